@@ -16,11 +16,15 @@ def generate_prebuilt_files(build_lib):
         subprocess.check_call(["make"], cwd=builddir)
         SO_NAME = "libthemis-frc.so"
         HEADER_NAME = "themis/themis.h"
+        # compiled along with generated code for host builds
+        HOST_SOURCE_NAMES = ["themis/themis.c", "themis/runloop.c", "themis/timers.c",
+                             "themis/profile.c", "themis/ds.c", "themis/frc_stub.c"]
 
         shutil.copyfile(os.path.join(builddir, SO_NAME),
                         os.path.join(build_lib, "themis", SO_NAME))
-        shutil.copyfile(os.path.join(source_dir, HEADER_NAME),
-                        os.path.join(build_lib, "themis", os.path.basename(HEADER_NAME)))
+        for name in [HEADER_NAME] + HOST_SOURCE_NAMES:
+            shutil.copyfile(os.path.join(source_dir, name),
+                            os.path.join(build_lib, "themis", os.path.basename(name)))
     print("finished compiling frc hal")
 
 
@@ -0,0 +1,77 @@
+// benchmark for calling the pure helpers through their static inline copies in themis.h, as generated code does,
+// against calling the exported versions in a shared library through the PLT, as it used to. not part of the runtime;
+// build and run it from this directory with:
+//   gcc -Os -fPIC -shared -I. themis.c -o /tmp/libthemis-helpers.so -lm
+//   gcc -Os -I. bench_helpers.c -L/tmp -lthemis-helpers -Wl,-rpath,/tmp -o /tmp/bench_helpers -lm && /tmp/bench_helpers
+// each update runs deadzone, choose_float, ramping_update, pwm_map and float_changed for six motors.
+
+#include <stdio.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <time.h>
+#include "themis.h"
+
+#define MOTORS 6
+#define SAMPLES 1024
+#define UPDATES 5000000
+
+static double axes[SAMPLES][MOTORS];
+static bool buttons[SAMPLES];
+
+static uint64_t now_ns(void) {
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec * UINT64_C(1000000000) + t.tv_nsec;
+}
+
+// the same update, written once for each way of calling the helpers
+#define UPDATE_LOOP(DEADZONE, CHOOSE, RAMP, PWM_MAP, CHANGED) \
+    double ramps[MOTORS] = {0}, written[MOTORS] = {0}; \
+    double checksum = 0; \
+    for (int i = 0; i < UPDATES; i++) { \
+        const double *axis = axes[i % SAMPLES]; \
+        for (int m = 0; m < MOTORS; m++) { \
+            double value = DEADZONE(axis[m], 0.1); \
+            value = CHOOSE(buttons[i % SAMPLES], value, value * 0.5); \
+            ramps[m] = RAMP(ramps[m], value, 0.05); \
+            double pwm = PWM_MAP(ramps[m], 0.989, 1.487, 1.513, 1.539, 2.037); \
+            if (CHANGED(written[m], pwm, 0.0)) { \
+                written[m] = pwm; \
+                checksum += pwm; \
+            } \
+        } \
+    } \
+    return checksum;
+
+static double __attribute__((noinline)) run_exported(void) {
+    UPDATE_LOOP(deadzone, choose_float, ramping_update, pwm_map, float_changed)
+}
+
+static double __attribute__((noinline)) run_inline(void) {
+    UPDATE_LOOP(deadzone_inline, choose_float_inline, ramping_update_inline, pwm_map_inline, float_changed_inline)
+}
+
+int main(void) {
+    uint32_t seed = 1;
+    for (int i = 0; i < SAMPLES; i++) {
+        for (int m = 0; m < MOTORS; m++) {
+            seed = seed * 1103515245 + 12345;
+            axes[i][m] = (double) (seed >> 8) / (1 << 24) * 2 - 1;
+        }
+        buttons[i] = (i / 64) % 2;
+    }
+
+    uint64_t start = now_ns();
+    double exported = run_exported();
+    uint64_t middle = now_ns();
+    double inlined = run_inline();
+    uint64_t end = now_ns();
+
+    printf("exported, through the PLT: %.1f ns/update\n", (double) (middle - start) / UPDATES);
+    printf("inline copies:             %.1f ns/update\n", (double) (end - middle) / UPDATES);
+    if (exported != inlined) {
+        printf("results differ: %f vs %f\n", exported, inlined);
+        return 1;
+    }
+    return 0;
+}
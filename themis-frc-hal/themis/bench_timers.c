@@ -0,0 +1,99 @@
+// benchmark for the one-shot timer heap in timers.c, against the malloc'd sorted list that it replaced. not part of
+// the runtime; build and run it from this directory with:
+//   gcc -O2 -pthread -I. bench_timers.c themis.c runloop.c -o /tmp/bench_timers -lm && /tmp/bench_timers
+// each row schedules and expires one timer while N others with random deadlines are already pending.
+
+#include "timers.c"
+
+struct list_timer {
+    uint64_t happen_at_ns;
+    struct list_timer *next;
+};
+
+static struct list_timer *list_head = NULL;
+
+// the insert from the original run_after_ns
+static void list_push(uint64_t happen_at_ns) {
+    struct list_timer *timer = malloc(sizeof(struct list_timer));
+    if (timer == NULL) {
+        perror("malloc");
+        panic("benchmark failure");
+    }
+    timer->happen_at_ns = happen_at_ns;
+    if (list_head == NULL || timer->happen_at_ns < list_head->happen_at_ns) {
+        timer->next = list_head;
+        list_head = timer;
+    } else {
+        struct list_timer *cur = list_head;
+        while (cur->next != NULL && cur->next->happen_at_ns < timer->happen_at_ns) {
+            cur = cur->next;
+        }
+        timer->next = cur->next;
+        cur->next = timer;
+    }
+}
+
+static uint64_t list_pop(void) {
+    struct list_timer *timer = list_head;
+    list_head = timer->next;
+    uint64_t happen_at_ns = timer->happen_at_ns;
+    free(timer);
+    return happen_at_ns;
+}
+
+static uint64_t random_deadline(void) {
+    return ((uint64_t) rand() << 16) ^ (uint64_t) rand();
+}
+
+static void heap_push(uint64_t happen_at_ns) {
+    struct one_shot_timer timer = {happen_at_ns, one_shot_sequence++, NULL};
+    one_shot_push(timer);
+}
+
+static double measure(void (*push)(uint64_t), uint64_t (*pop)(void), int pending, int iterations) {
+    srand(1);
+    for (int i = 0; i < pending; i++) {
+        push(random_deadline());
+    }
+    uint64_t start = get_time_nanos();
+    for (int i = 0; i < iterations; i++) {
+        push(random_deadline());
+        pop();
+    }
+    double per_op = (double) (get_time_nanos() - start) / iterations;
+    for (int i = 0; i < pending; i++) {
+        pop();
+    }
+    return per_op;
+}
+
+static uint64_t heap_pop(void) {
+    return one_shot_pop().happen_at_ns;
+}
+
+int main(void) {
+    // the heap has to hand timers back in deadline order
+    srand(2);
+    for (int i = 0; i < 3000; i++) {
+        heap_push(random_deadline());
+    }
+    uint64_t last = 0;
+    for (int i = 0; i < 3000; i++) {
+        uint64_t next = heap_pop();
+        if (next < last) {
+            panic("heap popped out of order");
+        }
+        last = next;
+    }
+
+    const int pending_counts[] = {10, 100, 1000, 4000};
+    printf("%-8s %14s %14s\n", "pending", "list ns/op", "heap ns/op");
+    for (unsigned int i = 0; i < sizeof(pending_counts) / sizeof(pending_counts[0]); i++) {
+        int pending = pending_counts[i];
+        int iterations = pending >= 1000 ? 20000 : 200000;
+        double list_ns = measure(list_push, list_pop, pending, iterations);
+        double heap_ns = measure(heap_push, heap_pop, pending, iterations);
+        printf("%-8d %14.0f %14.0f\n", pending, list_ns, heap_ns);
+    }
+    return 0;
+}
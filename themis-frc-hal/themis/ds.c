@@ -0,0 +1,48 @@
+#include <stdio.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <time.h>
+#include "themis.h"
+
+// driver station packets are handed from the driver station thread to the loop thread through a triple buffer: the
+// writer fills its own back buffer and swaps it into the middle, and the loop thread swaps the middle out for its
+// front buffer when it dispatches a packet. neither side ever waits for the other, and the loop thread always reads
+// one complete packet, however many arrive while a control update is running.
+
+#define DS_FRESH 4 // set in ds_middle when the middle buffer holds a packet the reader hasn't taken yet
+#define DS_INDEX 3
+
+static struct ds_snapshot ds_buffers[3]; // zeroed, so disabled with centered joysticks until the first packet
+static int ds_middle = 1; // shared between the threads
+static int ds_back = 2; // only used by the driver station thread
+static int ds_front = 0; // only used by the loop thread
+static uint64_t ds_sequence_next = 1; // only used by the driver station thread
+
+const struct ds_snapshot *ds_current = &ds_buffers[0];
+
+struct ds_snapshot *ds_publish_begin(void) {
+    struct ds_snapshot *packet = &ds_buffers[ds_back];
+    struct timespec t;
+    if (clock_gettime(CLOCK_MONOTONIC, &t) != 0) {
+        perror("clock_gettime");
+        panic("driver station critical failure");
+    }
+    packet->received_ns = t.tv_sec * UINT64_C(1000000000) + t.tv_nsec;
+    return packet;
+}
+
+void ds_publish(void) {
+    // numbered when published, so a gap in the sequence seen by the loop thread counts packets that were replaced
+    // before they could be dispatched
+    ds_buffers[ds_back].sequence = ds_sequence_next++;
+    ds_back = __atomic_exchange_n(&ds_middle, ds_back | DS_FRESH, __ATOMIC_ACQ_REL) & DS_INDEX;
+}
+
+bool ds_acquire(void) {
+    if (!(__atomic_load_n(&ds_middle, __ATOMIC_RELAXED) & DS_FRESH)) {
+        return false; // already taken by an earlier dispatch
+    }
+    ds_front = __atomic_exchange_n(&ds_middle, ds_front, __ATOMIC_ACQ_REL) & DS_INDEX;
+    ds_current = &ds_buffers[ds_front];
+    return true;
+}
@@ -13,26 +13,24 @@ enum frc_mode {
     MODE_TESTING = 3
 };
 
-#define JOYSTICK_NUM 6
-#define AXIS_NUM 12
+#define JOYSTICK_NUM DS_JOYSTICK_NUM
+#define AXIS_NUM DS_AXIS_NUM
 #define MAX_BUTTON_NUM 32
-#define PWM_NUM 20
+#define PWM_NUM 20 // at most 32, so that pwm_staged can have a bit for each
 #define PCM_NUM 63
 #define SOLENOID_NUM 8
 #define GPIO_NUM 26
 #define INTERRUPT_NUM 8
 
-static enum frc_mode robot_mode = MODE_DISABLED;
-static volatile bool ds_ready = true;
+static struct event_source ds_source;
 static callback ds_dispatch_target = NULL;
 static pthread_t ds_main_thread;
 static bool ds_run = true; // TODO: eliminate or use this
 
-static struct HALJoystickAxes stick_axes[JOYSTICK_NUM];
 static struct HALJoystickPOVs stick_povs[JOYSTICK_NUM];
-static struct HALJoystickButtons stick_buttons[JOYSTICK_NUM];
 
 static void *ds_mainloop(void *);
+static void ds_dispatch(void);
 
 static void pwm_init_config(void);
 
@@ -44,9 +42,17 @@ void ds_init(void) { // TODO: make sure this is used
 void ds_begin(callback target) {
     assert(ds_dispatch_target == NULL && target != NULL);
     ds_dispatch_target = target;
+    event_source_init(&ds_source, "driver station", ds_dispatch);
     pthread_create(&ds_main_thread, NULL, ds_mainloop, NULL);
 }
 
+static void ds_dispatch(void) {
+    // a packet published after this dispatch was dequeued queues another one, which then finds nothing new
+    if (ds_acquire()) {
+        ds_dispatch_target();
+    }
+}
+
 // TODO: also do something about warnings?
 #define HAL_CHECK(status, info) if (status < 0) { hal_panic(info, status); }
 
@@ -55,11 +61,6 @@ static void hal_panic(const char *info, int32_t status) {
     panic(info);
 }
 
-static void ds_dispatch(void) {
-    ds_ready = true;
-    ds_dispatch_target();
-}
-
 static enum frc_mode ds_calc_mode(HALControlWord word) {
     // TODO: use word.fmsAttached
     if (!word.enabled || !word.dsAttached || !word.eStop) {
@@ -84,10 +85,12 @@ static void *ds_mainloop(void *param) {
 
     while (ds_run) {
         takeMultiWait(data_semaphor, data_mutex);
+        struct ds_snapshot *packet = ds_publish_begin();
 
         HALControlWord word;
         HALGetControlWord(&word); // the official code ignores the return value. apparently it's okay.
-        robot_mode = ds_calc_mode(word);
+        enum frc_mode robot_mode = ds_calc_mode(word);
+        packet->robot_mode = robot_mode;
 
         switch (robot_mode) {
             case MODE_AUTONOMOUS:
@@ -105,45 +108,41 @@ static void *ds_mainloop(void *param) {
         }
 
         for (uint8_t stick = 0; stick < JOYSTICK_NUM; stick++) {
+            struct HALJoystickAxes axes;
+            struct HALJoystickButtons buttons;
             // again, the return values here are ignored in the official code. huh.
-            HALGetJoystickAxes(stick, &stick_axes[stick]);
+            HALGetJoystickAxes(stick, &axes);
             HALGetJoystickPOVs(stick, &stick_povs[stick]);
-            HALGetJoystickButtons(stick, &stick_buttons[stick]);
+            HALGetJoystickButtons(stick, &buttons);
+            for (int axis = 0; axis < AXIS_NUM; axis++) {
+                int16_t raw = axes.axes[axis];
+                packet->axes[stick][axis] = axis >= axes.count ? 0.0 : raw < 0 ? raw / 128.0 : raw / 127.0;
+            }
+            packet->buttons[stick] = buttons.count >= MAX_BUTTON_NUM ? buttons.buttons
+                                     : buttons.buttons & ((UINT32_C(1) << buttons.count) - 1);
         }
+        ds_publish();
 
-        // atomically set to false and, if it were true, go on to queue the event
-        if (__sync_fetch_and_and(&ds_ready, 0)) {
-            queue_event(ds_dispatch);
-        }
+        // if the last packet hasn't been handled yet, this one is collapsed into it
+        queue_source(&ds_source);
     }
     return NULL;
 }
 
 int get_robot_mode() {
-    return robot_mode;
+    return ds_mode();
 }
 
 double get_joystick_axis(int joy_i, int axis) {
     assert(0 <= joy_i && joy_i < JOYSTICK_NUM);
     assert(0 <= axis && axis < AXIS_NUM);
-    struct HALJoystickAxes axes = stick_axes[joy_i];
-    if (axis >= axes.count) {
-        return 0.0;
-    } else {
-        int16_t raw = axes.axes[axis];
-        return raw < 0 ? raw / 128.0 : raw / 127.0;
-    }
+    return ds_axis(joy_i, axis);
 }
 
 bool get_joystick_button(int joy_i, int btn) {
     assert(0 <= joy_i && joy_i < JOYSTICK_NUM);
     assert(0 <= btn && btn < MAX_BUTTON_NUM);
-    struct HALJoystickButtons buttons = stick_buttons[joy_i];
-    if (btn >= buttons.count) {
-        return false;
-    } else {
-        return (buttons.buttons & (1 << btn)) != 0;
-    }
+    return ds_button(joy_i, btn);
 }
 
 #define PWM_GEN_CENTER 1.5
@@ -153,6 +152,14 @@ bool get_joystick_button(int joy_i, int btn) {
 static void *pwms[PWM_NUM] = {NULL};
 static double pwm_shift = 0, pwm_multiplier = 0;
 
+// the raw value each channel was last set to, so that unchanged values don't cost an FPGA register write. channels
+// with a staged value are marked in pwm_staged, one bit each, and those that must be written even if unchanged are
+// also marked in pwm_forced.
+static uint16_t pwm_last_raw[PWM_NUM];
+static uint16_t pwm_staged_raw[PWM_NUM];
+static uint32_t pwm_staged = 0, pwm_forced = 0;
+static uint64_t pwm_writes = 0, pwm_skipped = 0; // only updated on the loop thread, but read by pwm_get_stats
+
 static void pwm_init_config() {
     int32_t status;
     uint16_t timing = getLoopTiming(&status);
@@ -174,6 +181,7 @@ void pwm_init(uint8_t pwm_id, uint8_t squelch, bool latch_pwm_zero) {
     }
     setPWM(port, 0, &status);
     HAL_CHECK(status, "pwm subsystem critical failure");
+    pwm_last_raw[pwm_id] = 0;
     setPWMPeriodScale(port, squelch, &status);
     HAL_CHECK(status, "pwm subsystem critical failure");
     if (latch_pwm_zero) { // TODO: find out why we skip this for servos
@@ -181,20 +189,60 @@ void pwm_init(uint8_t pwm_id, uint8_t squelch, bool latch_pwm_zero) {
         HAL_CHECK(status, "pwm subsystem critical failure");
     }
     pwms[pwm_id] = port;
+    runloop_after_dispatch(pwm_flush);
 }
 
-void pwm_update(double millis, int pwm_id) {
-    void *port = pwms[pwm_id];
-    assert(port != NULL);
-    unsigned short pwm_raw;
+static uint16_t pwm_raw(double millis) {
     if (isnan(millis)) {
-        pwm_raw = 0;
+        return 0;
     } else {
-        pwm_raw = (unsigned short) (millis * pwm_multiplier + pwm_shift);
+        return (uint16_t) (millis * pwm_multiplier + pwm_shift);
+    }
+}
+
+static void pwm_write(int pwm_id, uint16_t raw, bool force) {
+    if (!force && raw == pwm_last_raw[pwm_id]) {
+        __atomic_fetch_add(&pwm_skipped, 1, __ATOMIC_RELAXED);
+        return;
     }
     int32_t status;
-    setPWM(port, pwm_raw, &status);
+    setPWM(pwms[pwm_id], raw, &status);
     HAL_CHECK(status, "pwm subsystem critical failure");
+    pwm_last_raw[pwm_id] = raw;
+    __atomic_fetch_add(&pwm_writes, 1, __ATOMIC_RELAXED);
+}
+
+void pwm_update(double millis, int pwm_id) {
+    assert(pwms[pwm_id] != NULL);
+    pwm_write(pwm_id, pwm_raw(millis), false);
+}
+
+void pwm_stage(double millis, int pwm_id) {
+    assert(pwms[pwm_id] != NULL);
+    if (pwm_staged & (UINT32_C(1) << pwm_id)) {
+        __atomic_fetch_add(&pwm_skipped, 1, __ATOMIC_RELAXED); // the earlier value is never written
+    }
+    pwm_staged_raw[pwm_id] = pwm_raw(millis);
+    pwm_staged |= UINT32_C(1) << pwm_id;
+}
+
+void pwm_refresh(double millis, int pwm_id) {
+    pwm_stage(millis, pwm_id);
+    pwm_forced |= UINT32_C(1) << pwm_id;
+}
+
+void pwm_flush(void) {
+    while (pwm_staged != 0) {
+        int pwm_id = __builtin_ctz(pwm_staged);
+        pwm_staged &= pwm_staged - 1;
+        pwm_write(pwm_id, pwm_staged_raw[pwm_id], pwm_forced & (UINT32_C(1) << pwm_id));
+    }
+    pwm_forced = 0;
+}
+
+void pwm_get_stats(struct pwm_stats *stats) {
+    stats->writes = __atomic_load_n(&pwm_writes, __ATOMIC_RELAXED);
+    stats->skipped = __atomic_load_n(&pwm_skipped, __ATOMIC_RELAXED);
 }
 
 
@@ -255,7 +303,8 @@ void gpio_init_input_interrupt(uint8_t gpio_pin, uint8_t interrupt_id) {
 struct interrupt_params {
     void *gpio_port;
     void *interrupt_port;
-    callback cb;
+    struct event_source source;
+    char name[32];
     bool run; // TODO: eliminate or use
 };
 
@@ -273,9 +322,10 @@ void gpio_start_interrupt(int gpio_pin, int interrupt_id, callback cb) {
     }
     params->gpio_port = gpio_port;
     params->interrupt_port = interrupt_port;
-    params->cb = cb;
+    snprintf(params->name, sizeof(params->name), "gpio interrupt %d", interrupt_id);
+    event_source_init(&params->source, params->name, cb);
     params->run = true;
-    if (pthread_create(&interrupt_threads[interrupt_id], NULL, gpio_interrupt_handler_thread, &params) != 0) {
+    if (pthread_create(&interrupt_threads[interrupt_id], NULL, gpio_interrupt_handler_thread, params) != 0) {
         perror("pthread_create");
         panic("gpio subsystem critical failure");
     }
@@ -288,7 +338,8 @@ static void *gpio_interrupt_handler_thread(void *param) {
         // TODO: optimize based on timing out or not - timed out if the return value is 0.
         waitForInterrupt(params->interrupt_port, 10.0, false, &status);
         HAL_CHECK(status, "gpio subsystem critical failure");
-        queue_event(params->cb);
+        // edges that arrive while the callback is still pending are collapsed into it
+        queue_source(&params->source);
     }
     free(params);
     return NULL;
@@ -0,0 +1,321 @@
+// Host stand-in for frc.cpp: instead of talking to the roboRIO HAL, this reads driver station packets and sensor
+// changes as text commands and writes actuator updates as text lines, so that generated programs can run on a
+// developer machine.
+//
+// Input (THEMIS_HOST_INPUT, default stdin), one command per line:
+//   mode <0-3>              set the robot mode for subsequent packets
+//   axis <joy> <axis> <v>   set a joystick axis (0-indexed, -1.0 to 1.0)
+//   button <joy> <btn> <b>  set a joystick button (0-indexed, 0 or 1)
+//   gpio <pin> <b>          set a GPIO input, firing its interrupt if it changed
+//   packet                  deliver a driver station packet, with the mode, axes and buttons as they are now
+//   sync                    wait until every packet so far has been dispatched, so that none are collapsed
+//   quit                    finish pending events and exit (also happens on end of input)
+// Output (THEMIS_HOST_OUTPUT, default stdout), one line per actuator update (PWM updates that leave a channel's
+// value unchanged, as the real HAL would skip them, aren't written):
+//   <monotonic ns> <packet sequence> pwm <id> <millis>
+//   <monotonic ns> <packet sequence> solenoid <pcm> <id> <b>
+// where the packet sequence is that of the latest packet dispatched, and skips any packets that were replaced by newer
+// ones before they could be dispatched.
+// Packet dispatch latency, the mean time spent in the robot's update for each packet, PWM write counts and runloop
+// queue statistics are written to stderr on exit.
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <assert.h>
+#include <math.h>
+#include <time.h>
+#include "themis.h"
+
+#define JOYSTICK_NUM DS_JOYSTICK_NUM
+#define AXIS_NUM DS_AXIS_NUM
+#define MAX_BUTTON_NUM 32
+#define PWM_NUM 20 // at most 32, so that pwm_staged can have a bit for each
+#define PCM_NUM 63
+#define SOLENOID_NUM 8
+#define GPIO_NUM 26
+#define INTERRUPT_NUM 8
+
+#define PTHREAD_CHECK(call, ...) if (call(__VA_ARGS__) != 0) { perror(#call); panic("host stub critical failure"); }
+
+static pthread_mutex_t state_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static int robot_mode = 0;
+static double stick_axes[JOYSTICK_NUM][AXIS_NUM];
+static uint32_t stick_buttons[JOYSTICK_NUM];
+static bool gpio_values[GPIO_NUM];
+
+static struct event_source ds_source;
+static callback ds_dispatch_target = NULL;
+static pthread_t ds_main_thread;
+static FILE *output = NULL;
+
+static uint64_t packets_received = 0, packets_dispatched = 0, latency_total_ns = 0, latency_max_ns = 0;
+static uint64_t update_total_ns = 0;
+static uint64_t dispatched_sequence = 0; // written by the loop thread, and waited on by sync
+
+static bool pwm_ready[PWM_NUM];
+static double pwm_last[PWM_NUM], pwm_staged_millis[PWM_NUM];
+static uint32_t pwm_staged = 0, pwm_forced = 0;
+static uint64_t pwm_writes = 0, pwm_skipped = 0; // only updated on the loop thread, but read by pwm_get_stats
+static bool solenoid_ready[PCM_NUM][SOLENOID_NUM];
+static bool gpio_ready[GPIO_NUM];
+static int interrupt_pins[INTERRUPT_NUM];
+static bool interrupt_started[INTERRUPT_NUM];
+static struct event_source interrupt_sources[INTERRUPT_NUM];
+static char interrupt_names[INTERRUPT_NUM][32];
+
+static uint64_t get_time_nanos(void) {
+    struct timespec t;
+    if (clock_gettime(CLOCK_MONOTONIC, &t) != 0) {
+        perror("clock_gettime");
+        panic("host stub critical failure");
+    }
+    return t.tv_sec * UINT64_C(1000000000) + t.tv_nsec;
+}
+
+static void *ds_mainloop(void *);
+static void ds_dispatch(void);
+
+void ds_init(void) {
+    const char *path = getenv("THEMIS_HOST_OUTPUT");
+    output = path == NULL ? stdout : fopen(path, "w");
+    if (output == NULL) {
+        perror("fopen");
+        panic("host stub critical failure");
+    }
+    for (int i = 0; i < INTERRUPT_NUM; i++) {
+        interrupt_pins[i] = -1;
+    }
+}
+
+void ds_begin(callback target) {
+    assert(ds_dispatch_target == NULL && target != NULL);
+    ds_dispatch_target = target;
+    event_source_init(&ds_source, "driver station", ds_dispatch);
+    PTHREAD_CHECK(pthread_create, &ds_main_thread, NULL, ds_mainloop, NULL);
+}
+
+static void ds_dispatch(void) {
+    if (!ds_acquire()) {
+        return; // this packet was already taken by the previous dispatch
+    }
+    uint64_t start_ns = get_time_nanos();
+    ds_dispatch_target();
+    uint64_t end_ns = get_time_nanos();
+    __atomic_store_n(&dispatched_sequence, ds_current->sequence, __ATOMIC_RELEASE);
+    uint64_t latency = end_ns - ds_current->received_ns;
+    update_total_ns += end_ns - start_ns;
+    packets_dispatched++;
+    latency_total_ns += latency;
+    if (latency > latency_max_ns) {
+        latency_max_ns = latency;
+    }
+}
+
+static void host_exit(void) {
+    fflush(output);
+    fprintf(stderr, "packets received: %llu, dispatched: %llu, mean latency: %llu ns, max latency: %llu ns\n",
+            (unsigned long long) packets_received, (unsigned long long) packets_dispatched,
+            (unsigned long long) (packets_dispatched ? latency_total_ns / packets_dispatched : 0),
+            (unsigned long long) latency_max_ns);
+    fprintf(stderr, "mean update: %llu ns\n",
+            (unsigned long long) (packets_dispatched ? update_total_ns / packets_dispatched : 0));
+    struct pwm_stats pwm;
+    pwm_get_stats(&pwm);
+    fprintf(stderr, "pwm writes: %llu, skipped: %llu\n", (unsigned long long) pwm.writes,
+            (unsigned long long) pwm.skipped);
+    struct runloop_stats stats;
+    runloop_get_stats(&stats);
+    fprintf(stderr, "runloop queue high water: %u/%u, dropped: %u, wakeups: %llu\n", stats.high_water,
+            stats.capacity, stats.dropped, (unsigned long long) stats.wakeups);
+    runloop_report_sources();
+    exit(0);
+}
+
+static void handle_gpio(int pin, bool value) {
+    if (pin < 0 || pin >= GPIO_NUM) {
+        fprintf(stderr, "gpio pin out of range: %d\n", pin);
+        return;
+    }
+    PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+    bool changed = gpio_values[pin] != value;
+    gpio_values[pin] = value;
+    for (int i = 0; changed && i < INTERRUPT_NUM; i++) {
+        if (interrupt_pins[i] == pin && interrupt_started[i]) {
+            queue_source(&interrupt_sources[i]);
+        }
+    }
+    PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+}
+
+static void *ds_mainloop(void *param) {
+    const char *path = getenv("THEMIS_HOST_INPUT");
+    FILE *input = path == NULL ? stdin : fopen(path, "r");
+    if (input == NULL) {
+        perror("fopen");
+        panic("host stub critical failure");
+    }
+    char line[256];
+    while (fgets(line, sizeof(line), input) != NULL) {
+        int a, b, c;
+        double v;
+        if (sscanf(line, "mode %d", &a) == 1) {
+            PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+            robot_mode = a;
+            PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+        } else if (sscanf(line, "axis %d %d %lf", &a, &b, &v) == 3 && 0 <= a && a < JOYSTICK_NUM
+                   && 0 <= b && b < AXIS_NUM) {
+            PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+            stick_axes[a][b] = v;
+            PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+        } else if (sscanf(line, "button %d %d %d", &a, &b, &c) == 3 && 0 <= a && a < JOYSTICK_NUM
+                   && 0 <= b && b < MAX_BUTTON_NUM) {
+            PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+            if (c) {
+                stick_buttons[a] |= UINT32_C(1) << b;
+            } else {
+                stick_buttons[a] &= ~(UINT32_C(1) << b);
+            }
+            PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+        } else if (sscanf(line, "gpio %d %d", &a, &b) == 2) {
+            handle_gpio(a, b != 0);
+        } else if (strncmp(line, "packet", 6) == 0) {
+            packets_received++;
+            struct ds_snapshot *packet = ds_publish_begin();
+            PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+            packet->robot_mode = robot_mode;
+            for (int joy = 0; joy < JOYSTICK_NUM; joy++) {
+                for (int axis = 0; axis < AXIS_NUM; axis++) {
+                    packet->axes[joy][axis] = stick_axes[joy][axis];
+                }
+                packet->buttons[joy] = stick_buttons[joy];
+            }
+            PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+            ds_publish();
+            // a packet that arrives while one is still pending replaces it, and its dispatch is collapsed into it
+            queue_source(&ds_source);
+        } else if (strncmp(line, "sync", 4) == 0) {
+            // every packet is published with the next sequence number, so this is the last one published
+            struct timespec pause = {0, 10000};
+            while (__atomic_load_n(&dispatched_sequence, __ATOMIC_ACQUIRE) < packets_received) {
+                nanosleep(&pause, NULL);
+            }
+        } else if (strncmp(line, "quit", 4) == 0) {
+            break;
+        } else if (line[0] != '\n' && line[0] != '#') {
+            fprintf(stderr, "unrecognized host command: %s", line);
+        }
+    }
+    queue_event(host_exit);
+    return NULL;
+}
+
+int get_robot_mode() {
+    return ds_mode();
+}
+
+double get_joystick_axis(int joy_i, int axis) {
+    assert(0 <= joy_i && joy_i < JOYSTICK_NUM);
+    assert(0 <= axis && axis < AXIS_NUM);
+    return ds_axis(joy_i, axis);
+}
+
+bool get_joystick_button(int joy_i, int btn) {
+    assert(0 <= joy_i && joy_i < JOYSTICK_NUM);
+    assert(0 <= btn && btn < MAX_BUTTON_NUM);
+    return ds_button(joy_i, btn);
+}
+
+void pwm_init(uint8_t pwm_id, uint8_t squelch, bool latch_pwm_zero) {
+    assert(pwm_id < PWM_NUM && !pwm_ready[pwm_id]);
+    pwm_ready[pwm_id] = true;
+    pwm_last[pwm_id] = NAN; // what the real HAL's raw 0 means
+    runloop_after_dispatch(pwm_flush);
+}
+
+static void pwm_write(int pwm_id, double millis, bool force) {
+    // compared as values rather than as raw FPGA steps, since there's no FPGA here to say how long a step is
+    if (!force && (millis == pwm_last[pwm_id] || (isnan(millis) && isnan(pwm_last[pwm_id])))) {
+        __atomic_fetch_add(&pwm_skipped, 1, __ATOMIC_RELAXED);
+        return;
+    }
+    fprintf(output, "%llu %llu pwm %d %f\n", (unsigned long long) get_time_nanos(),
+            (unsigned long long) ds_current->sequence, pwm_id, millis);
+    pwm_last[pwm_id] = millis;
+    __atomic_fetch_add(&pwm_writes, 1, __ATOMIC_RELAXED);
+}
+
+void pwm_update(double millis, int pwm_id) {
+    assert(0 <= pwm_id && pwm_id < PWM_NUM && pwm_ready[pwm_id]);
+    pwm_write(pwm_id, millis, false);
+}
+
+void pwm_stage(double millis, int pwm_id) {
+    assert(0 <= pwm_id && pwm_id < PWM_NUM && pwm_ready[pwm_id]);
+    if (pwm_staged & (UINT32_C(1) << pwm_id)) {
+        __atomic_fetch_add(&pwm_skipped, 1, __ATOMIC_RELAXED); // the earlier value is never written
+    }
+    pwm_staged_millis[pwm_id] = millis;
+    pwm_staged |= UINT32_C(1) << pwm_id;
+}
+
+void pwm_refresh(double millis, int pwm_id) {
+    pwm_stage(millis, pwm_id);
+    pwm_forced |= UINT32_C(1) << pwm_id;
+}
+
+void pwm_flush(void) {
+    while (pwm_staged != 0) {
+        int pwm_id = __builtin_ctz(pwm_staged);
+        pwm_staged &= pwm_staged - 1;
+        pwm_write(pwm_id, pwm_staged_millis[pwm_id], pwm_forced & (UINT32_C(1) << pwm_id));
+    }
+    pwm_forced = 0;
+}
+
+void pwm_get_stats(struct pwm_stats *stats) {
+    stats->writes = __atomic_load_n(&pwm_writes, __ATOMIC_RELAXED);
+    stats->skipped = __atomic_load_n(&pwm_skipped, __ATOMIC_RELAXED);
+}
+
+void solenoid_init(uint8_t pcm_id, uint8_t solenoid_id) {
+    assert(pcm_id < PCM_NUM && solenoid_id < SOLENOID_NUM && !solenoid_ready[pcm_id][solenoid_id]);
+    solenoid_ready[pcm_id][solenoid_id] = true;
+}
+
+void solenoid_update(bool on, uint8_t pcm_id, uint8_t solenoid_id) {
+    assert(pcm_id < PCM_NUM && solenoid_id < SOLENOID_NUM && solenoid_ready[pcm_id][solenoid_id]);
+    fprintf(output, "%llu %llu solenoid %d %d %d\n", (unsigned long long) get_time_nanos(),
+            (unsigned long long) ds_current->sequence, pcm_id, solenoid_id, on);
+}
+
+void gpio_init_input_poll(int gpio_pin) {
+    assert(0 <= gpio_pin && gpio_pin < GPIO_NUM && !gpio_ready[gpio_pin]);
+    gpio_ready[gpio_pin] = true;
+}
+
+bool gpio_poll_input(int gpio_pin) {
+    assert(0 <= gpio_pin && gpio_pin < GPIO_NUM && gpio_ready[gpio_pin]);
+    PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+    bool value = gpio_values[gpio_pin];
+    PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+    return value;
+}
+
+void gpio_init_input_interrupt(uint8_t gpio_pin, uint8_t interrupt_id) {
+    assert(interrupt_id < INTERRUPT_NUM && interrupt_pins[interrupt_id] == -1);
+    gpio_init_input_poll(gpio_pin);
+    interrupt_pins[interrupt_id] = gpio_pin;
+}
+
+void gpio_start_interrupt(int gpio_pin, int interrupt_id, callback cb) {
+    assert(0 <= interrupt_id && interrupt_id < INTERRUPT_NUM && interrupt_pins[interrupt_id] == gpio_pin);
+    PTHREAD_CHECK(pthread_mutex_lock, &state_lock);
+    snprintf(interrupt_names[interrupt_id], sizeof(interrupt_names[interrupt_id]), "gpio interrupt %d", interrupt_id);
+    event_source_init(&interrupt_sources[interrupt_id], interrupt_names[interrupt_id], cb);
+    interrupt_started[interrupt_id] = true;
+    PTHREAD_CHECK(pthread_mutex_unlock, &state_lock);
+}
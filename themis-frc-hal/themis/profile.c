@@ -0,0 +1,86 @@
+#include <pthread.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <time.h>
+#include <assert.h>
+#include <stdbool.h>
+#include <errno.h>
+#include "themis.h"
+
+// per-instant counters for programs generated with profiling enabled. the table is dumped to THEMIS_PROFILE_OUTPUT
+// (default themis-profile.txt) whenever the process receives SIGUSR1, and also every THEMIS_PROFILE_INTERVAL_MS
+// milliseconds if that is set. themis/profile.py maps the dump back to the graph that generated it.
+
+#define PTHREAD_CHECK(call, ...) if (call(__VA_ARGS__) != 0) { perror(#call); panic("profiler critical failure"); }
+
+static struct profile_entry *profile_table = NULL;
+static uint32_t profile_count = 0;
+static pthread_t profile_thread;
+
+uint64_t profile_begin(void) {
+    struct timespec t;
+    if (clock_gettime(CLOCK_MONOTONIC, &t) != 0) {
+        perror("clock_gettime");
+        panic("profiler critical failure");
+    }
+    return t.tv_sec * UINT64_C(1000000000) + t.tv_nsec;
+}
+
+void profile_end(struct profile_entry *entry, uint64_t start_ns) {
+    // instants only run on the loop thread, but the dump thread reads these concurrently
+    __atomic_fetch_add(&entry->calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&entry->total_ns, profile_begin() - start_ns, __ATOMIC_RELAXED);
+}
+
+static void profile_dump(const char *path) {
+    char temp_path[256];
+    snprintf(temp_path, sizeof(temp_path), "%s.tmp", path);
+    FILE *out = fopen(temp_path, "w");
+    if (out == NULL) {
+        perror("fopen");
+        return; // losing a dump isn't worth stopping the robot
+    }
+    fprintf(out, "# themis profile at %llu ns: name uid calls total_ns\n", (unsigned long long) profile_begin());
+    for (uint32_t i = 0; i < profile_count; i++) {
+        fprintf(out, "%s %u %llu %llu\n", profile_table[i].name, (unsigned int) profile_table[i].uid,
+                (unsigned long long) __atomic_load_n(&profile_table[i].calls, __ATOMIC_RELAXED),
+                (unsigned long long) __atomic_load_n(&profile_table[i].total_ns, __ATOMIC_RELAXED));
+    }
+    // renamed into place, so that readers never see a partial dump
+    if (fclose(out) != 0 || rename(temp_path, path) != 0) {
+        perror("profile dump");
+    }
+}
+
+static void *profile_body(void *param) {
+    const char *path = getenv("THEMIS_PROFILE_OUTPUT");
+    const char *interval = getenv("THEMIS_PROFILE_INTERVAL_MS");
+    long interval_ms = interval == NULL ? 0 : strtol(interval, NULL, 10);
+    struct timespec timeout;
+    timeout.tv_sec = interval_ms / 1000;
+    timeout.tv_nsec = (interval_ms % 1000) * 1000000;
+    sigset_t signals;
+    sigemptyset(&signals);
+    sigaddset(&signals, SIGUSR1);
+    while (true) {
+        if (sigtimedwait(&signals, NULL, interval_ms > 0 ? &timeout : NULL) < 0 && errno != EAGAIN) {
+            continue; // interrupted
+        }
+        profile_dump(path == NULL ? "themis-profile.txt" : path);
+    }
+    return NULL;
+}
+
+// must be called before any other threads are started, so that they all inherit the blocked SIGUSR1
+void profile_start_dump(struct profile_entry *table, uint32_t count) {
+    assert(profile_table == NULL);
+    profile_table = table;
+    profile_count = count;
+    sigset_t signals;
+    sigemptyset(&signals);
+    sigaddset(&signals, SIGUSR1);
+    PTHREAD_CHECK(pthread_sigmask, SIG_BLOCK, &signals, NULL);
+    PTHREAD_CHECK(pthread_create, &profile_thread, NULL, profile_body, NULL);
+}
@@ -1,64 +1,303 @@
-#include <pthread.h>
+#include <unistd.h>
+#include <sys/eventfd.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <stdbool.h>
 #include <assert.h>
+#include <errno.h>
 #include "themis.h"
+#ifdef THEMIS_RUNLOOP_EPOLL
+#include <sys/epoll.h>
+#endif
 
-struct queue_entry {
-    struct queue_entry *next_in_queue;
+// bounded multi-producer, single-consumer ring (after Vyukov's bounded queue). each slot carries a sequence number
+// that tells producers and the consumer whose turn it is to use the slot, so no locks and no allocation are needed.
+#ifndef RUNLOOP_QUEUE_CAPACITY
+#define RUNLOOP_QUEUE_CAPACITY 256
+#endif
+#if RUNLOOP_QUEUE_CAPACITY & (RUNLOOP_QUEUE_CAPACITY - 1)
+#error "RUNLOOP_QUEUE_CAPACITY must be a power of two"
+#endif
+#define QUEUE_MASK (RUNLOOP_QUEUE_CAPACITY - 1)
+
+struct queue_slot {
+    uint32_t sequence;
     callback cb;
+    struct event_source *source; // NULL for plain queue_event calls
+};
+
+static struct queue_slot queue_slots[RUNLOOP_QUEUE_CAPACITY];
+static uint32_t enqueue_pos = 0; // shared by producers
+static uint32_t dequeue_pos = 0; // only written by the consumer
+
+// the consumer only sleeps on the eventfd after announcing it in consumer_sleeping, so producers can skip the
+// write() syscall whenever the loop is already running.
+static int wakeup_fd = -1;
+static int consumer_sleeping = 0;
+
+static uint32_t high_water = 0;
+static uint32_t dropped = 0;
+static uint64_t queued = 0;
+static uint64_t dispatched = 0;
+static uint64_t wakeups = 0;
+
+static struct event_source *sources = NULL;
+static callback after_dispatch = NULL; // only used by the loop thread
+
+#ifdef THEMIS_RUNLOOP_EPOLL
+// in this mode, the loop sleeps in epoll_wait on the wakeup eventfd plus any file descriptors that other parts of the
+// runtime (such as the timers) have asked it to watch, so those don't need threads of their own.
+#ifndef RUNLOOP_MAX_WATCHES
+#define RUNLOOP_MAX_WATCHES 64
+#endif
+// how many events to dispatch before checking watched descriptors again, so that a busy queue can't starve them
+#ifndef RUNLOOP_POLL_INTERVAL
+#define RUNLOOP_POLL_INTERVAL 16
+#endif
+
+struct fd_watch {
+    void (*ready)(void *context);
+    void *context;
 };
 
-static pthread_mutex_t queue_lock = PTHREAD_MUTEX_INITIALIZER;
-static pthread_cond_t queue_cond = PTHREAD_COND_INITIALIZER;
+static int epoll_fd = -1;
+static struct fd_watch watches[RUNLOOP_MAX_WATCHES];
+static int watch_count = 0;
+#endif
+
+#define LOAD(ptr) __atomic_load_n(ptr, __ATOMIC_ACQUIRE)
+#define STORE(ptr, value) __atomic_store_n(ptr, value, __ATOMIC_RELEASE)
+#define COUNT(ptr) __atomic_fetch_add(ptr, 1, __ATOMIC_RELAXED)
+
+static void queue_init(void) {
+    for (uint32_t i = 0; i < RUNLOOP_QUEUE_CAPACITY; i++) {
+        queue_slots[i].sequence = i;
+    }
+    wakeup_fd = eventfd(0, 0);
+    if (wakeup_fd < 0) {
+        perror("eventfd");
+        panic("runloop critical failure");
+    }
+#ifdef THEMIS_RUNLOOP_EPOLL
+    epoll_fd = epoll_create1(EPOLL_CLOEXEC);
+    if (epoll_fd < 0) {
+        perror("epoll_create1");
+        panic("runloop critical failure");
+    }
+    struct epoll_event event;
+    event.events = EPOLLIN;
+    event.data.ptr = NULL; // the wakeup eventfd is the only entry without a watch
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, wakeup_fd, &event) != 0) {
+        perror("epoll_ctl");
+        panic("runloop critical failure");
+    }
+#endif
+}
+
+static void consume_wakeup(void) {
+    eventfd_t count;
+    while (eventfd_read(wakeup_fd, &count) != 0) {
+        if (errno != EINTR) {
+            perror("eventfd_read");
+            panic("runloop critical failure");
+        }
+    }
+}
+
+#ifdef THEMIS_RUNLOOP_EPOLL
+// can only be used from the loop thread, once the loop has started
+void runloop_watch_fd(int fd, void (*ready)(void *context), void *context) {
+    assert(epoll_fd >= 0 && ready != NULL);
+    if (watch_count >= RUNLOOP_MAX_WATCHES) {
+        panic("too many file descriptors watched by the runloop");
+    }
+    struct fd_watch *watch = &watches[watch_count++];
+    watch->ready = ready;
+    watch->context = context;
+    struct epoll_event event;
+    event.events = EPOLLIN;
+    event.data.ptr = watch;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, fd, &event) != 0) {
+        perror("epoll_ctl");
+        panic("runloop critical failure");
+    }
+}
+
+static void poll_watches(int timeout_ms) {
+    struct epoll_event events[RUNLOOP_MAX_WATCHES + 1];
+    int count;
+    while ((count = epoll_wait(epoll_fd, events, RUNLOOP_MAX_WATCHES + 1, timeout_ms)) < 0) {
+        if (errno != EINTR) {
+            perror("epoll_wait");
+            panic("runloop critical failure");
+        }
+    }
+    // we're awake from here on, so anything the handlers queue doesn't need to signal us
+    __atomic_store_n(&consumer_sleeping, 0, __ATOMIC_SEQ_CST);
+    for (int i = 0; i < count; i++) {
+        struct fd_watch *watch = (struct fd_watch *) events[i].data.ptr;
+        if (watch == NULL) {
+            consume_wakeup();
+        } else {
+            watch->ready(watch->context);
+        }
+    }
+}
+#endif
 
-// read from head; write to tail
-static struct queue_entry *queue_head = NULL;
-static struct queue_entry *queue_tail = NULL;
+static callback queue_take(void) {
+    struct queue_slot *slot = &queue_slots[dequeue_pos & QUEUE_MASK];
+    if ((int32_t) (LOAD(&slot->sequence) - (dequeue_pos + 1)) < 0) {
+        return NULL; // empty, or a producer hasn't finished writing its slot yet
+    }
+    callback cb = slot->cb;
+    if (slot->source != NULL) {
+        // cleared before dispatch, so that anything that happens while the callback runs queues it again. the
+        // exchange synchronizes with the producer's, so the callback sees whatever state the producer published.
+        __atomic_exchange_n(&slot->source->pending, 0, __ATOMIC_ACQ_REL);
+    }
+    // hand the slot back to producers for the next lap around the ring
+    STORE(&slot->sequence, dequeue_pos + RUNLOOP_QUEUE_CAPACITY);
+    STORE(&dequeue_pos, dequeue_pos + 1);
+    return cb;
+}
 
-#define PTHREAD_CHECK(call, ...) if (call(__VA_ARGS__) != 0) { perror(#call); panic("runloop critical failure"); }
+static void wait_for_events(void) {
+    __atomic_store_n(&consumer_sleeping, 1, __ATOMIC_SEQ_CST);
+    // recheck after announcing, so that a producer that missed the flag must have published an entry we can see
+    if (__atomic_load_n(&queue_slots[dequeue_pos & QUEUE_MASK].sequence, __ATOMIC_SEQ_CST) == dequeue_pos + 1) {
+        __atomic_store_n(&consumer_sleeping, 0, __ATOMIC_SEQ_CST);
+        return;
+    }
+#ifdef THEMIS_RUNLOOP_EPOLL
+    poll_watches(-1);
+#else
+    consume_wakeup();
+#endif
+    __atomic_store_n(&consumer_sleeping, 0, __ATOMIC_SEQ_CST);
+    COUNT(&wakeups);
+}
 
 void enter_loop(callback entry) {
+    queue_init();
     queue_event(entry);
     while (true) {
-        PTHREAD_CHECK(pthread_mutex_lock, &queue_lock);
-        while (queue_head == NULL) {
-            assert(queue_tail == NULL);
-            PTHREAD_CHECK(pthread_cond_wait, &queue_cond, &queue_lock);
+        callback target = queue_take();
+        if (target == NULL) {
+            wait_for_events();
+            continue;
         }
-        struct queue_entry *old = queue_head;
-        queue_head = old->next_in_queue;
-        if (queue_head == NULL) {
-            assert(old == queue_tail);
-            queue_tail = NULL;
+#ifdef THEMIS_RUNLOOP_EPOLL
+        if (COUNT(&dispatched) % RUNLOOP_POLL_INTERVAL == RUNLOOP_POLL_INTERVAL - 1) {
+            poll_watches(0);
         }
-        PTHREAD_CHECK(pthread_mutex_unlock, &queue_lock);
-        callback target = old->cb;
-        free(old);
-        // now, while we don't hold the lock, dispatch to the callback.
+#else
+        COUNT(&dispatched);
+#endif
         target();
+        if (after_dispatch != NULL) {
+            after_dispatch();
+        }
     }
 }
 
-// TODO: have a maximum length for the queue?
-void queue_event(callback cb) {
-    struct queue_entry *ent = (struct queue_entry *) malloc(sizeof(struct queue_entry));
-    if (ent == NULL) {
-        perror("malloc");
+// runs cb on the loop thread once each dispatched event has finished, so that output written by the event can be
+// batched up and applied all at once. can only be used from the loop thread.
+void runloop_after_dispatch(callback cb) {
+    assert(cb != NULL && (after_dispatch == NULL || after_dispatch == cb)); // only one hook is supported
+    after_dispatch = cb;
+}
+
+// never blocks the producer (which may be the timer thread or an interrupt thread) or allocates: if the ring is full,
+// returns false, and the caller decides what losing the event means (see themis.h for the policy).
+static bool queue_push(callback cb, struct event_source *source) {
+    assert(cb != NULL && wakeup_fd >= 0); // only usable once enter_loop has started
+    uint32_t pos = __atomic_load_n(&enqueue_pos, __ATOMIC_RELAXED);
+    struct queue_slot *slot;
+    while (true) {
+        slot = &queue_slots[pos & QUEUE_MASK];
+        int32_t diff = (int32_t) (LOAD(&slot->sequence) - pos);
+        if (diff == 0) {
+            // the slot is free for this position; claim the position
+            if (__atomic_compare_exchange_n(&enqueue_pos, &pos, pos + 1, true, __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+                break;
+            }
+            // pos was reloaded by the failed compare-exchange
+        } else if (diff < 0) {
+            // the consumer hasn't released this slot from the previous lap yet: full
+            return false;
+        } else {
+            pos = __atomic_load_n(&enqueue_pos, __ATOMIC_RELAXED);
+        }
+    }
+    slot->cb = cb;
+    slot->source = source;
+    STORE(&slot->sequence, pos + 1);
+    COUNT(&queued);
+
+    // the consumer may already have passed us, in which case this is not a new maximum
+    int32_t depth = (int32_t) (pos + 1 - LOAD(&dequeue_pos));
+    uint32_t seen = __atomic_load_n(&high_water, __ATOMIC_RELAXED);
+    while (depth > (int32_t) seen && !__atomic_compare_exchange_n(&high_water, &seen, (uint32_t) depth, true,
+                                                                  __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {}
+
+    // pairs with the store in wait_for_events: either the consumer sees our entry, or we see it sleeping
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&consumer_sleeping, __ATOMIC_SEQ_CST) && eventfd_write(wakeup_fd, 1) != 0) {
+        perror("eventfd_write");
         panic("runloop critical failure");
     }
-    ent->cb = cb;
-    ent->next_in_queue = NULL;
-    PTHREAD_CHECK(pthread_mutex_lock, &queue_lock);
-    if (queue_tail == NULL) {
-        assert(queue_head == NULL);
-        queue_tail = queue_head = ent;
-    } else {
-        assert(queue_head != NULL);
-        queue_tail = queue_tail->next_in_queue = ent;
-    }
-    PTHREAD_CHECK(pthread_cond_signal, &queue_cond);
-    PTHREAD_CHECK(pthread_mutex_unlock, &queue_lock);
-    return; // success!
+    return true;
+}
+
+void queue_event(callback cb) {
+    if (!queue_push(cb, NULL)) {
+        // nothing would ever queue this event again, so whatever was waiting on it would stall forever
+        panic("runloop queue overflow: one-shot event lost");
+    }
+}
+
+void event_source_init(struct event_source *source, const char *name, callback cb) {
+    assert(source != NULL && name != NULL && cb != NULL);
+    source->cb = cb;
+    source->name = name;
+    source->pending = 0;
+    source->queued = 0;
+    source->coalesced = 0;
+    source->next_source = __atomic_load_n(&sources, __ATOMIC_RELAXED);
+    while (!__atomic_compare_exchange_n(&sources, &source->next_source, source, true,
+                                        __ATOMIC_RELEASE, __ATOMIC_RELAXED)) {}
+}
+
+// returns true if the event was queued, or false if it was collapsed into one that's already pending.
+bool queue_source(struct event_source *source) {
+    if (__atomic_exchange_n(&source->pending, 1, __ATOMIC_ACQ_REL)) {
+        COUNT(&source->coalesced);
+        return false;
+    }
+    if (!queue_push(source->cb, source)) {
+        COUNT(&dropped);
+        __atomic_store_n(&source->pending, 0, __ATOMIC_RELEASE); // dropped, so it must be allowed to queue again
+        return false;
+    }
+    COUNT(&source->queued);
+    return true;
+}
+
+void runloop_report_sources(void) {
+    for (struct event_source *source = LOAD(&sources); source != NULL; source = source->next_source) {
+        fprintf(stderr, "event source %s: queued %u, coalesced %u\n", source->name,
+                __atomic_load_n(&source->queued, __ATOMIC_RELAXED),
+                __atomic_load_n(&source->coalesced, __ATOMIC_RELAXED));
+    }
+}
+
+void runloop_get_stats(struct runloop_stats *stats) {
+    stats->capacity = RUNLOOP_QUEUE_CAPACITY;
+    stats->high_water = __atomic_load_n(&high_water, __ATOMIC_RELAXED);
+    stats->dropped = __atomic_load_n(&dropped, __ATOMIC_RELAXED);
+    stats->queued = __atomic_load_n(&queued, __ATOMIC_RELAXED);
+    stats->dispatched = __atomic_load_n(&dispatched, __ATOMIC_RELAXED);
+    stats->wakeups = __atomic_load_n(&wakeups, __ATOMIC_RELAXED);
 }
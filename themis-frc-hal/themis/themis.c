@@ -14,29 +14,21 @@ void do_nothing(void) {
 }
 
 double deadzone(double value, double zone) {
-    return fabs(value) >= zone ? value : 0.0;
+    return deadzone_inline(value, zone);
 }
 
 double choose_float(bool cond, double a, double b) {
-    return cond ? a : b;
+    return choose_float_inline(cond, a, b);
 }
 
 double pwm_map(double value, double rev_max, double rev_min, double center, double fwd_min, double fwd_max) {
-    if (value < 0) {
-        return fmin(1, -value) * (rev_max - rev_min) + rev_min;
-    } else if (value > 0) {
-        return fmin(1, -value) * (rev_max - rev_min) + rev_min;
-    } else if (isnan(value)) {
-        return NAN;
-    } else {
-        return center;
-    }
+    return pwm_map_inline(value, rev_max, rev_min, center, fwd_min, fwd_max);
 }
 
 double ramping_update(double previous, double target, double max_change_per_update) {
-    if (previous < target) {
-        return fmin(target, previous + max_change_per_update);
-    } else {
-        return fmax(target, previous - max_change_per_update);
-    }
+    return ramping_update_inline(previous, target, max_change_per_update);
+}
+
+bool float_changed(double previous, double value, double epsilon) {
+    return float_changed_inline(previous, value, epsilon);
 }
@@ -1,6 +1,7 @@
 #ifndef THEMIS_H
 #define THEMIS_H
 
+#include <math.h>
 #include <stdbool.h>
 #include <stdint.h>
 
@@ -11,14 +12,54 @@ extern "C" {
 typedef void (*callback)(void);
 
 // runloop.c
+struct runloop_stats {
+    uint32_t capacity;
+    uint32_t high_water; // deepest the queue has been
+    uint32_t dropped; // event source events discarded because the queue was full
+    uint64_t queued;
+    uint64_t dispatched;
+    uint64_t wakeups; // times the loop had to sleep and be woken
+};
+// a producer of events that should only ever be pending once: if it fires again before its callback has been
+// dispatched, the new event is collapsed into the pending one.
+struct event_source {
+    callback cb;
+    const char *name;
+    int pending;
+    uint32_t queued;
+    uint32_t coalesced;
+    struct event_source *next_source;
+};
+// overflow policy for the fixed-size queue: an event source that finds the queue full drops its event and counts it in
+// dropped, and fires again normally the next time its timer, interrupt or packet comes around. a plain queue_event has
+// nothing that would ever queue it again (one-shot timers, interrupt handoffs, exiting), so it panics instead.
 void enter_loop(callback entry);
 void queue_event(callback cb);
+void event_source_init(struct event_source *source, const char *name, callback cb);
+bool queue_source(struct event_source *source);
+void runloop_get_stats(struct runloop_stats *stats);
+void runloop_report_sources(void);
+void runloop_after_dispatch(callback cb);
+#ifdef THEMIS_RUNLOOP_EPOLL
+void runloop_watch_fd(int fd, void (*ready)(void *context), void *context);
+#endif
 
 // timers.c
 void start_timer_ns(uint32_t period_ns, callback cb);
 void begin_timers();
 void run_after_ns(uint32_t delay_ns, callback cb);
 
+// profile.c
+struct profile_entry {
+    const char *name;
+    uint32_t uid;
+    uint64_t calls;
+    uint64_t total_ns; // inclusive of any instants this one calls
+};
+void profile_start_dump(struct profile_entry *table, uint32_t count);
+uint64_t profile_begin(void);
+void profile_end(struct profile_entry *entry, uint64_t start_ns);
+
 // themis.c
 void panic(const char *err) __attribute__ ((__noreturn__));
 void do_nothing(void);
@@ -26,6 +67,69 @@ double deadzone(double value, double zone);
 double choose_float(bool cond, double a, double b);
 double pwm_map(double value, double rev_max, double rev_min, double center, double fwd_min, double fwd_max);
 double ramping_update(double previous, double target, double max_change_per_update);
+bool float_changed(double previous, double value, double epsilon);
+// the same pure helpers, for generated code to call: defined here so that gcc can inline them and fold in constant
+// arguments, instead of calling into the shared library. themis.c's versions just call these.
+static inline double deadzone_inline(double value, double zone) {
+    return fabs(value) >= zone ? value : 0.0;
+}
+static inline double choose_float_inline(bool cond, double a, double b) {
+    return cond ? a : b;
+}
+static inline double pwm_map_inline(double value, double rev_max, double rev_min, double center, double fwd_min,
+                                    double fwd_max) {
+    if (value < 0) {
+        return fmin(1, -value) * (rev_max - rev_min) + rev_min;
+    } else if (value > 0) {
+        return fmin(1, value) * (fwd_max - fwd_min) + fwd_min;
+    } else if (isnan(value)) {
+        return NAN;
+    } else {
+        return center;
+    }
+}
+static inline double ramping_update_inline(double previous, double target, double max_change_per_update) {
+    if (previous < target) {
+        return fmin(target, previous + max_change_per_update);
+    } else {
+        return fmax(target, previous - max_change_per_update);
+    }
+}
+static inline bool float_changed_inline(double previous, double value, double epsilon) {
+    if (isnan(previous) || isnan(value)) {
+        return isnan(previous) != isnan(value);
+    }
+    return fabs(value - previous) > epsilon;
+}
+
+// ds.c
+#define DS_JOYSTICK_NUM 6
+#define DS_AXIS_NUM 12
+// everything that generated code reads from one driver station packet, converted once when the packet arrives
+struct ds_snapshot {
+    uint64_t sequence; // counts every packet published, starting from 1; 0 until the first packet
+    uint64_t received_ns; // CLOCK_MONOTONIC when the packet arrived
+    int robot_mode;
+    double axes[DS_JOYSTICK_NUM][DS_AXIS_NUM]; // scaled to -1.0 to 1.0, and 0.0 past the joystick's axis count
+    uint32_t buttons[DS_JOYSTICK_NUM]; // bit n is button n; always clear past the joystick's button count
+};
+// the packet being dispatched; never NULL. only changes in ds_acquire, so it's only valid on the loop thread.
+extern const struct ds_snapshot *ds_current;
+// driver station thread: fill in every field of the returned packet except the sequence, then publish it
+struct ds_snapshot *ds_publish_begin(void);
+void ds_publish(void);
+// loop thread: switch ds_current to the latest published packet; false if there's been none since the last call
+bool ds_acquire(void);
+// direct field reads for generated code, in place of the range-checked get_* calls in frc.c
+static inline int ds_mode(void) {
+    return ds_current->robot_mode;
+}
+static inline double ds_axis(int joy_i, int axis) {
+    return ds_current->axes[joy_i][axis];
+}
+static inline bool ds_button(int joy_i, int btn) {
+    return (ds_current->buttons[joy_i] >> btn) & 1;
+}
 
 // frc.c
 void ds_init(void);
@@ -34,7 +138,18 @@ int get_robot_mode();
 double get_joystick_axis(int joy_i, int axis);
 bool get_joystick_button(int joy_i, int btn);
 void pwm_init(uint8_t pwm_id, uint8_t squelch, bool latch_pwm_zero);
+struct pwm_stats {
+    uint64_t writes; // values actually sent to the hardware
+    uint64_t skipped; // updates that didn't need a write: unchanged, or replaced by a later stage before the flush
+};
+// writes immediately, unless the channel already has this value
 void pwm_update(double millis, int pwm_id);
+// like pwm_update, but only remembered until pwm_flush, which runs automatically at the end of each dispatch
+void pwm_stage(double millis, int pwm_id);
+// like pwm_stage, but the flush writes the value even if the channel already has it, for periodic refreshes
+void pwm_refresh(double millis, int pwm_id);
+void pwm_flush(void);
+void pwm_get_stats(struct pwm_stats *stats);
 void solenoid_init(uint8_t pcm_id, uint8_t solenoid_id);
 void solenoid_update(bool on, uint8_t pcm_id, uint8_t solenoid_id);
 void gpio_init_input_poll(int gpio_pin);
@@ -8,12 +8,20 @@
 #include <assert.h>
 #include <errno.h>
 #include "themis.h"
+#ifdef THEMIS_RUNLOOP_EPOLL
+#include <unistd.h>
+#include <sys/timerfd.h>
+#endif
+
+// by default, timers run on their own thread and hand off to the runloop with queue_event. with
+// THEMIS_RUNLOOP_EPOLL, they are timerfds that the runloop waits on directly instead, so no thread is needed.
 
 #define PTHREAD_CHECK(call, ...) if (call(__VA_ARGS__) != 0) { perror(#call); panic("timer subsystem critical failure"); }
 
 static uint64_t get_time_nanos() {
     struct timespec t;
-    if (clock_gettime(CLOCK_MONOTONIC_RAW, &t) != 0) {
+    // must match the clock that next_shot_cond and the timerfds wait against
+    if (clock_gettime(CLOCK_MONOTONIC, &t) != 0) {
         perror("clock_gettime");
         panic("critical failure in timer subsystem");
     }
@@ -24,33 +32,185 @@ struct periodic_timer {
     uint32_t period_ns;
     uint64_t next_tick_ns;
     callback cb;
+    struct event_source source;
+    char name[32];
+    int fd; // only used with THEMIS_RUNLOOP_EPOLL
 };
 
+// one-shot timers live in a binary min-heap over a fixed array, so scheduling neither allocates nor walks a list.
+#ifndef ONE_SHOT_TIMER_CAPACITY
+#define ONE_SHOT_TIMER_CAPACITY 4096
+#endif
+
 struct one_shot_timer {
     uint64_t happen_at_ns;
+    uint32_t sequence; // timers due at the same time fire in the order they were scheduled
     callback cb;
-    struct one_shot_timer *next;
 };
 
-static void *timer_body(void *);
-
-static pthread_t timer_thread;
 static bool timer_init_complete = false;
-static bool timer_loop_run = true; // TODO: eliminate or use
 
 static struct periodic_timer *periodic_timers = NULL;
 static int periodic_timer_count = 0;
 static int periodic_timer_capacity = 0;
-// TODO: use a datastructure that doesn't require O(n) time for insertion
 static pthread_mutex_t next_shot_mutex = PTHREAD_MUTEX_INITIALIZER;
-static pthread_cond_t next_shot_cond = PTHREAD_COND_INITIALIZER;
-static struct one_shot_timer *next_one_shot_timer = NULL;
+static struct one_shot_timer one_shot_heap[ONE_SHOT_TIMER_CAPACITY];
+static int one_shot_count = 0;
+static uint32_t one_shot_sequence = 0;
 
-void begin_timers() {
+#define RUN_ORDER_LT(a, b) ((a).happen_at_ns < (b).happen_at_ns \
+                            || ((a).happen_at_ns == (b).happen_at_ns && (int32_t) ((a).sequence - (b).sequence) < 0))
+
+// the heap functions must be called with next_shot_mutex held
+static void one_shot_push(struct one_shot_timer timer) {
+    if (one_shot_count >= ONE_SHOT_TIMER_CAPACITY) {
+        panic("too many pending one-shot timers");
+    }
+    int i = one_shot_count++;
+    while (i > 0 && RUN_ORDER_LT(timer, one_shot_heap[(i - 1) / 2])) {
+        one_shot_heap[i] = one_shot_heap[(i - 1) / 2];
+        i = (i - 1) / 2;
+    }
+    one_shot_heap[i] = timer;
+}
+
+static struct one_shot_timer one_shot_pop(void) {
+    assert(one_shot_count > 0);
+    struct one_shot_timer top = one_shot_heap[0];
+    struct one_shot_timer last = one_shot_heap[--one_shot_count];
+    int i = 0;
+    while (true) {
+        int child = 2 * i + 1;
+        if (child >= one_shot_count) {
+            break;
+        }
+        if (child + 1 < one_shot_count && RUN_ORDER_LT(one_shot_heap[child + 1], one_shot_heap[child])) {
+            child++;
+        }
+        if (!RUN_ORDER_LT(one_shot_heap[child], last)) {
+            break;
+        }
+        one_shot_heap[i] = one_shot_heap[child];
+        i = child;
+    }
+    one_shot_heap[i] = last;
+    return top;
+}
+
+#ifdef THEMIS_RUNLOOP_EPOLL
+static int one_shot_fd = -1;
+
+static int timerfd_open(void) {
+    int fd = timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC);
+    if (fd < 0) {
+        perror("timerfd_create");
+        panic("timer subsystem critical failure");
+    }
+    return fd;
+}
+
+// the deadline is absolute, so ticks never drift by however long it took us to get around to rearming them.
+// a deadline of zero disarms the timer.
+static void timerfd_arm(int fd, uint64_t deadline_ns, uint32_t interval_ns) {
+    struct itimerspec spec;
+    spec.it_value.tv_sec = deadline_ns / 1000000000;
+    spec.it_value.tv_nsec = deadline_ns % 1000000000;
+    spec.it_interval.tv_sec = interval_ns / 1000000000;
+    spec.it_interval.tv_nsec = interval_ns % 1000000000;
+    if (timerfd_settime(fd, TFD_TIMER_ABSTIME, &spec, NULL) != 0) {
+        perror("timerfd_settime");
+        panic("timer subsystem critical failure");
+    }
+}
+
+static uint64_t timerfd_expirations(int fd) {
+    uint64_t count;
+    if (read(fd, &count, sizeof(count)) != sizeof(count)) {
+        if (errno == EAGAIN) {
+            return 0; // rearmed since epoll noticed it
+        }
+        perror("read");
+        panic("timer subsystem critical failure");
+    }
+    return count;
+}
+
+static void periodic_ready(void *context) {
+    struct periodic_timer *timer = (struct periodic_timer *) context;
+    uint64_t expirations = timerfd_expirations(timer->fd);
+    if (expirations > 0) {
+        queue_source(&timer->source);
+        if (expirations > 1) {
+            // we stalled for more than a whole period: the missed ticks are skipped rather than replayed
+            __atomic_fetch_add(&timer->source.coalesced, (uint32_t) (expirations - 1), __ATOMIC_RELAXED);
+        }
+    }
+}
+
+// must be called with next_shot_mutex held
+static void one_shot_rearm(void) {
+    timerfd_arm(one_shot_fd, one_shot_count > 0 ? one_shot_heap[0].happen_at_ns : 0, 0);
+}
+
+static void one_shot_ready(void *context) {
+    timerfd_expirations(one_shot_fd);
+    uint64_t now = get_time_nanos();
+    PTHREAD_CHECK(pthread_mutex_lock, &next_shot_mutex);
+    while (one_shot_count > 0 && (int64_t) (one_shot_heap[0].happen_at_ns - now) <= 0) {
+        callback cb = one_shot_pop().cb;
+        PTHREAD_CHECK(pthread_mutex_unlock, &next_shot_mutex);
+        queue_event(cb);
+        PTHREAD_CHECK(pthread_mutex_lock, &next_shot_mutex);
+    }
+    one_shot_rearm();
+    PTHREAD_CHECK(pthread_mutex_unlock, &next_shot_mutex);
+}
+
+static void start_timer_fds(void) {
+    uint64_t base_time = get_time_nanos();
+    for (int i = 0; i < periodic_timer_count; i++) {
+        periodic_timers[i].fd = timerfd_open();
+        timerfd_arm(periodic_timers[i].fd, base_time + periodic_timers[i].period_ns, periodic_timers[i].period_ns);
+        runloop_watch_fd(periodic_timers[i].fd, periodic_ready, &periodic_timers[i]);
+    }
+    one_shot_fd = timerfd_open();
+    runloop_watch_fd(one_shot_fd, one_shot_ready, NULL);
+    PTHREAD_CHECK(pthread_mutex_lock, &next_shot_mutex);
+    one_shot_rearm(); // for anything scheduled before begin_timers
+    PTHREAD_CHECK(pthread_mutex_unlock, &next_shot_mutex);
+}
+#else
+static void *timer_body(void *);
+
+static pthread_t timer_thread;
+static bool timer_loop_run = true; // TODO: eliminate or use
+static pthread_cond_t next_shot_cond;
+
+static void start_timer_thread(void) {
+    pthread_condattr_t attr;
+    PTHREAD_CHECK(pthread_condattr_init, &attr);
+    PTHREAD_CHECK(pthread_condattr_setclock, &attr, CLOCK_MONOTONIC);
+    PTHREAD_CHECK(pthread_cond_init, &next_shot_cond, &attr);
+    PTHREAD_CHECK(pthread_condattr_destroy, &attr);
     if (pthread_create(&timer_thread, NULL, timer_body, NULL) != 0) {
         perror("pthread_create");
         panic("critical failure in timer subsystem");
     }
+}
+#endif
+
+void begin_timers() {
+    // registered here rather than in start_timer_ns, because the array may move until all timers are added
+    for (int i = 0; i < periodic_timer_count; i++) {
+        snprintf(periodic_timers[i].name, sizeof(periodic_timers[i].name), "periodic timer %u ns",
+                 (unsigned int) periodic_timers[i].period_ns);
+        event_source_init(&periodic_timers[i].source, periodic_timers[i].name, periodic_timers[i].cb);
+    }
+#ifdef THEMIS_RUNLOOP_EPOLL
+    start_timer_fds();
+#else
+    start_timer_thread();
+#endif
     timer_init_complete = true;
 }
 
@@ -61,38 +221,28 @@ void start_timer_ns(uint32_t period_ns, callback cb) {
         periodic_timer_capacity = periodic_timer_capacity ? periodic_timer_capacity * 2 : 8;
         periodic_timers = realloc(periodic_timers, periodic_timer_capacity * sizeof(struct periodic_timer));
     }
-    periodic_timers[periodic_timer_count++].period_ns = period_ns;
+    periodic_timers[periodic_timer_count].period_ns = period_ns;
+    periodic_timers[periodic_timer_count++].cb = cb;
 }
 
 void run_after_ns(uint32_t delay_ns, callback cb) {
-    uint64_t now = get_time_nanos();
-    struct one_shot_timer *timer = malloc(sizeof(struct one_shot_timer));
-    if (timer == NULL) {
-        perror("malloc");
-        panic("timer subsystem critical failure");
-    }
-    timer->cb = cb;
-    timer->happen_at_ns = now + delay_ns;
+    struct one_shot_timer timer;
+    timer.cb = cb;
+    timer.happen_at_ns = get_time_nanos() + delay_ns;
     PTHREAD_CHECK(pthread_mutex_lock, &next_shot_mutex);
-#define RUN_ORDER_LT(a, b) ((int64_t) (a->happen_at_ns - now) < (int64_t) (b->happen_at_ns - now))
-    // we need to insert this in the correct sorted order (note that the sort order is based on the current time)
-    if (next_one_shot_timer == NULL || RUN_ORDER_LT(timer, next_one_shot_timer)) {
-        timer->next = next_one_shot_timer;
-        next_one_shot_timer = timer;
-    } else {
-        // search to find the correct timer for us to go after
-        struct one_shot_timer *cur = next_one_shot_timer;
-        while (cur->next != NULL && RUN_ORDER_LT(cur->next, timer)) {
-            cur = cur->next;
-        }
-        timer->next = cur->next;
-        cur->next = timer;
+    timer.sequence = one_shot_sequence++;
+    one_shot_push(timer);
+#ifdef THEMIS_RUNLOOP_EPOLL
+    if (one_shot_fd >= 0 && one_shot_heap[0].sequence == timer.sequence) {
+        one_shot_rearm(); // we're the new earliest deadline
     }
-#undef RUN_ORDER_LT
+#else
     pthread_cond_signal(&next_shot_cond);
+#endif
     PTHREAD_CHECK(pthread_mutex_unlock, &next_shot_mutex);
 }
 
+#ifndef THEMIS_RUNLOOP_EPOLL
 static void *timer_body(void *unused_param) {
     uint64_t base_time = get_time_nanos();
     for (int i = 0; i < periodic_timer_count; i++) {
@@ -105,10 +255,17 @@ static void *timer_body(void *unused_param) {
         for (int i = 0; i < periodic_timer_count; i++) {
             int64_t remaining = (int64_t) (periodic_timers[i].next_tick_ns - now);
             if (remaining <= 0) {
-                // TODO: make sure we don't enqueue this too many times
-                queue_event(periodic_timers[i].cb);
+                // if the loop is still behind on the last tick, this is collapsed into it instead of piling up
+                queue_source(&periodic_timers[i].source);
                 periodic_timers[i].next_tick_ns += periodic_timers[i].period_ns;
                 remaining = (int64_t) (periodic_timers[i].next_tick_ns - now);
+                if (remaining <= 0) {
+                    // we stalled for more than a whole period: skip the missed ticks rather than replaying them
+                    uint32_t missed = (uint32_t) (-remaining / periodic_timers[i].period_ns) + 1;
+                    periodic_timers[i].next_tick_ns += (uint64_t) missed * periodic_timers[i].period_ns;
+                    remaining = (int64_t) (periodic_timers[i].next_tick_ns - now);
+                    __atomic_fetch_add(&periodic_timers[i].source.coalesced, missed, __ATOMIC_RELAXED);
+                }
             }
             if (remaining < shortest_remaining) {
                 shortest_remaining = remaining;
@@ -116,39 +273,37 @@ static void *timer_body(void *unused_param) {
         }
         // process any ready one-off timers
         PTHREAD_CHECK(pthread_mutex_lock, &next_shot_mutex);
-        while (next_one_shot_timer != NULL && (int64_t) (next_one_shot_timer->happen_at_ns - now) <= 0) {
-            struct one_shot_timer *t = next_one_shot_timer;
-            next_one_shot_timer = t->next;
+        while (one_shot_count > 0 && (int64_t) (one_shot_heap[0].happen_at_ns - now) <= 0) {
+            callback cb = one_shot_pop().cb;
             PTHREAD_CHECK(pthread_mutex_unlock, &next_shot_mutex);
             // make sure we release the lock before queueing
-            queue_event(t->cb);
-            free(t);
-            // note that the next timer list could have changed during this time, so we'll need to go back to the global
+            queue_event(cb);
+            // note that the heap could have changed during this time, so we'll need to go back to the global
             PTHREAD_CHECK(pthread_mutex_lock, &next_shot_mutex);
         }
-        if (next_one_shot_timer != NULL) {
-            int64_t remaining = (int64_t) (next_one_shot_timer->happen_at_ns - now);
+        if (one_shot_count > 0) {
+            int64_t remaining = (int64_t) (one_shot_heap[0].happen_at_ns - now);
             if (remaining < shortest_remaining) {
                 shortest_remaining = remaining;
             }
         }
         // sleep until the next timer is ready to be processed
         if (shortest_remaining > 0) {
-            // the locks and unlocks and enqueueings could have invalidated this offset, so make sure we don't sleep a bunch more than necessary
-            uint64_t new_now = get_time_nanos();
-            int64_t new_remaining = shortest_remaining + (int64_t) (new_now - now);
-            if (new_remaining > 0) {
-                struct timespec t;
-                t.tv_sec = new_remaining / 1000000000;
-                t.tv_nsec = new_remaining % 1000000000;
-                if (pthread_cond_timedwait(&next_shot_cond, &next_shot_mutex, &t) != 0 && errno != ETIMEDOUT) {
-                    perror("pthread_cond_timedwait");
-                    panic("timer subsystem critical failure");
-                }
-                // at this point, we either have new timers added or have a timer that should be enqueued now
+            // the deadline is absolute, so the locks and unlocks and enqueueings since 'now' don't extend our sleep
+            uint64_t deadline = now + shortest_remaining;
+            struct timespec t;
+            t.tv_sec = deadline / 1000000000;
+            t.tv_nsec = deadline % 1000000000;
+            int err = pthread_cond_timedwait(&next_shot_cond, &next_shot_mutex, &t);
+            if (err != 0 && err != ETIMEDOUT) {
+                errno = err;
+                perror("pthread_cond_timedwait");
+                panic("timer subsystem critical failure");
             }
+            // at this point, we either have new timers added or have a timer that should be enqueued now
         }
         PTHREAD_CHECK(pthread_mutex_unlock, &next_shot_mutex);
     }
     return NULL;
 }
+#endif
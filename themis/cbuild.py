@@ -1,34 +1,289 @@
+import concurrent.futures
+import functools
+import hashlib
 import os
-import shutil
 import subprocess
 import tempfile
+import typing
 import pkg_resources
 
+import themis.cgen
 
-def build_program(main_file_data, library_header, shared_library, gcc_prefix, cflags, package=__name__):
-    with tempfile.TemporaryDirectory() as tempdir:
-        shead_name = os.path.basename(library_header)
-        shlib_name = os.path.basename(shared_library)
-        assert shlib_name.startswith("lib") and shlib_name.endswith(".so") and shead_name.endswith(".h")
-        shlib_short = shlib_name[3:-3]  # strip "lib" and ".so"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "themis")
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+# named optimization settings, added to a target's base flags. LTO only helps where the runtime is compiled into the
+# program along with the generated code, as in host builds, since it can then inline across the two.
+BUILD_PROFILES = {
+    "size": "-Os",
+    "speed": "-O2",
+    "speed+lto": "-O2 -flto",
+}
+
+
+def profile_flags(cflags: str, build_profile: str) -> str:
+    assert build_profile in BUILD_PROFILES, "unknown build profile: %s" % build_profile
+    return cflags + " " + BUILD_PROFILES[build_profile]
+
+
+# cached linked programs and cached compiled objects are told apart by suffix, and counted separately
+PROGRAM_SUFFIX = ".elf"
+OBJECT_SUFFIX = ".o"
+
+
+class BuildCache:
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_BYTES):
+        assert max_bytes > 0
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.object_hits = 0
+        self.object_misses = 0
+        self.object_evictions = 0
+
+    def _count(self, suffix: str, event: str) -> None:
+        name = event if suffix == PROGRAM_SUFFIX else "object_" + event
+        setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def key(*parts: bytes) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            # length-prefix each part so that different splits of the same bytes can't collide
+            digest.update(b"%d:" % len(part))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key: str, suffix: str) -> str:
+        assert suffix in (PROGRAM_SUFFIX, OBJECT_SUFFIX)
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key: str, suffix: str = PROGRAM_SUFFIX) -> typing.Optional[bytes]:
+        path = self._path(key, suffix)
+        try:
+            with open(path, "rb") as fin:
+                data = fin.read()
+        except FileNotFoundError:
+            self._count(suffix, "misses")
+            return None
+        os.utime(path)  # mark as recently used
+        self._count(suffix, "hits")
+        return data
+
+    def put(self, key: str, data: bytes, suffix: str = PROGRAM_SUFFIX) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+        os.replace(temp_path, self._path(key, suffix))  # atomic, so concurrent builds never see partial entries
+        self.evict()
+
+    def evict(self) -> None:
+        # programs and objects share one budget, least recently used first
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith((PROGRAM_SUFFIX, OBJECT_SUFFIX)):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._count(os.path.splitext(name)[1], "evictions")
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "object_hits": self.object_hits, "object_misses": self.object_misses,
+                "object_evictions": self.object_evictions}
+
+
+@functools.lru_cache(maxsize=None)
+def default_cache() -> BuildCache:
+    return BuildCache(os.environ.get("THEMIS_CACHE_DIR", DEFAULT_CACHE_DIR))
+
+
+@functools.lru_cache(maxsize=None)
+def _compiler_identity(gcc_prefix: str) -> bytes:
+    try:
+        version = subprocess.check_output([gcc_prefix + "gcc", "--version"])
+    except (OSError, subprocess.CalledProcessError):
+        version = b""  # the actual build will report the problem
+    return gcc_prefix.encode() + b"\0" + version
+
+
+def _read_symbol_sizes(nm: str, binary_path: str, symbol_sizes: dict) -> None:
+    # bytes of code in each function, from the symbol table of an unstripped build
+    output = subprocess.check_output([nm, "--size-sort", "--print-size", "--defined-only", binary_path],
+                                     universal_newlines=True)
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[2] in ("t", "T"):
+            symbol_sizes[fields[3]] = int(fields[1], 16)
+
+
+def _program_files(main_file_data: typing.Union[str, typing.Dict[str, str]]) -> typing.Dict[str, bytes]:
+    # a program is either a single C file, or the C files and shared header produced by generate_units
+    if isinstance(main_file_data, str):
+        main_file_data = {themis.cgen.MAIN_FILE: main_file_data}
+    return {name: data.encode() for name, data in sorted(main_file_data.items())}
 
+
+def _write_program_files(tempdir: str, program_files: typing.Dict[str, bytes], lib_header_data: bytes) \
+        -> typing.Dict[str, typing.List[bytes]]:
+    # returns the C files to compile, each with everything that its object depends on
+    headers = [lib_header_data]
+    for name, data in program_files.items():
+        with open(os.path.join(tempdir, name), "wb") as fout:
+            fout.write(data)
+        if name.endswith(".h"):
+            headers.append(data)
+    return {os.path.join(tempdir, name): [name.encode(), data, *headers]
+            for name, data in program_files.items() if name.endswith(".c")}
+
+
+def build_program(main_file_data, library_header, shared_library, gcc_prefix, cflags, package=__name__,
+                  cache: typing.Optional[BuildCache] = None, symbol_sizes: typing.Optional[dict] = None):
+    # main_file_data is either a single C file, or the files produced by generate_units. if symbol_sizes is provided, it
+    # is filled in with the size of every function in the program, as measured before the program is stripped
+    program_files = _program_files(main_file_data)
+    shead_name = os.path.basename(library_header)
+    shlib_name = os.path.basename(shared_library)
+    assert shlib_name.startswith("lib") and shlib_name.endswith(".so") and shead_name.endswith(".h")
+    shlib_short = shlib_name[3:-3]  # strip "lib" and ".so"
+
+    lib_header_data = pkg_resources.resource_string(package, library_header)
+    shared_lib_data = pkg_resources.resource_string(package, shared_library)
+
+    if cache is not None:
+        key = cache.key(*(part for name, data in program_files.items() for part in (name.encode(), data)),
+                        _compiler_identity(gcc_prefix), cflags.encode(), lib_header_data, shared_lib_data)
+        # the cache only has stripped programs, so symbol sizes always need a fresh build
+        cached = cache.get(key) if symbol_sizes is None else None
+        if cached is not None:
+            return cached
+
+    with tempfile.TemporaryDirectory() as tempdir:
         shared_lib_path = os.path.join(tempdir, shlib_name)
         lib_header_path = os.path.join(tempdir, shead_name)
-        main_file_path = os.path.join(tempdir, "themis_main.c")
         main_output_path = os.path.join(tempdir, "themis_main")
 
         with open(shared_lib_path, "wb") as fout:
-            with pkg_resources.resource_stream(package, shared_library) as fin:
-                shutil.copyfileobj(fin, fout)
+            fout.write(shared_lib_data)
         with open(lib_header_path, "wb") as fout:
-            with pkg_resources.resource_stream(package, library_header) as fin:
-                shutil.copyfileobj(fin, fout)
-        with open(main_file_path, "w") as fout:
-            fout.write(main_file_data)
+            fout.write(lib_header_data)
+        sources = _write_program_files(tempdir, program_files, lib_header_data)
 
-        subprocess.check_call([gcc_prefix + "gcc", *cflags.split(), "-I", tempdir, "-L", tempdir, "-l", shlib_short,
-                               main_file_path, "-o", main_output_path])
+        _compile_and_link(gcc_prefix, cflags.split(), tempdir, sources, ["-L", tempdir, "-l", shlib_short],
+                          main_output_path, cache)
+        if symbol_sizes is not None:
+            _read_symbol_sizes(gcc_prefix + "nm", main_output_path, symbol_sizes)
         subprocess.check_call([gcc_prefix + "strip", main_output_path])
         with open(main_output_path, "rb") as fin:
             main_output_data = fin.read()
+
+    if cache is not None:
+        cache.put(key, main_output_data)
+    return main_output_data
+
+
+def _compile_and_link(gcc_prefix: str, cflags: typing.List[str], include_dir: str,
+                      sources: typing.Dict[str, typing.List[bytes]], ldflags: typing.List[str], output_path: str,
+                      cache: typing.Optional[BuildCache] = None) -> None:
+    # sources maps each source path to everything its object depends on. there is one object per source, so that
+    # profile data is recorded and looked up under the same name on every build, and so that objects can be cached
+    # separately: editing one part of a program only recompiles the files that changed.
+    gcc = gcc_prefix + "gcc"
+    objects, missing = [], []
+    for source_path, inputs in sources.items():
+        objects.append(source_path[:-2] + ".o")
+        key = None
+        if cache is not None:
+            key = cache.key(b"object", _compiler_identity(gcc_prefix), " ".join(cflags).encode(), *inputs)
+            data = cache.get(key, OBJECT_SUFFIX)
+            if data is not None:
+                with open(objects[-1], "wb") as fout:
+                    fout.write(data)
+                continue
+        missing.append((source_path, objects[-1], key))
+
+    # the work happens in the gcc processes, so a thread pool is enough to run them all in parallel: a process pool
+    # would only add a Python interpreter per compile, each of which would just wait on its gcc
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        for future in [pool.submit(subprocess.check_call, [gcc, *cflags, "-I", include_dir, "-c", source_path,
+                                                           "-o", object_path])
+                       for source_path, object_path, _ in missing]:
+            future.result()
+    for _, object_path, key in missing:
+        if key is not None:
+            with open(object_path, "rb") as fin:
+                cache.put(key, fin.read(), OBJECT_SUFFIX)
+
+    # the flags are passed again when linking, which is where LTO does its work
+    subprocess.check_call([gcc, *cflags, *objects, *ldflags, "-o", output_path])
+
+
+def build_host_program(main_file_data, library_header, runtime_sources, gcc_prefix, cflags, libs=(),
+                       package=__name__, cache: typing.Optional[BuildCache] = None,
+                       pgo_workload: typing.Optional[typing.Callable[[str], None]] = None,
+                       symbol_sizes: typing.Optional[dict] = None):
+    # if pgo_workload is provided, an instrumented build is made first, and pgo_workload is called with its path to run
+    # it on a representative workload. the final build is then optimized using the profile that run recorded. if
+    # symbol_sizes is provided, it is filled in with the size of every function in the program.
+    assert library_header.endswith(".h") and all(source.endswith(".c") for source in runtime_sources)
+    program_files = _program_files(main_file_data)
+    lib_header_data = pkg_resources.resource_string(package, library_header)
+    sources_data = [pkg_resources.resource_string(package, source) for source in runtime_sources]
+    ldflags = ["-l" + lib for lib in libs]
+
+    if pgo_workload is not None:
+        cache = None  # the result depends on what the workload does, which we can't hash
+    if cache is not None:
+        key = cache.key(*(part for name, data in program_files.items() for part in (name.encode(), data)),
+                        _compiler_identity(gcc_prefix), cflags.encode(), " ".join(ldflags).encode(), lib_header_data,
+                        *sources_data)
+        cached = cache.get(key) if symbol_sizes is None else None  # symbol sizes need the build's files
+        if cached is not None:
+            return cached
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, os.path.basename(library_header)), "wb") as fout:
+            fout.write(lib_header_data)
+        # the runtime is compiled along with the program, so there is no shared library to distribute
+        sources = _write_program_files(tempdir, program_files, lib_header_data)
+        for source, data in zip(runtime_sources, sources_data):
+            source_path = os.path.join(tempdir, os.path.basename(source))
+            with open(source_path, "wb") as fout:
+                fout.write(data)
+            sources[source_path] = [os.path.basename(source).encode(), data, lib_header_data]
+        main_output_path = os.path.join(tempdir, "themis_main")
+
+        if pgo_workload is None:
+            _compile_and_link(gcc_prefix, cflags.split(), tempdir, sources, ldflags, main_output_path, cache)
+        else:
+            profile_dir = os.path.join(tempdir, "pgo")
+            _compile_and_link(gcc_prefix, cflags.split() + ["-fprofile-generate=" + profile_dir], tempdir,
+                              sources, ldflags, main_output_path)
+            pgo_workload(main_output_path)
+            # functions that the workload never reached have no profile, and are just optimized as usual
+            _compile_and_link(gcc_prefix, cflags.split() + ["-fprofile-use=" + profile_dir,
+                                                            "-fprofile-correction", "-Wno-missing-profile"],
+                              tempdir, sources, ldflags, main_output_path)
+        if symbol_sizes is not None:
+            _read_symbol_sizes(gcc_prefix + "nm", main_output_path, symbol_sizes)
+        with open(main_output_path, "rb") as fin:
+            main_output_data = fin.read()
+
+    if cache is not None:
+        cache.put(key, main_output_data)
     return main_output_data
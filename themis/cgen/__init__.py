@@ -1,8 +1,13 @@
+import collections
+import os
+import sys
 import typing
 
 import themis.cgen.counter
+import themis.cgen.ir
 import themis.cgen.optimizer
 import themis.cgen.templates
+import themis.util
 
 PARAM_TYPES = {None: "None", bool: "bool", int: "int", float: "double"}
 
@@ -10,42 +15,87 @@ uid = counter.Counter()
 
 Param = object()
 
+PROFILE_TABLE = "themis_profile"
+MAIN_FILE = "themis_main.c"
+PROGRAM_HEADER = "themis_program.h"
+
+# whether Instants and Boxes remember the robot code line that created them. off unless a debugging feature needs it
+# (see track_sources), since it walks the stack for every one.
+_track_sources = themis.util.Parameter(os.environ.get("THEMIS_TRACK_SOURCES", "0") == "1")
+_THEMIS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+_internal_files = {}
+
 __all__ = ["Box", "Instant", "generate_code", "Param"]
 
+encode_value = templates.encode_value
+
+
+def track_sources(enabled: bool = True) -> themis.util.Parameterization:
+    # while entered, Instants and Boxes created on this thread record their creation site. can't turn off tracking
+    # that's already on.
+    return _track_sources.parameterize(enabled or _track_sources.get())
+
+
+def _source_location() -> typing.Optional[typing.Tuple[str, int]]:
+    # the first frame outside of the themis package; files are only classified once, so this stays cheap
+    if not _track_sources.get():
+        return None
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        internal = _internal_files.get(filename)
+        if internal is None:
+            internal = _internal_files[filename] = os.path.abspath(filename).startswith(_THEMIS_DIR)
+        if not internal:
+            return filename, frame.f_lineno
+        frame = frame.f_back
+    return None
+
 
-def encode_value(x):
-    if type(x) == bool:
-        return "true" if x else "false"
-    elif type(x) == int:
-        return str(x)
-    elif type(x) == float:
-        return str(x)
-    else:
-        assert False
+def _count(counts: collections.Counter, key, delta: int) -> None:
+    counts[key] += delta
+    if not counts[key]:
+        del counts[key]
 
 
 class Box:
+    __slots__ = ("_value", "_box_type", "_uid", "_box", "_users", "_definers", "_source")
+
     def __init__(self, initial_value):
         self._value = initial_value
         self._box_type = type(initial_value)
         assert self._box_type is not None and self._box_type in PARAM_TYPES, \
             "Invalid initial value type: %s" % type(initial_value)
-        self._box = uid.nstr("box%d")
+        self._uid = uid.next()
+        self._box = "box%d" % self._uid
+        # use-def index, maintained by Instant as bodies change: instant -> number of references
+        self._users = collections.Counter()
+        self._definers = collections.Counter()
+        self._source = _source_location()
 
-    def _generate(self) -> str:
-        return "static %s %s = %s;" % (PARAM_TYPES[self._box_type], self._box, encode_value(self._value))
+    def _generate(self, static: bool = True) -> str:
+        return "%s%s %s = %s;" % ("static " if static else "", PARAM_TYPES[self._box_type], self._box,
+                                  encode_value(self._value))
+
+    def _generate_extern(self) -> str:
+        return "extern %s %s;" % (PARAM_TYPES[self._box_type], self._box)
 
 
 class Instant:
+    __slots__ = ("_param_type", "_param", "_uid", "_instant", "_body", "_uses", "_users", "_defs", "_source")
+
     def __init__(self, param_type):
         assert param_type in PARAM_TYPES
         self._param_type = param_type
-        if param_type is not None:
-            self._param = uid.nstr("param%d")
+        self._param = uid.nstr("param%d") if param_type is not None else None
         self._uid = uid.next()
         self._instant = "instant%d" % self._uid
         self._body = []
-        self._referenced_instants = set()
+        # use-def index: instants and boxes referenced by our body, instants referencing us, and variables we write
+        self._uses = collections.Counter()
+        self._users = collections.Counter()
+        self._defs = collections.Counter()
+        self._source = _source_location()
 
     def is_param_type(self, type_ref):
         return self._param_type == type_ref
@@ -53,154 +103,142 @@ class Instant:
     def is_empty(self):
         return not self._body
 
-    def _validate_type(self, arg) -> typing.Tuple["typing.Type", str]:
+    def _index(self, node: ir.Node, delta: int) -> None:
+        for leaf in ir.leaves(node):
+            if isinstance(leaf, (Instant, Box)):
+                _count(self._uses, leaf, delta)
+                _count(leaf._users, self, delta)
+        for variable in ir.definitions(node):
+            _count(self._defs, variable, delta)
+            if isinstance(variable, Box):
+                _count(variable._definers, self, delta)
+
+    def _append(self, node: ir.Node) -> None:
+        self._index(node, 1)
+        self._body.append(node)
+
+    def _splice(self, start: int, stop: int, nodes: typing.List[ir.Node]) -> None:
+        for node in self._body[start:stop]:
+            self._index(node, -1)
+        for node in nodes:
+            self._index(node, 1)
+        self._body[start:stop] = nodes
+
+    def _replace_body(self, nodes: typing.List[ir.Node]) -> None:
+        self._splice(0, len(self._body), list(nodes))
+
+    def _validate_type(self, arg) -> typing.Tuple["typing.Type", typing.Any]:
         assert arg is not None
         if arg is Param:
             return self._param_type, self._param
         elif isinstance(arg, Box):
             return arg._box_type, arg
         elif type(arg) in PARAM_TYPES:
-            return type(arg), encode_value(arg)
+            return type(arg), arg
         elif hasattr(arg, "get_ref"):
             arg = arg.get_ref()
         if isinstance(arg, Instant):
-            self._referenced_instants.add(arg)
             return typing.Callable[[] if arg._param_type is None else [arg._param_type], None], arg
         else:
             assert False, "Invalid parameter (bad type): %s" % (arg,)
 
-    def _encode_gen(self, arg) -> str:
+    def _encode_gen(self, arg):
         arg_type, arg_value = self._validate_type(arg)
         return arg_value
 
-    def _validate_gen(self, arg, expected_type: "typing.Type") -> str:
+    def _validate_gen(self, arg, expected_type: "typing.Type"):
         arg_type, arg_value = self._validate_type(arg)
         assert expected_type is not None
         assert arg_type == expected_type, "Type mismatch: got %s but expected %s" % (arg_type, expected_type)
         return arg_value
 
+    def _invocation(self, target: "Instant", arg) -> ir.Invoke:
+        assert isinstance(target, Instant)
+        if target._param_type is None:
+            assert arg is None
+            return ir.Invoke(target)
+        else:
+            return ir.Invoke(target, self._validate_gen(arg, target._param_type))
+
     def invoke(self, inst: "Instant", arg=None) -> None:
         assert isinstance(inst, Instant)
-        self._referenced_instants.add(inst)
-        if arg is None:
-            assert inst._param_type is None
-            self._body.append((templates.invoke_nullary, inst))
-        else:
-            param_value = self._validate_gen(arg, inst._param_type)
-            self._body.append((templates.invoke_unary, inst, param_value))
+        self._append(self._invocation(inst, arg))
 
     def set(self, box: Box, arg):
         assert isinstance(box, Box)
         param_value = self._validate_gen(arg, box._box_type)
-        self._body.append((templates.set, box, param_value))
+        self._append(ir.Set(box, param_value))
 
     def if_equal(self, comp_a, comp_b, target: "Instant", arg=None):
-        assert isinstance(target, Instant)
-        self._referenced_instants.add(target)
         comp_type, gen_a = self._validate_type(comp_a)
         gen_b = self._validate_gen(comp_b, comp_type)
-
-        if target._param_type is None:
-            assert arg is None
-            invocation = (templates.invoke_nullary, target)
-        else:
-            arg_value = self._validate_gen(arg, target._param_type)
-            invocation = (templates.invoke_unary, target, arg_value)
-
-        self._body.append((templates.if_then, (templates.equals, gen_a, gen_b),
-                           invocation))
+        self._append(ir.IfThen(ir.Operator(gen_a, "==", gen_b), self._invocation(target, arg)))
 
     def if_unequal(self, comp_a, comp_b, target: "Instant", arg=None):
-        assert isinstance(target, Instant)
-        self._referenced_instants.add(target)
         comp_type, gen_a = self._validate_type(comp_a)
         gen_b = self._validate_gen(comp_b, comp_type)
-
-        if target._param_type is None:
-            assert arg is None
-            invocation = (templates.invoke_nullary, target)
-        else:
-            arg_value = self._validate_gen(arg, target._param_type)
-            invocation = (templates.invoke_unary, target, arg_value)
-
-        self._body.append((templates.if_then, (templates.not_equals, gen_a, gen_b),
-                           invocation))
+        self._append(ir.IfThen(ir.Operator(gen_a, "!=", gen_b), self._invocation(target, arg)))
 
     def if_else(self, comp_a, comp_b, when_true: "Instant", when_false: "Instant", arg_true=None, arg_false=None):
-        assert isinstance(when_true, Instant)
-        assert isinstance(when_false, Instant)
-        self._referenced_instants.add(when_true)
-        self._referenced_instants.add(when_false)
         comp_type, gen_a = self._validate_type(comp_a)
         gen_b = self._validate_gen(comp_b, comp_type)
 
-        if when_true._param_type is None:
-            assert arg_true is None
-            call_true = (templates.invoke_nullary, when_true)
-        else:
-            call_true = (templates.invoke_unary, when_true, self._validate_gen(arg_true, when_true._param_type))
-
-        if when_false._param_type is None:
-            assert arg_false is None
-            call_false = (templates.invoke_nullary, when_false)
-        else:
-            call_false = (templates.invoke_unary, when_false, self._validate_gen(arg_false, when_false._param_type))
+        call_true = self._invocation(when_true, arg_true)
+        call_false = self._invocation(when_false, arg_false)
 
-        if gen_b == "True":
-            self._body.append((templates.if_else, gen_a, call_true, call_false))
+        if gen_b is True:
+            self._append(ir.IfElse(gen_a, call_true, call_false))
         else:
-            self._body.append((templates.if_else, (templates.equals, gen_a, gen_b), call_true, call_false))
+            self._append(ir.IfElse(ir.Operator(gen_a, "==", gen_b), call_true, call_false))
 
     def operator_transform(self, op: str, instant_target: "Instant", arg_left, arg_right):
         assert type(op) == str
         assert isinstance(instant_target, Instant)
-        self._referenced_instants.add(instant_target)
 
         assert arg_left is not None or arg_right is not None
 
-        value_left, value_right = "" if arg_left is None else self._encode_gen(arg_left), "" if arg_right is None else self._encode_gen(arg_right)
+        value_left = None if arg_left is None else self._encode_gen(arg_left)
+        value_right = None if arg_right is None else self._encode_gen(arg_right)
 
-        self._body.append((templates.invoke_unary, instant_target, (templates.operator, value_left, op, value_right)))
+        self._append(ir.Invoke(instant_target, ir.Operator(value_left, op, value_right)))
 
     def transform(self, filter_ref: str, instant_target: typing.Optional["Instant"], *args):
         assert type(filter_ref) == str
         if instant_target is not None:
             assert isinstance(instant_target, Instant)
-            self._referenced_instants.add(instant_target)
 
         arg_values = [self._encode_gen(arg) for arg in args]
 
-        invocation = (templates.invoke_poly, filter_ref, arg_values)
+        invocation = ir.PolyCall(filter_ref, arg_values)
         if instant_target is not None:
-            invocation = (templates.invoke_unary, instant_target, invocation)
-        self._body.append(invocation)
+            invocation = ir.Invoke(instant_target, invocation)
+        self._append(invocation)
 
-    def _walk_refed_boxes(self, tree, out: set) -> None:
-        if type(tree) in (list, tuple):
-            for subtree in tree:
-                self._walk_refed_boxes(subtree, out)
-        elif isinstance(tree, Box):
-            out.add(tree)
+    def get_referenced_instants(self) -> set:
+        return {ref for ref in self._uses if isinstance(ref, Instant)}
 
     def get_referenced_boxes(self) -> set:
-        sum_set = set()
-        self._walk_refed_boxes(self._body, sum_set)
-        return sum_set
-
-    def _generate_stub(self):
-        if self._param_type is None:
-            return "static void %s(void);" % (self._instant,)
-        else:
-            return "static void %s(%s %s);" % (self._instant, PARAM_TYPES[self._param_type], self._param)
+        return {ref for ref in self._uses if isinstance(ref, Box)}
 
-    def _generate(self):
+    def _generate_signature(self, static: bool) -> str:
         if self._param_type is None:
-            yield "static void %s(void) {" % (self._instant,)
+            return "%svoid %s(void)" % ("static " if static else "", self._instant)
         else:
-            yield "static void %s(%s %s) {" % (self._instant, PARAM_TYPES[self._param_type], self._param)
-        for chunk in self._body:
-            for line in templates.apply(chunk).split("\n"):
+            return "%svoid %s(%s %s)" % ("static " if static else "", self._instant, PARAM_TYPES[self._param_type],
+                                         self._param)
+
+    def _generate_stub(self, static: bool = True):
+        return self._generate_signature(static) + ";"
+
+    def _generate(self, profile_index: typing.Optional[int] = None, static: bool = True):
+        yield self._generate_signature(static) + " {"
+        if profile_index is not None:
+            yield "\tuint64_t profile_start = profile_begin();"
+        for node in self._body:
+            for line in node.generate().split("\n"):
                 yield "\t%s" % (line,)
+        if profile_index is not None:
+            yield "\tprofile_end(&%s[%d], profile_start);" % (PROFILE_TABLE, profile_index)
         yield "}"
 
 
@@ -211,29 +249,210 @@ def _enumerate_instants(root_instant: Instant) -> typing.Set[Instant]:
     while remaining_instants:
         instant = remaining_instants.pop()
         processed_instants.add(instant)
-        remaining_instants.update(instant._referenced_instants)
+        remaining_instants.update(instant.get_referenced_instants())
         remaining_instants.difference_update(processed_instants)
     return processed_instants
 
 
-def generate_code(root_instant: Instant):
+def prepare(root_instant: Instant, optimizer_stats: typing.Optional[dict] = None) \
+        -> typing.Tuple[Instant, typing.List[Instant], typing.List[Box]]:
     assert root_instant.is_param_type(None)
 
     # find all involved instants, imports, and boxes
     instants = _enumerate_instants(root_instant)
 
     # optimize the setup - after we find everything, to avoid losing reference info
-    root_instant, instants = optimizer.optimize(root_instant, instants)
+    root_instant, instants = optimizer.optimize(root_instant, instants, stats=optimizer_stats)
 
     boxes = set().union(*(instant.get_referenced_boxes() for instant in instants))
 
+    return root_instant, sorted(instants, key=lambda instant: instant._uid), sorted(boxes, key=lambda box: box._uid)
+
+
+def describe_source(source: typing.Optional[typing.Tuple[str, int]]) -> typing.Optional[str]:
+    return None if source is None else "%s:%d" % source
+
+
+def _line_directive(source: typing.Tuple[str, int]) -> str:
+    return "#line %d \"%s\"" % (source[1], source[0].replace("\\", "\\\\").replace("\"", "\\\""))
+
+
+def _prepare_symbols(root_instant: Instant, profiled_instants: typing.Optional[list],
+                     source_map: typing.Optional[dict], symbols: typing.Optional[dict],
+                     optimizer_stats: typing.Optional[dict]):
+    root_instant, instants, boxes = prepare(root_instant, optimizer_stats)
+    if profiled_instants is not None:
+        profiled_instants += instants
+    if source_map is not None:
+        source_map.update((symbol._box, describe_source(symbol._source)) for symbol in boxes)
+        source_map.update((symbol._instant, describe_source(symbol._source)) for symbol in instants)
+    if symbols is not None:
+        symbols.update((symbol._box, symbol) for symbol in boxes)
+        symbols.update((symbol._instant, symbol) for symbol in instants)
+    return root_instant, instants, boxes
+
+
+def _generate_profile_table(instants: typing.List[Instant], static: bool = True) -> typing.List[str]:
+    out = ["%sstruct profile_entry %s[] = {" % ("static " if static else "", PROFILE_TABLE)]
+    out += ["\t{\"%s\", %d, 0, 0}," % (instant._instant, instant._uid) for instant in instants]
+    out.append("};")
+    return out
+
+
+def _line_count(lines: typing.List[str]) -> int:
+    return sum(1 + line.count("\n") for line in lines)
+
+
+def _generate_bodies(out: typing.List[str], instants: typing.List[Instant], profile_indices: typing.Optional[dict],
+                     line_directives: bool, file_name: str,
+                     static: typing.Callable[[Instant], bool] = lambda instant: True) -> None:
+    # appends to out, which holds everything generated so far for file_name
+    next_line = _line_count(out) + 1
+    for instant in instants:
+        body = list(instant._generate(None if profile_indices is None else profile_indices[instant], static(instant)))
+        if line_directives and instant._source is not None:
+            # attributes compiler diagnostics and debug info for this function to the robot code that created it, and
+            # then goes back to numbering the generated file, so that the code after it isn't attributed there too
+            out.append(_line_directive(instant._source))
+            out += body
+            next_line += 1 + _line_count(body)
+            out.append(_line_directive((file_name, next_line + 1)))
+            next_line += 1
+        else:
+            out += body
+            next_line += _line_count(body)
+
+
+def _generate_main(root_instant: Instant, profile_count: typing.Optional[int]) -> typing.List[str]:
+    out = ["int main() {"]
+    if profile_count is not None:
+        out.append("\tprofile_start_dump(%s, %d);" % (PROFILE_TABLE, profile_count))
+    out.append("\t%s();\n\tpanic(\"critical failure: root instant returned\");\n}" % root_instant._instant)
+    return out
+
+
+def generate_code(root_instant: Instant, profiled_instants: typing.Optional[list] = None,
+                  line_directives: bool = False, source_map: typing.Optional[dict] = None,
+                  symbols: typing.Optional[dict] = None, optimizer_stats: typing.Optional[dict] = None):
+    # if profiled_instants is provided, every instant counts its calls and time, and the instants are appended to it
+    # in the order of the generated profile table. if source_map is provided, it is filled in with the creation site
+    # of every generated symbol, and if symbols is provided, with the Box or Instant behind each one. if
+    # optimizer_stats is provided, it is filled in with how much work the optimizer did (see optimizer.optimize).
+    profile = profiled_instants is not None
+    root_instant, instants, boxes = _prepare_symbols(root_instant, profiled_instants, source_map, symbols,
+                                                     optimizer_stats)
+
     # generate code
     out = ["#include \"themis.h\""]
     out += [box._generate() for box in boxes]
-    for instant in sorted(instants, key=lambda instant: instant._uid):
+    if profile:
+        out += _generate_profile_table(instants)
+    for instant in instants:
         out.append(instant._generate_stub())
-    for instant in sorted(instants, key=lambda instant: instant._uid):
-        out += instant._generate()
-    out += ["int main() {\n\t%s();\n\tpanic(\"critical failure: root instant returned\");\n}" % root_instant._instant]
+    _generate_bodies(out, instants, {instant: i for i, instant in enumerate(instants)} if profile else None,
+                     line_directives, MAIN_FILE)
+    out += _generate_main(root_instant, len(instants) if profile else None)
 
     return "\n".join(out)
+
+
+def _partition(instants: typing.List[Instant], units: int) -> typing.Dict[Instant, int]:
+    # each instant follows its first caller, so that calls mostly stay within a unit, where gcc can still inline them.
+    # that makes a forest, and each tree goes to one unit, unless it's too big to balance, in which case its root is
+    # placed alone and its subtrees are placed separately. sizes count leaves, which editing a constant doesn't change,
+    # so that such an edit leaves the other units byte-for-byte the same.
+    live = set(instants)
+    parent = {}
+    for instant in instants:
+        callers = [user for user in instant._users if user in live and user is not instant]
+        if callers:
+            parent[instant] = min(callers, key=lambda caller: caller._uid)
+    for instant in instants:
+        seen = set()
+        while instant in parent and instant not in seen:
+            seen.add(instant)
+            instant = parent[instant]
+        if instant in seen:
+            del parent[instant]  # instants that only call each other: break the cycle anywhere
+    children = collections.defaultdict(list)
+    for instant in instants:
+        if instant in parent:
+            children[parent[instant]].append(instant)
+
+    size = {instant: 1 + sum(1 for node in instant._body for _ in ir.leaves(node)) for instant in instants}
+    tree_size = dict(size)
+    order = [instant for instant in instants if instant not in parent]
+    for instant in order:  # grows as it goes, so that every parent comes before its children
+        order += children[instant]
+    for instant in reversed(order):
+        if instant in parent:
+            tree_size[parent[instant]] += tree_size[instant]
+
+    limit = sum(size.values()) / units
+    pieces, piece_of = [], {}
+    for instant in order:
+        if instant in piece_of:
+            continue
+        if tree_size[instant] > limit and children[instant]:
+            pieces.append((instant, size[instant]))
+            piece_of[instant] = instant
+        else:
+            pieces.append((instant, tree_size[instant]))
+            remaining = [instant]
+            while remaining:
+                member = remaining.pop()
+                piece_of[member] = instant
+                remaining += children[member]
+
+    # largest first, each into whichever unit has the least so far
+    piece_unit, loads = {}, [0] * units
+    for instant, weight in sorted(pieces, key=lambda piece: (-piece[1], piece[0]._uid)):
+        unit = loads.index(min(loads))
+        piece_unit[instant] = unit
+        loads[unit] += weight
+    return {instant: piece_unit[piece_of[instant]] for instant in instants}
+
+
+def generate_units(root_instant: Instant, units: int, profiled_instants: typing.Optional[list] = None,
+                   line_directives: bool = False, source_map: typing.Optional[dict] = None,
+                   symbols: typing.Optional[dict] = None,
+                   optimizer_stats: typing.Optional[dict] = None) -> typing.Dict[str, str]:
+    # like generate_code, but split across the given number of C files, which can be compiled in parallel. returns a
+    # mapping from file name to contents, including a header that declares everything the files share.
+    assert units >= 1
+    profile = profiled_instants is not None
+    root_instant, instants, boxes = _prepare_symbols(root_instant, profiled_instants, source_map, symbols,
+                                                     optimizer_stats)
+    unit_of = _partition(instants, units)
+
+    def units_using(symbol):
+        found = {unit_of[user] for user in symbol._users if user in unit_of}  # readers and writers both
+        return found | {0} if symbol is root_instant else found  # main() is in the first unit
+
+    # only what is used from another unit gets external linkage; everything else stays static, as in generate_code
+    box_units = {box: units_using(box) or {0} for box in boxes}
+    shared_boxes = {box for box in boxes if len(box_units[box]) > 1}
+    shared_instants = {instant for instant in instants if units_using(instant) - {unit_of[instant]}}
+
+    header = ["#include \"themis.h\""]
+    header += [box._generate_extern() for box in boxes if box in shared_boxes]
+    if profile:
+        header.append("extern struct profile_entry %s[];" % PROFILE_TABLE)
+    header += [instant._generate_stub(static=False) for instant in instants if instant in shared_instants]
+    files = {PROGRAM_HEADER: "\n".join(header)}
+
+    profile_indices = {instant: i for i, instant in enumerate(instants)} if profile else None
+    for unit in range(units):
+        unit_instants = [instant for instant in instants if unit_of[instant] == unit]
+        out = ["#include \"%s\"" % PROGRAM_HEADER]
+        out += [box._generate(box not in shared_boxes) for box in boxes if min(box_units[box]) == unit]
+        if profile and unit == 0:
+            out += _generate_profile_table(instants, static=False)
+        out += [instant._generate_stub() for instant in unit_instants if instant not in shared_instants]
+        name = "themis_unit%d.c" % unit
+        _generate_bodies(out, unit_instants, profile_indices, line_directives, name,
+                         lambda instant: instant not in shared_instants)
+        if unit == 0:
+            out += _generate_main(root_instant, len(instants) if profile else None)
+        files[name] = "\n".join(out)
+    return files
@@ -0,0 +1,51 @@
+import math
+
+# Python equivalents of the pure helper functions in themis.c. These must be kept in sync with the C versions.
+
+__all__ = ["deadzone", "choose_float", "pwm_map", "ramping_update", "float_changed", "PURE_HELPERS",
+           "INLINE_HELPERS"]
+
+
+def deadzone(value: float, zone: float) -> float:
+    return value if abs(value) >= zone else 0.0
+
+
+def choose_float(cond: bool, a: float, b: float) -> float:
+    return a if cond else b
+
+
+def pwm_map(value: float, rev_max: float, rev_min: float, center: float, fwd_min: float, fwd_max: float) -> float:
+    if value < 0:
+        return min(1, -value) * (rev_max - rev_min) + rev_min
+    elif value > 0:
+        return min(1, value) * (fwd_max - fwd_min) + fwd_min
+    elif math.isnan(value):
+        return math.nan
+    else:
+        return center
+
+
+def ramping_update(previous: float, target: float, max_change_per_update: float) -> float:
+    if previous < target:
+        return min(target, previous + max_change_per_update)
+    else:
+        return max(target, previous - max_change_per_update)
+
+
+def float_changed(previous: float, value: float, epsilon: float) -> bool:
+    if math.isnan(previous) or math.isnan(value):
+        return math.isnan(previous) != math.isnan(value)
+    return abs(value - previous) > epsilon
+
+
+PURE_HELPERS = {
+    "deadzone": deadzone,
+    "choose_float": choose_float,
+    "pwm_map": pwm_map,
+    "ramping_update": ramping_update,
+    "float_changed": float_changed,
+}
+
+# the static inline copies of these in themis.h, which generated C code calls instead, so that gcc can fold constant
+# arguments into them
+INLINE_HELPERS = {name: name + "_inline" for name in PURE_HELPERS}
@@ -0,0 +1,183 @@
+import typing
+
+import themis.cgen.helpers
+import themis.cgen.templates
+
+__all__ = ["Node", "Invoke", "PolyCall", "Operator", "Set", "SetDecl", "IfThen", "IfElse", "Nop", "NOP",
+           "leaves", "definitions", "transform"]
+
+
+class Node:
+    __slots__ = ()
+    expression_only = False  # set on node classes that are never statements, which keep the generate() below
+
+    def __init_subclass__(cls, **kwargs):
+        # checked when each node class is defined, rather than when code generation first reaches one. (not abc, since
+        # its isinstance checks would slow down every pass over the IR.)
+        super().__init_subclass__(**kwargs)
+        if not cls.expression_only and cls.generate is Node.generate:
+            raise TypeError("%s must define generate()" % cls.__name__)
+
+    def operands(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def with_operands(self, operands) -> "Node":
+        return type(self)(*operands)
+
+    def expr(self) -> str:
+        raise TypeError("%s cannot be used as an expression" % type(self).__name__)
+
+    def generate(self) -> str:
+        raise TypeError("%s cannot be used as a statement" % type(self).__name__)
+
+    def __repr__(self):
+        return "%s%r" % (type(self).__name__, self.operands())
+
+
+class Invoke(Node):
+    __slots__ = ("target", "arg")
+
+    def __init__(self, target, arg=None):
+        self.target = target
+        self.arg = arg
+
+    def generate(self) -> str:
+        if self.arg is None:
+            return themis.cgen.templates.invoke_nullary(self.target)
+        else:
+            return themis.cgen.templates.invoke_unary(self.target, self.arg)
+
+
+class PolyCall(Node):
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: str, args):
+        assert type(func) == str
+        self.func = func
+        self.args = tuple(args)
+
+    def operands(self) -> tuple:
+        return (self.func,) + self.args
+
+    def with_operands(self, operands) -> "Node":
+        return PolyCall(operands[0], operands[1:])
+
+    def c_func(self) -> str:
+        # pure helpers are called through their static inline copies in themis.h
+        return themis.cgen.helpers.INLINE_HELPERS.get(self.func, self.func)
+
+    def expr(self) -> str:
+        return themis.cgen.templates.call(self.c_func(), self.args)
+
+    def generate(self) -> str:
+        return themis.cgen.templates.invoke_poly(self.c_func(), self.args)
+
+
+class Operator(Node):
+    __slots__ = ("left", "op", "right")
+    expression_only = True
+
+    def __init__(self, left, op: str, right):
+        assert type(op) == str
+        assert left is not None or right is not None
+        self.left = left
+        self.op = op
+        self.right = right
+
+    def operands(self) -> tuple:
+        return self.left, self.right
+
+    def with_operands(self, operands) -> "Node":
+        return Operator(operands[0], self.op, operands[1])
+
+    def expr(self) -> str:
+        return themis.cgen.templates.operator(self.left, self.op, self.right)
+
+
+class Set(Node):
+    __slots__ = ("variable", "value")
+
+    def __init__(self, variable, value):
+        self.variable = variable
+        self.value = value
+
+    def generate(self) -> str:
+        return themis.cgen.templates.set(self.variable, self.value)
+
+
+class SetDecl(Node):
+    __slots__ = ("var_type", "variable", "value")
+
+    def __init__(self, var_type: str, variable, value):
+        self.var_type = var_type
+        self.variable = variable
+        self.value = value
+
+    def operands(self) -> tuple:
+        return self.variable, self.value
+
+    def with_operands(self, operands) -> "Node":
+        return SetDecl(self.var_type, operands[0], operands[1])
+
+    def generate(self) -> str:
+        return themis.cgen.templates.set_decl(self.var_type, self.variable, self.value)
+
+
+class IfThen(Node):
+    __slots__ = ("condition", "body")
+
+    def __init__(self, condition, body: Node):
+        self.condition = condition
+        self.body = body
+
+    def generate(self) -> str:
+        return themis.cgen.templates.if_then(self.condition, self.body.generate())
+
+
+class IfElse(Node):
+    __slots__ = ("condition", "body_true", "body_false")
+
+    def __init__(self, condition, body_true: Node, body_false: Node):
+        self.condition = condition
+        self.body_true = body_true
+        self.body_false = body_false
+
+    def generate(self) -> str:
+        return themis.cgen.templates.if_else(self.condition, self.body_true.generate(), self.body_false.generate())
+
+
+class Nop(Node):
+    __slots__ = ()
+
+    def generate(self) -> str:
+        return themis.cgen.templates.nop()
+
+
+NOP = Nop()
+
+
+def leaves(node) -> typing.Iterator:
+    for operand in node.operands():
+        if isinstance(operand, Node):
+            yield from leaves(operand)
+        elif operand is not None:
+            yield operand
+
+
+def definitions(node) -> typing.Iterator:
+    if isinstance(node, (Set, SetDecl)):
+        yield node.variable
+    for operand in node.operands():
+        if isinstance(operand, Node):
+            yield from definitions(operand)
+
+
+def transform(node: Node, node_func=None, leaf_func=None) -> Node:
+    # rebuilds the tree bottom-up; unchanged subtrees are returned as-is, so callers can compare by identity
+    operands = node.operands()
+    updated = tuple(transform(operand, node_func, leaf_func) if isinstance(operand, Node)
+                    else (leaf_func(operand) if leaf_func is not None and operand is not None else operand)
+                    for operand in operands)
+    if any(new is not old for new, old in zip(updated, operands)):
+        node = node.with_operands(updated)
+    return node if node_func is None else node_func(node)
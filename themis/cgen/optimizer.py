@@ -1,243 +1,447 @@
-import themis.cgen.templates
+import collections
+import math
+import operator
+import os
+import typing
+
+import themis.cgen
+import themis.util
+from themis.cgen import ir, helpers
 
 _opt_passes = []
+_final_passes = []
+_verbose = themis.util.Parameter(os.environ.get("THEMIS_VERBOSE_OPTIMIZER", "0") == "1")
+_eliminated = themis.util.Parameter(None)  # the running PassManager's counts of what its passes eliminated
 
-wildcard = object()
 CALLBACK_ELIM = ["start_timer_ns"]
+# runtime functions that only read state, so calls whose results go unused can be dropped
+SIDE_EFFECT_FREE = ["get_robot_mode", "get_joystick_axis", "get_joystick_button", "gpio_poll_input",
+                    "ds_mode", "ds_axis", "ds_button"]
+DEFAULT_MAX_ROUNDS = 32
 
 
-def tree_match(tree, template):
-    if template is wildcard:
-        return True
-    elif type(tree) != type(template):
-        return False
-    elif tree == template:
+def rewrite_body(instant, node_func=None, leaf_func=None) -> bool:
+    body = [ir.transform(node, node_func, leaf_func) for node in instant._body]
+    if any(new is not old for new, old in zip(body, instant._body)):
+        instant._replace_body(body)
         return True
-    elif type(tree) != tuple:
-        return False
-    elif len(tree) != len(template):
-        return False
-    else:
-        return all(tree_match(subtree, subtemplate) for subtree, subtemplate in zip(tree, template))
+    return False
 
 
-def tree_replace(tree, template_list, substitutor, replace_before=False):
-    if any(tree_match(tree, template) for template in template_list):
-        if replace_before and type(tree) == tuple:
-            tree = (tree[0],) + tuple(
-                tree_replace(subtree, template_list, substitutor, replace_before) for subtree in tree[1:])
-        return substitutor(tree)
-    elif type(tree) == tuple:
-        return (tree[0],) + tuple(
-            tree_replace(subtree, template_list, substitutor, replace_before) for subtree in tree[1:])
-    elif type(tree) == list:
-        return tree_replace_all(tree, template_list, substitutor, replace_before)
-    else:
-        return tree
+def users_within(targets, instants: set) -> set:
+    users = set()
+    for target in targets:
+        users.update(target._users)
+    users.intersection_update(instants)
+    return users
 
 
-def tree_replace_all(trees, template_list, substitutor, replace_before=False):
-    return [tree_replace(tree, template_list, substitutor, replace_before) for tree in trees]
+def opt_pass(op):
+    _opt_passes.append(op)
 
 
-def replace_in_instants(instants, template_list, substitutor, replace_before=False):
-    for instant in instants:
-        instant._body = tree_replace_all(instant._body, template_list, substitutor, replace_before)
-
-
-def tree_walk(tree, walker):
-    has_changed = False
-    if type(tree) == list or type(tree) == tuple:
-        out = None
-        for i in range(len(tree)):
-            change, value = tree_walk(tree[i], walker)
-            if change:
-                if out is None:
-                    out = tree[:]
-                out[i] = value
-        has_changed = out is not None
-        if has_changed:
-            tree = tuple(out) if type(tree) == tuple else out
-    change, value = walker(tree)
-    if change:
-        return True, value
-    else:
-        return has_changed, tree
-
-
-def replace_walk_in_instants(instants, walker):
-    for instant in instants:
-        update, value = tree_walk(instant._body, walker)
-        if update:
-            instant._body = value
+def final_pass(op):
+    # for passes that need the whole graph every time: they run once the other passes have settled, instead of in
+    # every round
+    _final_passes.append(op)
 
 
-def tree_walk_ro(tree, walker):
-    if type(tree) == list or type(tree) == tuple:
-        for subtree in tree:
-            tree_walk_ro(subtree, walker)
-    walker(tree)
+def verbose(enabled: bool = True) -> themis.util.Parameterization:
+    # while entered, passes on this thread print each thing that they eliminate, rather than only how many
+    return _verbose.parameterize(enabled)
 
 
-def opt_pass(op):
-    _opt_passes.append(op)
+def count_eliminated(kind: str, count: int) -> None:
+    eliminated = _eliminated.get()
+    if eliminated is not None:
+        eliminated[kind] += count
+
+
+FOLD_OPERATORS = {"&": operator.and_, "|": operator.or_, "==": operator.eq, "!=": operator.ne,
+                  "+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv}
+
+
+def is_literal(value) -> bool:
+    # C has no literals for infinities or NaNs, and NaNs would behave differently in Python's min/max anyway
+    return type(value) in (bool, int, float) and (type(value) != float or math.isfinite(value))
+
+
+def is_pure(value) -> bool:
+    if isinstance(value, ir.PolyCall) and value.func not in helpers.PURE_HELPERS:
+        return False
+    return not isinstance(value, ir.Node) or all(is_pure(operand) for operand in value.operands())
+
+
+def evaluate_operator(node: ir.Operator):
+    left, right = node.left, node.right
+    if left is None:
+        return (not right) if node.op == "!" else (-right if node.op == "-" else None)
+    if right is None or node.op not in FOLD_OPERATORS or (node.op == "/" and int in (type(left), type(right))):
+        return None  # (C integer division truncates)
+    try:
+        return FOLD_OPERATORS[node.op](left, right)
+    except ZeroDivisionError:
+        return None
+
+
+def fold_node(node):
+    if isinstance(node, ir.Operator):
+        if (node.left is None or is_literal(node.left)) and (node.right is None or is_literal(node.right)):
+            value = evaluate_operator(node)
+            if is_literal(value):
+                return value
+        # identities that hold for every double, including -0.0 and NaN
+        if type(node.right) == float and node.left is not None and \
+                (node.op in ("*", "/") and node.right == 1.0 or
+                 node.op == "-" and node.right == 0.0 and math.copysign(1, node.right) > 0 or
+                 node.op == "+" and node.right == 0.0 and math.copysign(1, node.right) < 0):
+            return node.left
+        if type(node.left) == float and node.op == "*" and node.left == 1.0:
+            return node.right
+    elif isinstance(node, ir.PolyCall) and node.func in helpers.PURE_HELPERS:
+        if node.func == "choose_float" and is_literal(node.args[0]) and all(is_pure(arg) for arg in node.args):
+            return node.args[1] if node.args[0] else node.args[2]
+        if all(is_literal(arg) for arg in node.args):
+            value = helpers.PURE_HELPERS[node.func](*node.args)
+            if type(value) != bool:
+                value = float(value)  # the Python versions can return ints where the C ones return doubles
+            if is_literal(value):
+                return value
+    elif isinstance(node, ir.IfThen) and is_literal(node.condition):
+        return node.body if node.condition else ir.NOP
+    elif isinstance(node, ir.IfElse) and is_literal(node.condition):
+        return node.body_true if node.condition else node.body_false
+    return node
+
+
+def fold_statement(node, leaf_func):
+    node = ir.transform(node, fold_node, leaf_func)
+    if not isinstance(node, ir.Node) or (isinstance(node, ir.PolyCall) and is_pure(node)):
+        return ir.NOP  # a pure computation whose result isn't used
+    return node
+
+
+@opt_pass
+def opt_fold_constants(root_instant, instants: set, dirty: set):
+    # boxes that nothing reachable ever writes to keep their initial values forever
+    constants = {}
+    for instant in dirty:
+        for box in instant.get_referenced_boxes():
+            if not any(definer in instants for definer in box._definers):
+                constants[box] = box._value
+
+    changed = set()
+    for instant in dirty:
+        body = []
+        local_constants = dict(constants)  # plus locals declared by inlining with literal arguments
+
+        def leaf_func(leaf):
+            return local_constants.get(leaf, leaf) if isinstance(leaf, (str, themis.cgen.Box)) else leaf
+
+        for node in instant._body:
+            if isinstance(node, ir.SetDecl):
+                value = ir.transform(node.value, fold_node, leaf_func) if isinstance(node.value, ir.Node) \
+                    else leaf_func(node.value)
+                if is_literal(value):
+                    local_constants[node.variable] = value
+                    continue
+            body.append(fold_statement(node, leaf_func))
+        if len(body) == len(instant._body) and all(new is old for new, old in zip(body, instant._body)):
+            continue
+        written = {box for box in instant._defs if isinstance(box, themis.cgen.Box)}
+        instant._replace_body(body)
+        changed.add(instant)
+        # boxes that lost a writer might be constant now
+        lost = {box for box in written if box not in instant._defs}
+        changed.update(users_within(lost, instants))
+    return root_instant, instants, changed
+
+
+def reads(node) -> typing.Iterator:
+    operands = (node.value,) if isinstance(node, (ir.Set, ir.SetDecl)) else node.operands()
+    for operand in operands:
+        if isinstance(operand, ir.Node):
+            yield from reads(operand)
+        elif operand is not None:
+            yield operand
+
+
+def has_effect(node, useful: set, live: set) -> bool:
+    # whether running this node can influence a HAL write or other side effect, given what's known to be needed so far
+    if isinstance(node, ir.Invoke) and node.target in useful:
+        return True
+    if isinstance(node, ir.PolyCall) and node.func not in SIDE_EFFECT_FREE and node.func not in helpers.PURE_HELPERS:
+        return True
+    if isinstance(node, (ir.Set, ir.SetDecl)):
+        return node.variable in live or (isinstance(node.value, ir.Node) and has_effect(node.value, useful, live))
+    return any(has_effect(operand, useful, live) for operand in node.operands() if isinstance(operand, ir.Node))
+
+
+def find_effective(instant, useful: set, live: set, newly_live: list = None) -> list:
+    # backwards, so that locals are known to be live before we reach their declarations
+    effective = []
+    for node in reversed(instant._body):
+        if has_effect(node, useful, live):
+            effective.append(node)
+            for leaf in reads(node):
+                if isinstance(leaf, (str, themis.cgen.Box)) and leaf not in live:
+                    live.add(leaf)
+                    if newly_live is not None:
+                        newly_live.append(leaf)
+    effective.reverse()
+    return effective
+
+
+@final_pass
+def opt_eliminate_dead(root_instant, instants: set, dirty: set):
+    # the roots are HAL writes and other calls with side effects; everything else is only kept if it can reach one,
+    # either by calling it or by writing a Box that it (transitively) reads.
+    useful, live = set(), set()
+    worklist = set(instants)
+    while worklist:
+        instant = worklist.pop()
+        newly_live = []
+        if find_effective(instant, useful, live, newly_live) and instant not in useful:
+            useful.add(instant)
+            worklist.update(users_within([instant], instants))
+        for box in newly_live:
+            if isinstance(box, themis.cgen.Box):
+                worklist.update(definer for definer in box._definers if definer in instants)
+    removals = {}
+    for instant in instants:
+        effective = find_effective(instant, useful, live)
+        if len(effective) != len(instant._body):
+            removals[instant] = effective
+    changed = set(removals)
+    dead_nodes = sum(len(instant._body) - len(removals[instant]) for instant in changed & useful)
+    dead_instants = len(changed - useful)
+    if _verbose.get():
+        for instant, effective in sorted(removals.items(), key=lambda item: item[0]._uid):
+            if instant not in useful:
+                continue
+            for node in instant._body:
+                # (calls to empty instants aren't worth mentioning)
+                if not any(node is kept for kept in effective) and \
+                        not (isinstance(node, ir.Invoke) and node.target.is_empty()):
+                    source = themis.cgen.describe_source(node.target._source) if isinstance(node, ir.Invoke) else None
+                    print("ELIMINATED DEAD CODE IN", instant._instant, ":", node.generate().split("\n")[0],
+                          "(from %s)" % source if source else "")
+    for instant, effective in removals.items():
+        instant._replace_body(effective)
+    if dead_nodes or dead_instants:
+        print("ELIMINATED", dead_nodes, "DEAD STATEMENTS AND", dead_instants, "DEAD INSTANTS")
+    count_eliminated("dead_statements", dead_nodes)
+    count_eliminated("dead_instants", dead_instants)
+    return root_instant, instants, changed
 
 
 @opt_pass
-def opt_eliminate_empty(root_instant, instants: set):
-    to_remove = [instant for instant in instants if instant.is_empty() and instant is not root_instant]
+def opt_eliminate_empty(root_instant, instants: set, dirty: set):
+    to_remove = {instant for instant in dirty if instant.is_empty() and instant is not root_instant}
     if not to_remove:
-        return root_instant, instants
+        return root_instant, instants, set()
     instants.difference_update(to_remove)
 
-    # === ELIMINATE DIRECT CALLS ===
-    def substitutor(tree):
-        assert tree[0] in (
-            themis.cgen.templates.invoke_nullary, themis.cgen.templates.invoke_unary,
-            themis.cgen.templates.invoke_poly)
-        assert tree[1] in to_remove
-        return (themis.cgen.templates.nop,)
-
-    template_list = []
-    for instant in to_remove:
-        template_list += [(themis.cgen.templates.invoke_nullary, instant),
-                          (themis.cgen.templates.invoke_unary, instant, wildcard),
-                          (themis.cgen.templates.invoke_poly, instant, wildcard)]
-    replace_in_instants(instants, template_list, substitutor)
-
-    # === ELIMINATE INDIRECT USES ===
-    def substitutor_2(tree):
-        if tree[0] == themis.cgen.templates.invoke_unary and tree[2] in to_remove:
-            if tree[1] in CALLBACK_ELIM:
-                return (themis.cgen.templates.nop,)
+    def substitutor(node):
+        # === ELIMINATE DIRECT CALLS ===
+        if isinstance(node, ir.Invoke) and node.target in to_remove:
+            return ir.NOP
+        # === ELIMINATE INDIRECT USES ===
+        if isinstance(node, ir.PolyCall) and any(arg in to_remove for arg in node.args):
+            if node.func in CALLBACK_ELIM:
+                return ir.NOP
             else:
-                return tree[0:2] + ("do_nothing",) + tree[3:]
-        else:
-            assert tree[0] == themis.cgen.templates.invoke_poly
-            if any(elem in to_remove for elem in tree[2]):
-                if tree[1] in CALLBACK_ELIM:
-                    return (themis.cgen.templates.nop,)
-                else:
-                    updated_args = [(arg if arg not in to_remove else "do_nothing") for arg in tree[2]]
-                    return tree[0:2] + (updated_args,) + tree[3:]
-            else:
-                return tree
+                return ir.PolyCall(node.func, [(arg if arg not in to_remove else "do_nothing") for arg in node.args])
+        return node
 
-    template_list = [(themis.cgen.templates.invoke_poly, wildcard, wildcard)]
-    for instant in to_remove:
-        template_list += [(themis.cgen.templates.invoke_unary, wildcard, instant)]
-    replace_in_instants(instants, template_list, substitutor_2, replace_before=True)
-
-    return root_instant, instants
+    changed = {user for user in users_within(to_remove, instants) if rewrite_body(user, substitutor)}
+    return root_instant, instants, changed
 
 
 @opt_pass
-def opt_eliminate_nops(root_instant, instants):
-    def walker(tree):
-        if type(tree) == list and (themis.cgen.templates.nop,) in tree:
-            return True, [elem for elem in tree if elem != (themis.cgen.templates.nop,)]
-        return False, None
-
-    replace_walk_in_instants(instants, walker)
-    return root_instant, instants
+def opt_eliminate_nops(root_instant, instants, dirty: set):
+    changed = set()
+    for instant in dirty:
+        if any(node is ir.NOP for node in instant._body):
+            instant._replace_body([node for node in instant._body if node is not ir.NOP])
+            changed.add(instant)
+    return root_instant, instants, changed
 
 
 def check_get_simple_call(instant):
     if len(instant._body) != 1: return
-    if instant._param_type is None:
-        if instant._body[0][0] == themis.cgen.templates.invoke_nullary \
-                and isinstance(instant._body[0][1], themis.cgen.Instant):
-            return instant._body[0][1]
-    else:
-        if instant._body[0][0] == themis.cgen.templates.invoke_unary \
-                and isinstance(instant._body[0][1], themis.cgen.Instant) and instant._body[0][2] == instant._param:
-            return instant._body[0][1]
+    node = instant._body[0]
+    if isinstance(node, ir.Invoke) and isinstance(node.target, themis.cgen.Instant):
+        if instant._param_type is None:
+            if node.arg is None:
+                return node.target
+        elif node.arg == instant._param:
+            return node.target
 
 
 @opt_pass
-def opt_inline_simple(root_instant, instants: set):
+def opt_inline_simple(root_instant, instants: set, dirty: set):
     remaps = {}
-    for instant in instants:
+    for instant in dirty:
         simple_target = check_get_simple_call(instant)
-        if simple_target is not None:
+        if simple_target is not None and instant is not root_instant:
             remaps[instant] = simple_target
+    if not remaps:
+        return root_instant, instants, set()
     # === ELIMINATE REMAPPED INSTANTS FROM INSTANT LIST ===
     instants.difference_update(remaps.keys())
 
     # === REMAP USES OF REMOVED INSTANTS ===
-    def substitutor(tree):
-        assert tree in remaps
-        while tree in remaps:  # TODO: notice infinite loops
-            tree = remaps[tree]
-        return tree
-
-    replace_in_instants(instants, [instant for instant in remaps.keys()], substitutor, replace_before=True)
-    return root_instant, instants
-
-
-def calculate_refcounts(root_instant, instants):
-    refs = {instant: [] for instant in instants}
-    refs[root_instant].append(None)
-
-    for instant in instants:
-        def walker(tree):
-            if isinstance(tree, themis.cgen.Instant):
-                refs[tree].append(instant)
-
-        tree_walk_ro(instant._body, walker)
+    def substitutor(leaf):
+        while leaf in remaps:  # TODO: notice infinite loops
+            leaf = remaps[leaf]
+        return leaf
 
-    return refs
+    changed = {user for user in users_within(remaps.keys(), instants) if rewrite_body(user, leaf_func=substitutor)}
+    for instant in remaps:
+        instant._replace_body([])
+    return root_instant, instants, changed
 
 
-def get_modified_variables(instant):
-    refed = {instant._param} if instant._param_type is not None else set()
+def get_refcount(root_instant, instant) -> int:
+    return sum(instant._users.values()) + (1 if instant is root_instant else 0)
 
-    def walker(tree):
-        if type(tree) == tuple and tree[0] == themis.cgen.templates.set:
-            refed.add(tree[1])
-
-    tree_walk_ro(instant._body, walker)
 
+def get_modified_variables(instant) -> set:
+    # only locals can clash when bodies are merged; writing the same Box from both is fine
+    refed = {variable for variable in instant._defs if not isinstance(variable, themis.cgen.Box)}
+    if instant._param_type is not None:
+        refed.add(instant._param)
     return refed
 
 
 @opt_pass
-def opt_inline(root_instant, instants: set):
-    refs = calculate_refcounts(root_instant, instants)
-    inlineable = [instant for instant, ref in refs.items() if len(ref) == 1 and instant is not root_instant]
+def opt_inline(root_instant, instants: set, dirty: set):
+    # only instants whose refcount or body could have changed since the last run are worth considering
+    candidates = set(dirty)
+    for instant in dirty:
+        candidates.update(instant.get_referenced_instants())
+    candidates.intersection_update(instants)
+    inlineable = [instant for instant in candidates
+                  if get_refcount(root_instant, instant) == 1 and instant is not root_instant]
     inlineable.sort(key=lambda x: x._uid)
-    actually_inlined = []
+    actually_inlined = set()
+    changed = set()
     for instant in inlineable:
-        refed_in = refs[instant][0]
-        while refed_in in actually_inlined:
-            refed_in = refs[refed_in][0]
+        if get_refcount(root_instant, instant) != 1:
+            continue
+        # the index is kept up to date as we inline, so this is always the current host
+        refed_in, = instant._users
         assert refed_in is not instant
         if get_modified_variables(refed_in).intersection(get_modified_variables(instant)):
             print("VARDUP BYPASS", instant._instant, "INTO", refed_in._instant)
             continue
-        found_line = [i for i, line in enumerate(refed_in._body)
-                      if line[0] in (themis.cgen.templates.invoke_nullary, themis.cgen.templates.invoke_unary)
-                      and line[1] == instant]
+        found_line = [i for i, node in enumerate(refed_in._body)
+                      if isinstance(node, ir.Invoke) and node.target is instant]
         if not found_line:
             continue
         assert len(found_line) == 1
         line_id = found_line[0]
-        if refed_in._body[line_id][0] == themis.cgen.templates.invoke_nullary:
+        invocation = refed_in._body[line_id]
+        if invocation.arg is None:
             assert instant._param_type is None
-            refed_in._body[line_id:line_id + 1] = instant._body
+            replacement = list(instant._body)
         else:
             assert instant._param_type is not None
-            refed_in._body[line_id:line_id + 1] = [(themis.cgen.templates.set_decl,
-                                                    themis.cgen.PARAM_TYPES[instant._param_type], instant._param,
-                                                    refed_in._body[line_id][2])] + instant._body
-        actually_inlined.append(instant)
+            replacement = [ir.SetDecl(themis.cgen.PARAM_TYPES[instant._param_type], instant._param,
+                                      invocation.arg)] + instant._body
+        refed_in._splice(line_id, line_id + 1, replacement)
+        instant._replace_body([])
+        actually_inlined.add(instant)
+        changed.add(refed_in)
 
     instants.difference_update(actually_inlined)
-    return root_instant, instants
+    return root_instant, instants, changed - actually_inlined
 
 
-def optimize(root_instant, instants):
-    for op in _opt_passes:
-        root_instant, instants = op(root_instant, instants)
-
+def detach_unreachable(instants: set) -> None:
+    # instants that were never reachable from the root (such as the cells behind constant channels) can still
+    # reference reachable instants; drop their bodies so that they don't count as users.
+    users = set()
+    for instant in instants:
+        users.update(instant._users)
+    for user in users - instants:
+        user._replace_body([])
+
+
+class PassManager:
+    def __init__(self, root_instant, instants: set, passes=None, max_rounds: int = DEFAULT_MAX_ROUNDS,
+                 final_passes=None):
+        assert max_rounds > 0
+        self.root_instant = root_instant
+        self.instants = instants
+        self.passes = list(_opt_passes if passes is None else passes)
+        self.final_passes = list(_final_passes if final_passes is None else final_passes)
+        self.max_rounds = max_rounds
+        self.rounds = 0
+        self.pass_runs = 0
+        self.runs_per_pass = collections.Counter()
+        self.eliminated = collections.Counter()
+        self.converged = False
+        # each pass has its own worklist: the instants that changed since it last looked at them
+        self._dirty = {op: set(instants) for op in self.passes}
+
+    def _mark_dirty(self, changed: set) -> None:
+        for dirty in self._dirty.values():
+            dirty.update(changed)
+
+    def _run_pass(self, op, dirty: set) -> set:
+        with _eliminated.parameterize(self.eliminated):
+            self.root_instant, self.instants, changed = op(self.root_instant, self.instants, dirty)
+        self.pass_runs += 1
+        self.runs_per_pass[op.__name__] += 1
+        return changed
+
+    def run_round(self) -> bool:
+        progress = False
+        for op in self.passes:
+            dirty = self._dirty[op]
+            dirty.intersection_update(self.instants)
+            if not dirty:
+                continue
+            self._dirty[op] = set()
+            changed = self._run_pass(op, dirty)
+            if changed:
+                self._mark_dirty(changed)
+                progress = True
+        return progress
+
+    def _run_to_fixpoint(self) -> None:
+        self.converged = False
+        while self.rounds < self.max_rounds:
+            self.rounds += 1
+            if not self.run_round():
+                self.converged = True
+                break
+
+    def run(self):
+        self._run_to_fixpoint()
+        for op in self.final_passes:
+            changed = self._run_pass(op, set(self.instants))
+            if changed:
+                # let the other passes clean up after it, such as by dropping the instants it emptied
+                self._mark_dirty(changed)
+                self._run_to_fixpoint()
+        return self.root_instant, self.instants
+
+    def stats(self) -> dict:
+        return {"rounds": self.rounds, "pass_runs": self.pass_runs, "converged": self.converged,
+                "runs_per_pass": dict(self.runs_per_pass), "eliminated": dict(self.eliminated)}
+
+
+def optimize(root_instant, instants, max_rounds: int = DEFAULT_MAX_ROUNDS, stats: typing.Optional[dict] = None):
+    # if stats is provided, it is filled in with how many rounds and pass runs the optimizer took, and with what the
+    # passes eliminated
+    detach_unreachable(instants)
+    manager = PassManager(root_instant, instants, max_rounds=max_rounds)
+    root_instant, instants = manager.run()
+    if not manager.converged:
+        print("OPTIMIZER DID NOT CONVERGE AFTER", manager.rounds, "ROUNDS")
+    if stats is not None:
+        stats.update(manager.stats())
     return root_instant, instants
@@ -0,0 +1,99 @@
+import math
+import typing
+
+import themis.cgen
+from themis.cgen import ir
+
+__all__ = ["generate_python", "compile_python"]
+
+PY_OPERATORS = {"!": "not ", "&": "&", "|": "|", "==": "==", "!=": "!=", "+": "+", "-": "-", "*": "*"}
+
+
+def _divide(a, b):
+    # C semantics for double division, rather than raising ZeroDivisionError
+    try:
+        return a / b
+    except ZeroDivisionError:
+        return math.nan if a == 0 or math.isnan(a) else math.copysign(math.inf, a) * math.copysign(1, b)
+
+
+def _value(op) -> str:
+    if isinstance(op, ir.Operator):
+        return "(%s)" % _expr(op)
+    elif isinstance(op, ir.Node):
+        return _expr(op)
+    elif isinstance(op, themis.cgen.Instant):
+        return op._instant
+    elif isinstance(op, themis.cgen.Box):
+        return op._box
+    elif type(op) == float and not math.isfinite(op):
+        return "float(%r)" % str(op)
+    elif type(op) in (bool, int, float):
+        return repr(op)
+    else:
+        assert type(op) == str, "bad application type: %s" % op
+        return op
+
+
+def _expr(node: ir.Node) -> str:
+    if isinstance(node, ir.PolyCall):
+        return "%s(%s)" % (node.func, ", ".join(_value(arg) for arg in node.args))
+    elif isinstance(node, ir.Operator):
+        if node.op == "/":
+            return "_divide(%s, %s)" % (_value(node.left), _value(node.right))
+        op = PY_OPERATORS[node.op]
+        if node.left is None:
+            return "%s%s" % (op, _value(node.right))
+        return "%s %s %s" % (_value(node.left), op.strip(), _value(node.right))
+    else:
+        raise TypeError("%s cannot be used as an expression" % type(node).__name__)
+
+
+def _statement(node: ir.Node) -> typing.Iterator[str]:
+    if isinstance(node, ir.Invoke):
+        yield "%s(%s)" % (node.target._instant, "" if node.arg is None else _value(node.arg))
+    elif isinstance(node, ir.PolyCall):
+        yield _expr(node)
+    elif isinstance(node, (ir.Set, ir.SetDecl)):
+        yield "%s = %s" % (_value(node.variable), _value(node.value))
+    elif isinstance(node, ir.IfThen):
+        yield "if %s:" % _value(node.condition)
+        yield from ("    " + line for line in _statement(node.body))
+    elif isinstance(node, ir.IfElse):
+        yield "if %s:" % _value(node.condition)
+        yield from ("    " + line for line in _statement(node.body_true))
+        yield "else:"
+        yield from ("    " + line for line in _statement(node.body_false))
+    elif isinstance(node, ir.Nop):
+        yield "pass"
+    else:
+        raise TypeError("unknown node type: %s" % type(node).__name__)
+
+
+def _generate_instant(instant: themis.cgen.Instant) -> typing.Iterator[str]:
+    yield "def %s(%s):" % (instant._instant, "" if instant._param_type is None else instant._param)
+    written = sorted((box for box in instant._defs if isinstance(box, themis.cgen.Box)), key=lambda box: box._uid)
+    if written:
+        yield "    global %s" % ", ".join(box._box for box in written)
+    for node in instant._body:
+        yield from ("    " + line for line in _statement(node))
+    if not instant._body:
+        yield "    pass"
+
+
+def generate_python(root_instant: themis.cgen.Instant) -> str:
+    root_instant, instants, boxes = themis.cgen.prepare(root_instant)
+
+    out = ["%s = %s" % (box._box, _value(box._value)) for box in boxes]
+    for instant in instants:
+        out += _generate_instant(instant)
+    out.append("main = %s" % root_instant._instant)
+
+    return "\n".join(out)
+
+
+def compile_python(source: str, runtime: typing.Dict[str, typing.Callable]) -> typing.Callable[[], None]:
+    namespace = dict(runtime)
+    namespace["_divide"] = _divide
+    exec(compile(source, "<themis>", "exec"), namespace)
+    return namespace["main"]
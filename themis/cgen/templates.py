@@ -1,10 +1,23 @@
-def apply(op):
-    if type(op) == tuple:
-        return op[0](*op[1:])
+def encode_value(x) -> str:
+    if type(x) == bool:
+        return "true" if x else "false"
+    elif type(x) == int:
+        return str(x)
+    elif type(x) == float:
+        return str(x)
+    else:
+        assert False
+
+
+def apply(op) -> str:
+    if hasattr(op, "expr"):
+        return op.expr()
     elif hasattr(op, "_instant"):
         return op._instant
     elif hasattr(op, "_box"):
         return op._box
+    elif type(op) in (bool, int, float):
+        return encode_value(op)
     else:
         assert type(op) == str, "bad application type: %s" % op
         return op
@@ -18,41 +31,45 @@ def invoke_nullary(target) -> str:
     return "%s();" % (apply(target),)
 
 
-def invoke_unary(target, param: str) -> str:
-    # TODO: find a better way to handle semicolons than stripping them off
-    return "%s(%s);" % (apply(target), apply(param).rstrip(";"))
+def invoke_unary(target, param) -> str:
+    return "%s(%s);" % (apply(target), apply(param))
 
 
-def invoke_poly(target, args: list) -> str:
-    return "%s(%s);" % (apply(target), ", ".join(apply(arg).rstrip(";") for arg in args))
+def call(target, args) -> str:
+    return "%s(%s)" % (apply(target), ", ".join(apply(arg) for arg in args))
 
 
-def set(variable, value: str) -> str:
-    return "%s = %s;" % (apply(variable), apply(value).rstrip(";"))
+def invoke_poly(target, args) -> str:
+    return "%s;" % (call(target, args),)
 
 
-def set_decl(var_type: str, variable, value: str) -> str:
-    return "%s %s = %s;" % (var_type, apply(variable), apply(value).rstrip(";"))
+def set(variable, value) -> str:
+    return "%s = %s;" % (apply(variable), apply(value))
 
 
-def if_then(condition, body) -> str:
-    return "if (%s) {\n%s\n}" % (apply(condition), indent(apply(body)))
+def set_decl(var_type: str, variable, value) -> str:
+    return "%s %s = %s;" % (var_type, apply(variable), apply(value))
 
 
-def if_else(condition, body_true, body_false) -> str:
-    return "if (%s) {\n%s\n} else {\n%s\n}" % (apply(condition), indent(apply(body_true)), indent(apply(body_false)))
+def if_then(condition, body: str) -> str:
+    return "if (%s) {\n%s\n}" % (apply(condition), indent(body))
 
 
-def operator(a, op: str, b) -> str:
-    return "%s %s %s" % (apply(a), op, apply(b))
+def if_else(condition, body_true: str, body_false: str) -> str:
+    return "if (%s) {\n%s\n} else {\n%s\n}" % (apply(condition), indent(body_true), indent(body_false))
 
 
-def equals(a, b) -> str:
-    return "%s == %s" % (apply(a), apply(b))
+def _operand(x) -> str:
+    # nested operators need explicit grouping
+    return "(%s)" % apply(x) if hasattr(x, "op") else apply(x)
 
 
-def not_equals(a, b) -> str:
-    return "%s != %s" % (apply(a), apply(b))
+def operator(a, op: str, b) -> str:
+    if a is None:
+        return "%s%s" % (op, _operand(b))
+    elif b is None:
+        return "%s%s" % (_operand(a), op)
+    return "%s %s %s" % (_operand(a), op, _operand(b))
 
 
 def nop() -> str:
@@ -3,6 +3,8 @@ import typing
 import themis.channel.event
 import themis.codegen
 import themis.cgen
+import themis.propagation
+import themis.timers
 import themis.util
 
 __all__ = ["BooleanOutput", "BooleanInput", "boolean_cell", "always_boolean"]
@@ -24,6 +26,27 @@ class BooleanOutput:
         instant.transform(filter_func, self.get_ref(), *pre_args, themis.cgen.Param, *post_args)
         return BooleanOutput(instant)
 
+    def suppress_unchanged(self, refresh_ms: int = None) -> "BooleanOutput":
+        # only passes on values that differ from the last one passed on. with refresh_ms, the last value is also passed
+        # on again that often, so that whatever is downstream keeps being fed.
+        last = themis.cgen.Box(False)
+        written = themis.cgen.Box(False)
+
+        write = themis.cgen.Instant(bool)
+        write.set(last, themis.cgen.Param)
+        write.set(written, True)
+        write.invoke(self.get_ref(), themis.cgen.Param)
+
+        compare = themis.cgen.Instant(bool)
+        compare.if_unequal(themis.cgen.Param, last, write, themis.cgen.Param)
+
+        guard = themis.cgen.Instant(bool)
+        guard.if_else(written, True, compare, write, themis.cgen.Param, themis.cgen.Param)
+
+        if refresh_ms is not None:
+            themis.timers.ticker(refresh_ms).get_instant().if_equal(written, True, self.get_ref(), last)
+        return BooleanOutput(guard)
+
     @property
     @themis.util.memoize_field
     def set_true(self) -> "themis.channel.event.EventOutput":
@@ -45,7 +68,6 @@ class BooleanInput:
         assert isinstance(default_value, bool)
         self._instant = instant
         self._default_value = default_value
-        # TODO: cache the current value in a shared way, rather than having each user of the current value track it separately.
 
     def send(self, output: BooleanOutput) -> None:
         assert isinstance(output, BooleanOutput)
@@ -55,17 +77,26 @@ class BooleanInput:
     def __bool__(self):
         raise TypeError("Cannot convert IO channels to bool")
 
+    @themis.util.memoize_field
+    def _value_tracker(self) -> "typing.Tuple[themis.cgen.Box, themis.cgen.Instant]":
+        # the one Box holding the last-seen value of this channel, shared by everything that needs it. it's only
+        # stored when the value changes, so that press and release can compare against the previous value first.
+        last_value = themis.cgen.Box(self._default_value)
+        on_change = themis.cgen.Instant(bool)
+        self._instant.if_unequal(themis.cgen.Param, last_value, on_change, themis.cgen.Param)
+        on_change.set(last_value, themis.cgen.Param)
+        return last_value, on_change
+
+    def _value_box(self) -> themis.cgen.Box:
+        return self._value_tracker()[0]
+
     @themis.util.memoize_field
     def _press_and_release(self) -> "typing.Tuple[themis.channel.event.EventInput, themis.channel.event.EventInput]":
         become_true = themis.cgen.Instant(None)
         become_false = themis.cgen.Instant(None)
 
-        last_value = themis.cgen.Box(self._default_value)
-
-        on_update = themis.cgen.Instant(bool)
-        self._instant.if_unequal(themis.cgen.Param, last_value, on_update, themis.cgen.Param)
-        on_update.set(last_value, themis.cgen.Param)
-        on_update.if_else(themis.cgen.Param, True, become_true, become_false)
+        on_change = self._value_tracker()[1]
+        on_change.if_else(themis.cgen.Param, True, become_true, become_false)
 
         return themis.channel.event.EventInput(become_true), themis.channel.event.EventInput(become_false)
 
@@ -79,22 +110,21 @@ class BooleanInput:
 
     def choose_float(self, when_false: "themis.channel.float.FloatInput", when_true: "themis.channel.float.FloatInput") \
             -> "themis.channel.float.FloatInput":
+        key = (self._instant, "choose_float", when_false._instant, when_true._instant)
+        return themis.codegen.intern_expression(key, lambda: self._choose_float(when_false, when_true))
+
+    def _choose_float(self, when_false: "themis.channel.float.FloatInput",
+                      when_true: "themis.channel.float.FloatInput") -> "themis.channel.float.FloatInput":
         # TODO: do default values without accessing private fields
         cell_out, cell_in = themis.channel.float.float_cell(when_true._default_value if self._default_value else
                                                             when_false._default_value)
 
-        condition = themis.cgen.Box(self._default_value)
-        var_true = themis.cgen.Box(when_true._default_value)
-        var_false = themis.cgen.Box(when_false._default_value)
-
-        self._instant.set(condition, themis.cgen.Param)
-        self._instant.transform("choose_float", cell_out.get_ref(), condition, var_true, var_false)
-
-        when_true._instant.set(var_true, themis.cgen.Param)
-        when_true._instant.transform("choose_float", cell_out.get_ref(), condition, var_true, var_false)
+        condition, var_true, var_false = self._value_box(), when_true._value_box(), when_false._value_box()
 
-        when_false._instant.set(var_false, themis.cgen.Param)
-        when_false._instant.transform("choose_float", cell_out.get_ref(), condition, var_true, var_false)
+        inputs = (self, when_true) if when_false is when_true else (self, when_true, when_false)
+        themis.propagation.combine([input._instant for input in inputs],
+                                   lambda instant: instant.transform("choose_float", cell_out.get_ref(),
+                                                                     condition, var_true, var_false))
 
         return cell_in
 
@@ -124,16 +154,11 @@ class BooleanInput:
                 return self
             else:
                 return always_boolean(False)
+        elif other is self:
+            return self
         elif isinstance(other, BooleanInput):
-            cell_out, cell_in = boolean_cell(self._default_value and other._default_value)
-
-            value_self = themis.cgen.Box(self._default_value)
-            value_other = themis.cgen.Box(other._default_value)
-
-            for value, input in zip((value_self, value_other), (self, other)):
-                input._instant.set(value, themis.cgen.Param)
-                input._instant.operator_transform("&", cell_out.get_ref(), value_self, value_other)
-            return cell_in
+            return themis.codegen.intern_expression((frozenset((self._instant, other._instant)), "&"),
+                                                    lambda: self._and(other))
         else:
             return NotImplemented
 
@@ -147,6 +172,16 @@ class BooleanInput:
             assert not isinstance(other, BooleanInput), "should have dispatched to __and__"
             return NotImplemented
 
+    def _and(self, other: "BooleanInput") -> "BooleanInput":
+        cell_out, cell_in = boolean_cell(self._default_value and other._default_value)
+
+        value_self, value_other = self._value_box(), other._value_box()
+
+        themis.propagation.combine([self._instant, other._instant],
+                                   lambda instant: instant.operator_transform("&", cell_out.get_ref(),
+                                                                              value_self, value_other))
+        return cell_in
+
 
 class InvertedBooleanInput(BooleanInput):
     def __init__(self, instant: themis.cgen.Instant, default_value: bool, base: BooleanInput):
@@ -175,19 +210,16 @@ class BooleanIO:
     @property
     @themis.util.memoize_field
     def toggle(self) -> "themis.channel.event.EventOutput":
-        last_value = themis.cgen.Box(self.input._default_value)
-        self.input._instant.set(last_value, themis.cgen.Param)
-
         instant = themis.cgen.Instant(None)
-        instant.operator_transform("!", self.output.get_ref(), None, last_value)
+        instant.operator_transform("!", self.output.get_ref(), None, self.input._value_box())
         return themis.channel.event.EventOutput(instant)
 
 
-# TODO: should we be doing deduplication in cells? probably.
 def boolean_cell(default_value) -> BooleanIO:
     instant = themis.cgen.Instant(bool)
     return BooleanIO(BooleanOutput(instant), BooleanInput(instant, default_value))
 
 
 def always_boolean(value):
-    return boolean_cell(value).input
+    # nothing can ever send to these cells, so every use of the same constant can share one
+    return themis.codegen.intern_expression(("always", bool(value)), lambda: boolean_cell(value).input)
@@ -67,6 +67,9 @@ class DiscreteInput:
         raise TypeError("Cannot convert IO channels to bool")
 
     def is_value(self, value: str) -> "themis.channel.boolean.BooleanInput":
+        return themis.codegen.intern_expression((self._instant, "==", value), lambda: self._is_value(value))
+
+    def _is_value(self, value: str) -> "themis.channel.boolean.BooleanInput":
         value_int = self.discrete_type.numeric(value)
         instant = themis.cgen.Instant(bool)
         self._instant.operator_transform("==", instant, themis.cgen.Param, value_int)
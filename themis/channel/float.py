@@ -3,6 +3,10 @@ import math
 
 import themis.codegen
 import themis.cgen
+import themis.cgen.helpers
+import themis.propagation
+import themis.timers
+import themis.util
 
 __all__ = ["FloatOutput", "FloatInput", "float_cell", "always_float"]
 
@@ -45,7 +49,6 @@ class FloatOutput:
     # note: different ramping scale than the CCRE
     # TODO: handle default targets better
     def add_ramping(self, change_per_second: float, update_rate_ms=None, default_target=0) -> "FloatOutput":
-        import themis.timers
         update_rate_ms = update_rate_ms or 10
         ticker = themis.timers.ticker(update_rate_ms)
         max_delta = (change_per_second * (update_rate_ms / 1000.0))
@@ -63,6 +66,38 @@ class FloatOutput:
 
         return FloatOutput(update_target)
 
+    def suppress_unchanged(self, epsilon: float = 0.0, refresh_ms: int = None,
+                           refresh_to: "FloatOutput" = None) -> "FloatOutput":
+        # only passes on values that differ from the last one passed on by more than epsilon. with refresh_ms, the last
+        # value is also passed on again that often, to refresh_to if given, so that whatever is downstream keeps being
+        # fed.
+        assert isinstance(epsilon, (int, float)) and epsilon >= 0
+        last = themis.cgen.Box(0.0)
+        pending = themis.cgen.Box(0.0)
+        written = themis.cgen.Box(False)
+
+        write = themis.cgen.Instant(None)
+        write.set(last, pending)
+        write.set(written, True)
+        write.invoke(self.get_ref(), pending)
+
+        check = themis.cgen.Instant(bool)
+        check.if_equal(themis.cgen.Param, True, write)
+
+        compare = themis.cgen.Instant(None)
+        compare.transform("float_changed", check, last, pending, float(epsilon))
+
+        guard = themis.cgen.Instant(float)
+        guard.set(pending, themis.cgen.Param)
+        guard.if_else(written, True, compare, write)
+
+        if refresh_ms is not None:
+            target = self if refresh_to is None else refresh_to
+            themis.timers.ticker(refresh_ms).get_instant().if_equal(written, True, target.get_ref(), last)
+        else:
+            assert refresh_to is None, "refresh_to only applies with refresh_ms"
+        return FloatOutput(guard)
+
     def __add__(self, other: "FloatOutput") -> "FloatOutput":
         if not isinstance(other, FloatOutput):
             return NotImplemented
@@ -112,6 +147,13 @@ class FloatInput:
         self._instant = instant
         self._default_value = float(default_value)
 
+    @themis.util.memoize_field
+    def _value_box(self) -> themis.cgen.Box:
+        # the one Box holding the last-seen value of this channel, shared by everything that needs it
+        last_value = themis.cgen.Box(self._default_value)
+        self._instant.set(last_value, themis.cgen.Param)
+        return last_value
+
     def send(self, output: FloatOutput) -> None:
         assert isinstance(output, FloatOutput)
         # TODO: default value?
@@ -121,19 +163,29 @@ class FloatInput:
         raise TypeError("Cannot convert IO channels to bool")
 
     def filter(self, filter_func, pre_args=(), post_args=()) -> "FloatInput":
+        if filter_func not in themis.cgen.helpers.PURE_HELPERS:
+            # might have side effects, so every use gets its own call
+            return self._filter(filter_func, pre_args, post_args)
+        key = (self._instant, "filter", filter_func, tuple(pre_args), tuple(post_args))
+        return themis.codegen.intern_expression(key, lambda: self._filter(filter_func, pre_args, post_args))
+
+    def _filter(self, filter_func, pre_args, post_args) -> "FloatInput":
         cell_out, cell_in = float_cell(0)  # TODO: default value
         self.send(cell_out.filter(filter_func=filter_func, pre_args=pre_args, post_args=post_args))
         return cell_in
 
     def operation(self, filter_op, other: "FloatInput") -> "FloatInput":
+        return themis.codegen.intern_expression((self._instant, filter_op, other._instant),
+                                                lambda: self._operation(filter_op, other))
+
+    def _operation(self, filter_op, other: "FloatInput") -> "FloatInput":
         cell_out, cell_in = float_cell(_run_filter_op(self._default_value, filter_op, other._default_value))
 
-        value_self = themis.cgen.Box(self._default_value)
-        value_other = themis.cgen.Box(other._default_value)
+        value_self, value_other = self._value_box(), other._value_box()
 
-        for value, input in zip((value_self, value_other), (self, other)):
-            input._instant.set(value, themis.cgen.Param)
-            input._instant.operator_transform(filter_op, cell_out.get_ref(), value_self, value_other)
+        themis.propagation.combine([self._instant] if other is self else [self._instant, other._instant],
+                                   lambda instant: instant.operator_transform(filter_op, cell_out.get_ref(),
+                                                                              value_self, value_other))
         return cell_in
 
     def deadzone(self, zone: float) -> "FloatInput":
@@ -141,23 +193,40 @@ class FloatInput:
 
     # note: different ramping scale than the CCRE
     def with_ramping(self, change_per_second: float, update_rate_ms=None) -> "FloatInput":
+        return themis.codegen.intern_expression((self._instant, "ramping", float(change_per_second), update_rate_ms),
+                                                lambda: self._with_ramping(change_per_second, update_rate_ms))
+
+    def _with_ramping(self, change_per_second: float, update_rate_ms) -> "FloatInput":
         cell_out, cell_in = float_cell(0)  # TODO: default value
         self.send(cell_out.add_ramping(change_per_second, update_rate_ms=update_rate_ms,
                                        default_target=0))
         return cell_in
 
+    def constant_operation(self, filter_op, constant: float, reverse=False) -> "FloatInput":
+        constant = float(constant)
+        return themis.codegen.intern_expression((self._instant, filter_op, constant, reverse),
+                                                lambda: self._constant_operation(filter_op, constant, reverse))
+
+    def _constant_operation(self, filter_op, constant: float, reverse) -> "FloatInput":
+        if reverse:
+            default_value = _run_filter_op(constant, filter_op, self._default_value)
+        else:
+            default_value = _run_filter_op(self._default_value, filter_op, constant)
+        cell_out, cell_in = float_cell(default_value)
+        if reverse:
+            self._instant.operator_transform(filter_op, cell_out.get_ref(), constant, themis.cgen.Param)
+        else:
+            self._instant.operator_transform(filter_op, cell_out.get_ref(), themis.cgen.Param, constant)
+        return cell_in
+
     def _arith_op(self, op, other, reverse):
         if isinstance(other, (int, float)):
-            other = float(other)
-            if reverse:
-                return self.filter(op, other)
-            else:
-                return self.filter(op, pre_args=(other,))
+            return self.constant_operation(op, other, reverse)
         elif isinstance(other, FloatInput):
             if reverse:
-                return self.operation(op, other)
-            else:
                 return other.operation(op, self)
+            else:
+                return self.operation(op, other)
         else:
             return NotImplemented
 
@@ -186,6 +255,9 @@ class FloatInput:
         return self._arith_op("/", other, True)
 
     def __neg__(self):
+        return themis.codegen.intern_expression((self._instant, "neg"), self._negate)
+
+    def _negate(self) -> "FloatInput":
         cell_out, cell_in = float_cell(-self._default_value)
         self.send(-cell_out)
         return cell_in
@@ -197,4 +269,5 @@ def float_cell(default_value) -> typing.Tuple[FloatOutput, FloatInput]:
 
 
 def always_float(value) -> FloatInput:
-    return float_cell(value)[1]
+    # nothing can ever send to these cells, so every use of the same constant can share one
+    return themis.codegen.intern_expression(("always", float(value)), lambda: float_cell(value)[1])
@@ -1,6 +1,8 @@
 import enum
+import json
 
 import themis.cgen
+import themis.cgen.pygen
 import themis.util
 
 
@@ -11,10 +13,22 @@ class InitPhase(enum.Enum):
     PHASE_BEGIN = 4
 
 
+def _expression_key(part):
+    if isinstance(part, tuple):
+        return tuple(_expression_key(element) for element in part)
+    elif isinstance(part, (bool, int, float)):
+        # keep True, 1, and 1.0 apart, and also 0.0 and -0.0
+        return type(part), repr(part)
+    else:
+        return part
+
+
 class GenerationContext:
     _context_param = themis.util.Parameter(None)
 
-    def __init__(self):
+    def __init__(self, topological=False):
+        # see themis.propagation
+        self.topological = topological
         self._root_init = themis.cgen.Instant(None)
         self._initialize = themis.cgen.Instant(None)
         self._root_init.transform("enter_loop", None, self._initialize)
@@ -24,6 +38,13 @@ class GenerationContext:
             self._initialize.invoke(inst)
             self._init_phases[phase] = inst
         self._properties = {}
+        self._interned = {}
+        self._finalizers = []
+        self._late_finalizers = []
+        self.profiled_instants = None
+        self.source_map = {}
+        self.symbols = {}  # generated name -> Box or Instant, once code has been generated
+        self.optimizer_stats = {}  # rounds, pass runs and eliminations, once code has been generated
 
     def add_init(self, instant: themis.cgen.Instant, phase: InitPhase, arg=None):
         self._init_phases[phase].invoke(instant, arg)
@@ -31,8 +52,42 @@ class GenerationContext:
     def add_init_call(self, target, phase: InitPhase, *args):
         self._init_phases[phase].transform(target, None, *args)
 
-    def generate_code(self):
-        return themis.cgen.generate_code(self._root_init)
+    def add_finalizer(self, finalizer, late=False):
+        # called once the whole graph has been built, before code is first generated. late finalizers only run once
+        # all of the others have, so they see everything that the others added.
+        (self._late_finalizers if late else self._finalizers).append(finalizer)
+
+    def _finalize(self):
+        while self._finalizers or self._late_finalizers:
+            (self._finalizers or self._late_finalizers).pop(0)()
+
+    def generate_code(self, profile=False, line_directives=False):
+        self._finalize()
+        self.profiled_instants = [] if profile else None
+        return themis.cgen.generate_code(self._root_init, self.profiled_instants, line_directives, self.source_map,
+                                         self.symbols, self.optimizer_stats)
+
+    def generate_units(self, units, profile=False, line_directives=False):
+        self._finalize()
+        self.profiled_instants = [] if profile else None
+        return themis.cgen.generate_units(self._root_init, units, self.profiled_instants, line_directives,
+                                          self.source_map, self.symbols, self.optimizer_stats)
+
+    def write_source_map(self, path):
+        # maps each generated instantN/boxN to the robot code line that created it
+        with open(path, "w") as fout:
+            json.dump(self.source_map, fout, indent=1, sort_keys=True)
+
+    def generate_python(self):
+        self._finalize()
+        return themis.cgen.pygen.generate_python(self._root_init)
+
+    def intern_expression(self, key, producer):
+        # structurally identical channel expressions share a single node, keyed on (source, operation, constants)
+        key = _expression_key(key)
+        if key not in self._interned:
+            self._interned[key] = producer()
+        return self._interned[key]
 
     def get_prop_init(self, key, default_producer):
         if key not in self._properties:
@@ -64,13 +119,33 @@ def add_init_call(target, phase: InitPhase, *args):
     GenerationContext.get_context().add_init_call(target, phase, *args)
 
 
+def add_finalizer(finalizer, late=False):
+    GenerationContext.get_context().add_finalizer(finalizer, late)
+
+
 def get_prop_init(key, default_producer):
     return GenerationContext.get_context().get_prop_init(key, default_producer)
 
 
+def intern_expression(key, producer):
+    return GenerationContext.get_context().intern_expression(key, producer)
+
+
 def get_prop(key):
     return GenerationContext.get_context().get_prop(key)
 
 
-def generate_code():
-    return GenerationContext.get_context().generate_code()
+def generate_code(profile=False, line_directives=False):
+    return GenerationContext.get_context().generate_code(profile, line_directives)
+
+
+def generate_units(units, profile=False, line_directives=False):
+    return GenerationContext.get_context().generate_units(units, profile, line_directives)
+
+
+def write_source_map(path):
+    GenerationContext.get_context().write_source_map(path)
+
+
+def generate_python():
+    return GenerationContext.get_context().generate_python()
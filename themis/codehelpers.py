@@ -4,12 +4,23 @@ import themis.cgen
 
 
 def poll_float(event: themis.channel.EventInput, poll_func, args, default_value: float) -> themis.channel.FloatInput:
+    return themis.codegen.intern_expression((event.get_instant(), poll_func, tuple(args), default_value),
+                                            lambda: _poll_float(event, poll_func, args, default_value))
+
+
+def _poll_float(event: themis.channel.EventInput, poll_func, args, default_value: float) -> themis.channel.FloatInput:
     dispatch = themis.cgen.Instant(float)
     event.get_instant().transform(poll_func, dispatch, *args)
     return themis.channel.float.FloatInput(dispatch, default_value)
 
 
 def poll_boolean(event: themis.channel.EventInput, poll_func, args, default_value: bool) -> themis.channel.BooleanInput:
+    return themis.codegen.intern_expression((event.get_instant(), poll_func, tuple(args), default_value),
+                                            lambda: _poll_boolean(event, poll_func, args, default_value))
+
+
+def _poll_boolean(event: themis.channel.EventInput, poll_func, args,
+                  default_value: bool) -> themis.channel.BooleanInput:
     dispatch = themis.cgen.Instant(bool)
     event.get_instant().transform(poll_func, dispatch, *args)
     return themis.channel.boolean.BooleanInput(dispatch, default_value)
@@ -17,18 +28,42 @@ def poll_boolean(event: themis.channel.EventInput, poll_func, args, default_valu
 
 def poll_discrete(event: themis.channel.EventInput, poll_func, args, default_value: str,
                   discrete_type: themis.channel.Discrete) -> themis.channel.DiscreteInput:
+    key = (event.get_instant(), poll_func, tuple(args), default_value, discrete_type)
+    return themis.codegen.intern_expression(key, lambda: _poll_discrete(event, poll_func, args, default_value,
+                                                                        discrete_type))
+
+
+def _poll_discrete(event: themis.channel.EventInput, poll_func, args, default_value: str,
+                   discrete_type: themis.channel.Discrete) -> themis.channel.DiscreteInput:
     dispatch = themis.cgen.Instant(int)
     event.get_instant().transform(poll_func, dispatch, *args)
     return themis.channel.discrete.DiscreteInput(dispatch, default_value, discrete_type)
 
 
-def push_float(update_func, extra_args) -> themis.channel.FloatOutput:
+def push_float(update_func, extra_args, suppress_unchanged: bool = False, epsilon: float = 0.0,
+               refresh_ms: int = None, refresh_func=None) -> themis.channel.FloatOutput:
+    # refresh_func, if given, is called in place of update_func for the periodic refreshes
     instant = themis.cgen.Instant(float)
     instant.transform(update_func, None, themis.cgen.Param, *extra_args)
-    return themis.channel.float.FloatOutput(instant)
+    output = themis.channel.float.FloatOutput(instant)
+    if suppress_unchanged:
+        refresh_to = None
+        if refresh_func is not None:
+            refresh = themis.cgen.Instant(float)
+            refresh.transform(refresh_func, None, themis.cgen.Param, *extra_args)
+            refresh_to = themis.channel.float.FloatOutput(refresh)
+        return output.suppress_unchanged(epsilon, refresh_ms, refresh_to)
+    assert epsilon == 0.0 and refresh_ms is None and refresh_func is None, \
+        "epsilon, refresh_ms and refresh_func only apply with suppress_unchanged"
+    return output
 
 
-def push_boolean(update_func, extra_args) -> themis.channel.BooleanOutput:
+def push_boolean(update_func, extra_args, suppress_unchanged: bool = False,
+                 refresh_ms: int = None) -> themis.channel.BooleanOutput:
     instant = themis.cgen.Instant(bool)
     instant.transform(update_func, None, themis.cgen.Param, *extra_args)
-    return themis.channel.boolean.BooleanOutput(instant)
\ No newline at end of file
+    output = themis.channel.boolean.BooleanOutput(instant)
+    if suppress_unchanged:
+        return output.suppress_unchanged(refresh_ms)
+    assert refresh_ms is None, "refresh_ms only applies with suppress_unchanged"
+    return output
@@ -1,3 +1,7 @@
+import os
+import re
+import subprocess
+import tempfile
 import typing
 import binascii
 
@@ -6,8 +10,13 @@ import themis.auto
 import themis.channel
 import themis.codegen
 import themis.codehelpers
+import themis.cgen
+import themis.cgen.pygen
+import themis.host
 import themis.joystick
+import themis.profile
 import themis.pwm
+import themis.size
 import themis.timers
 
 Mode = themis.channel.Discrete("DISABLED AUTONOMOUS TELEOP TESTING")
@@ -20,6 +29,7 @@ PCM_NUM = 63
 SOLENOID_NUM = 8
 GPIO_NUM = 26
 INTERRUPT_NUM = 8
+OUTPUT_REFRESH_MS = 100  # how often outputs that haven't changed are written again anyway
 
 
 class RoboRIO:
@@ -91,39 +101,46 @@ class PWM:
         else:
             return 3  # full squelching: 49.5 Hz
 
-    def talon_sr(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.TALON_SR)
+    def talon_sr(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.TALON_SR, suppress_unchanged=suppress_unchanged)
 
-    def jaguar(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.JAGUAR)
+    def jaguar(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.JAGUAR, suppress_unchanged=suppress_unchanged)
 
-    def victor_old(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.VICTOR_OLD)
+    def victor_old(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.VICTOR_OLD, suppress_unchanged=suppress_unchanged)
 
-    def servo(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.SERVO, latch_zero=True)
+    def servo(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.SERVO, latch_zero=True, suppress_unchanged=suppress_unchanged)
 
-    def victor_sp(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.VICTOR_SP)
+    def victor_sp(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.VICTOR_SP, suppress_unchanged=suppress_unchanged)
 
-    def spark(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.SPARK)
+    def spark(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.SPARK, suppress_unchanged=suppress_unchanged)
 
-    def sd540(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.SD540)
+    def sd540(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.SD540, suppress_unchanged=suppress_unchanged)
 
-    def talon_srx(self, pwm_id: int) -> themis.channel.FloatOutput:
-        return self.pwm_controller(pwm_id, themis.pwm.TALON_SRX)
+    def talon_srx(self, pwm_id: int, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return self.pwm_controller(pwm_id, themis.pwm.TALON_SRX, suppress_unchanged=suppress_unchanged)
 
     def pwm_controller(self, pwm_id: int, specs: themis.pwm.SpeedControlSpecs,
-                       latch_zero: bool = False) -> themis.channel.FloatOutput:
-        return themis.pwm.filter_to(specs, self.pwm_raw(pwm_id, specs.frequency_hz, latch_zero=latch_zero))
+                       latch_zero: bool = False, suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
+        return themis.pwm.filter_to(specs, self.pwm_raw(pwm_id, specs.frequency_hz, latch_zero=latch_zero,
+                                                        suppress_unchanged=suppress_unchanged))
 
-    def pwm_raw(self, pwm_id: int, frequency: float, latch_zero: bool = False) -> themis.channel.FloatOutput:
+    # with suppress_unchanged, only changed values are passed on, plus the last value again every OUTPUT_REFRESH_MS
+    def pwm_raw(self, pwm_id: int, frequency: float, latch_zero: bool = False,
+                suppress_unchanged: bool = False) -> themis.channel.FloatOutput:
         assert 0 <= pwm_id < PWM_NUM
         squelch = self._frequency_to_squelch(frequency)
         themis.codegen.add_init_call("pwm_init", themis.codegen.InitPhase.PHASE_INIT_IO, pwm_id, squelch, latch_zero)
-        return themis.codehelpers.push_float("pwm_update", extra_args=(pwm_id,))
+        # staged, so that however many times one event updates a channel, only its final value is written. refreshes
+        # go through pwm_refresh, so that they reach the hardware even though the value hasn't changed.
+        return themis.codehelpers.push_float("pwm_stage", extra_args=(pwm_id,), suppress_unchanged=suppress_unchanged,
+                                             refresh_ms=OUTPUT_REFRESH_MS if suppress_unchanged else None,
+                                             refresh_func="pwm_refresh" if suppress_unchanged else None)
 
 
 class CAN:  # TODO: implement!
@@ -137,11 +154,14 @@ class PCM:
         assert 0 <= pcm_id < PCM_NUM
         self._id = pcm_id
 
-    def solenoid(self, solenoid_id):
+    # with suppress_unchanged, only changed values are passed on, plus the last value again every OUTPUT_REFRESH_MS
+    def solenoid(self, solenoid_id, suppress_unchanged: bool = False):
         assert 0 <= solenoid_id < SOLENOID_NUM
         themis.codegen.add_init_call("solenoid_init", themis.codegen.InitPhase.PHASE_INIT_IO, self._id,
                                      solenoid_id)
-        return themis.codehelpers.push_boolean("solenoid_update", extra_args=(self._id, solenoid_id))
+        return themis.codehelpers.push_boolean("solenoid_update", extra_args=(self._id, solenoid_id),
+                                               suppress_unchanged=suppress_unchanged,
+                                               refresh_ms=OUTPUT_REFRESH_MS if suppress_unchanged else None)
 
 
 class DriverStation:
@@ -153,7 +173,7 @@ class DriverStation:
 
     def get_mode(self) -> themis.channel.DiscreteInput:
         if self._get_mode is None:
-            self._get_mode = themis.codehelpers.poll_discrete(self._update, "get_robot_mode", (), Mode.DISABLED, Mode)
+            self._get_mode = themis.codehelpers.poll_discrete(self._update, "ds_mode", (), Mode.DISABLED, Mode)
         return self._get_mode
 
     def joystick(self, i):
@@ -168,18 +188,23 @@ class Joystick(themis.joystick.Joystick):
         self._buttons = [None] * MAX_BUTTON_NUM
 
     def _make_axis(self, i) -> themis.channel.FloatInput:
-        return themis.codehelpers.poll_float(self._update, "get_joystick_axis", (self._index, i), 0)
+        return themis.codehelpers.poll_float(self._update, "ds_axis", (self._index, i), 0)
 
     def _make_button(self, i) -> themis.channel.BooleanInput:
-        return themis.codehelpers.poll_boolean(self._update, "get_joystick_button", (self._index, i), False)
+        return themis.codehelpers.poll_boolean(self._update, "ds_button", (self._index, i), False)
 
+    # the snapshot accessors in themis.h don't check their indices, so they are checked here, before any code uses them
     def axis(self, axis_num) -> themis.channel.FloatInput:
+        if not 1 <= axis_num <= AXIS_NUM:
+            raise Exception("Joystick axis out of range: %s (must be 1 to %d)" % (axis_num, AXIS_NUM))
         axis_num -= 1
         if self._axes[axis_num] is None:
             self._axes[axis_num] = self._make_axis(axis_num)
         return self._axes[axis_num]
 
     def button(self, button_num) -> themis.channel.BooleanInput:
+        if not 1 <= button_num <= MAX_BUTTON_NUM:
+            raise Exception("Joystick button out of range: %s (must be 1 to %d)" % (button_num, MAX_BUTTON_NUM))
         button_num -= 1
         if self._buttons[button_num] is None:
             self._buttons[button_num] = self._make_button(button_num)
@@ -197,18 +222,158 @@ def deploy_roboRIO(team_number: int, code):
 
 
 GCC_PREFIX = "arm-frc-linux-gnueabi-"
-# note: these flags are duplicated in themis-frc-hal/CMakeLists.txt
-C_FLAGS = "-Wformat=2 -Wall -Wextra -Werror -pedantic -Wno-psabi -Wno-unused-parameter -fPIC -Os -g0 -rdynamic " \
-          "-std=c11 -D_POSIX_C_SOURCE=199309L"
-
-
-def compile_roboRIO(c_code):
-    return themis.cbuild.build_program(c_code, "themis.h", "libthemis-frc.so", GCC_PREFIX, C_FLAGS, __name__)
-
-
-def robot(team_number: int, robot_constructor: typing.Callable[[RoboRIO], None]):
+# note: these flags are duplicated in themis-frc-hal/CMakeLists.txt, which always builds the runtime with -Os
+C_FLAGS = "-Wformat=2 -Wall -Wextra -Werror -pedantic -Wno-psabi -Wno-unused-parameter -fPIC -g0 -rdynamic " \
+          "-std=c11 -D_POSIX_C_SOURCE=200112L"
+DEFAULT_BUILD_PROFILE = "size"  # see themis.cbuild.BUILD_PROFILES
+
+
+HOST_GCC_PREFIX = ""
+HOST_C_FLAGS = "-Wformat=2 -Wall -Wextra -Werror -pedantic -Wno-unused-parameter -g0 -pthread " \
+               "-std=c11 -D_POSIX_C_SOURCE=200112L"
+HOST_RUNTIME_SOURCES = ("themis.c", "runloop.c", "timers.c", "profile.c", "ds.c", "frc_stub.c")
+HOST_LIBS = ("m",)
+HOST_EPOLL_FLAGS = "-DTHEMIS_RUNLOOP_EPOLL"
+
+
+def compile_roboRIO(c_code, build_profile: str = DEFAULT_BUILD_PROFILE, symbol_sizes: typing.Optional[dict] = None):
+    # the runtime stays in libthemis-frc.so, which links against the NI libraries, so the build profile only applies to
+    # the generated code
+    cflags = themis.cbuild.profile_flags(C_FLAGS, build_profile)
+    return themis.cbuild.build_program(c_code, "themis.h", "libthemis-frc.so", GCC_PREFIX, cflags, __name__,
+                                       cache=themis.cbuild.default_cache(), symbol_sizes=symbol_sizes)
+
+
+def compile_host(c_code, epoll_runloop: bool = False, build_profile: str = DEFAULT_BUILD_PROFILE,
+                 pgo_input: typing.Optional[str] = None, symbol_sizes: typing.Optional[dict] = None):
+    # if pgo_input is the path to a host input file (see frc_stub.c), the build is optimized using a profile recorded
+    # while running it
+    cflags = HOST_C_FLAGS + " " + HOST_EPOLL_FLAGS if epoll_runloop else HOST_C_FLAGS
+    cflags = themis.cbuild.profile_flags(cflags, build_profile)
+    pgo_workload = None if pgo_input is None else lambda binary_path: run_host_workload(binary_path, pgo_input)
+    return themis.cbuild.build_host_program(c_code, "themis.h", HOST_RUNTIME_SOURCES, HOST_GCC_PREFIX, cflags,
+                                            HOST_LIBS, __name__, cache=themis.cbuild.default_cache(),
+                                            pgo_workload=pgo_workload, symbol_sizes=symbol_sizes)
+
+
+def write_synthetic_workload(path: str, packets: int = 2000) -> None:
+    # teleop packets that sweep the axes and cycle the buttons of the first two joysticks, each dispatched on its own
+    with open(path, "w") as fout:
+        fout.write("mode %d\n" % Mode.numeric(Mode.TELEOP))
+        for i in range(packets):
+            for joystick in range(2):
+                for axis in range(6):
+                    value = ((i * (axis + 1) + joystick * 50) % 201 - 100) / 100
+                    fout.write("axis %d %d %f\n" % (joystick, axis, value))
+                for button in range(12):
+                    fout.write("button %d %d %d\n" % (joystick, button, (i >> (button % 4)) & 1))
+            fout.write("packet\nsync\n")
+        fout.write("quit\n")
+
+
+def run_host_workload(binary_path: str, input_path: str) -> typing.Dict[str, int]:
+    # runs a host build on a host input file, and returns the statistics it reports on exit
+    with open(os.devnull, "w") as devnull:
+        result = subprocess.run([binary_path], env=dict(os.environ, THEMIS_HOST_INPUT=input_path), stdout=devnull,
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return {name.strip().replace(" ", "_"): int(value)
+            for name, value in re.findall(r"([a-z ]+): (\d+)", result.stderr.replace("\n", ", "))}
+
+
+def report_build_profiles(robot_constructor: typing.Callable[[RoboRIO], None], workload_path: str = None,
+                          pgo: bool = True, runs: int = 5) -> str:
+    # builds the robot for the host with every build profile, with and without PGO, and measures each one on the
+    # workload (by default, a synthetic one). the update cost is the best of several runs, to reduce noise.
     with themis.codegen.GenerationContext().enter():
         roboRIO = RoboRIO()
         robot_constructor(roboRIO)
-        compiled_code = compile_roboRIO(themis.codegen.generate_code())
+        c_code = themis.codegen.generate_code()
+    lines = ["%-12s %-4s %10s %16s" % ("profile", "pgo", "bytes", "ns per update")]
+    with tempfile.TemporaryDirectory() as tempdir:
+        if workload_path is None:
+            workload_path = os.path.join(tempdir, "workload.txt")
+            write_synthetic_workload(workload_path)
+        binary_path = os.path.join(tempdir, "robot")
+        for build_profile in themis.cbuild.BUILD_PROFILES:
+            for use_pgo in (False, True) if pgo else (False,):
+                with open(binary_path, "wb") as fout:
+                    fout.write(compile_host(c_code, build_profile=build_profile,
+                                            pgo_input=workload_path if use_pgo else None))
+                os.chmod(binary_path, 0o755)
+                update_ns = min(run_host_workload(binary_path, workload_path)["mean_update"] for _ in range(runs))
+                lines.append("%-12s %-4s %10d %16d" % (build_profile, "yes" if use_pgo else "no",
+                                                       os.path.getsize(binary_path), update_ns))
+    return "\n".join(lines)
+
+
+def _check_sizes(context: themis.codegen.GenerationContext, symbol_sizes: typing.Optional[dict], size_report: bool,
+                 size_budget: typing.Optional[themis.size.SizeBudget]) -> None:
+    if size_report:
+        print(themis.size.report(symbol_sizes, context.symbols))
+    if size_budget is not None:
+        themis.size.check_budget(symbol_sizes, context.symbols, size_budget)
+
+
+def _generate(profile: bool, units: int, line_directives: bool):
+    # more than one unit splits the generated code into that many C files, compiled in parallel and cached separately.
+    # calls between units can't be inlined, except in builds that use LTO.
+    if units == 1:
+        return themis.codegen.generate_code(profile, line_directives)
+    return themis.codegen.generate_units(units, profile, line_directives)
+
+
+def robot(team_number: int, robot_constructor: typing.Callable[[RoboRIO], None], profile: bool = False,
+          topological: bool = False, build_profile: str = DEFAULT_BUILD_PROFILE, size_report: bool = False,
+          size_budget: typing.Optional[themis.size.SizeBudget] = None, units: int = 1,
+          profile_map_path: str = "robot.profile.json", line_directives: bool = False,
+          source_map_path: typing.Optional[str] = None):
+    # with profile, the map that themis.profile needs to read the robot's dumps is written to profile_map_path. with
+    # size_report, the bytes of code behind each instant are printed; a size_budget stops the deploy if exceeded.
+    # line_directives attributes compiler diagnostics to the robot code, and source_map_path saves which robot code
+    # line created each generated symbol.
+    context = themis.codegen.GenerationContext(topological)
+    debugging = profile or size_report or size_budget is not None or line_directives or source_map_path is not None
+    with context.enter(), themis.cgen.track_sources(debugging):
+        roboRIO = RoboRIO()
+        robot_constructor(roboRIO)
+        symbol_sizes = {} if size_report or size_budget is not None else None
+        compiled_code = compile_roboRIO(_generate(profile, units, line_directives), build_profile, symbol_sizes)
+        _check_sizes(context, symbol_sizes, size_report, size_budget)
+        if profile:
+            themis.profile.write_map(profile_map_path, context.profiled_instants)
+        if source_map_path is not None:
+            context.write_source_map(source_map_path)
         deploy_roboRIO(team_number, compiled_code)
+
+
+def robot_host(output_path: str, robot_constructor: typing.Callable[[RoboRIO], None], epoll_runloop: bool = False,
+               profile: bool = False, topological: bool = False, build_profile: str = DEFAULT_BUILD_PROFILE,
+               pgo_input: typing.Optional[str] = None, size_report: bool = False,
+               size_budget: typing.Optional[themis.size.SizeBudget] = None, units: int = 1,
+               line_directives: bool = False, source_map_path: typing.Optional[str] = None):
+    context = themis.codegen.GenerationContext(topological)
+    debugging = profile or size_report or size_budget is not None or line_directives or source_map_path is not None
+    with context.enter(), themis.cgen.track_sources(debugging):
+        roboRIO = RoboRIO()
+        robot_constructor(roboRIO)
+        symbol_sizes = {} if size_report or size_budget is not None else None
+        compiled_code = compile_host(_generate(profile, units, line_directives), epoll_runloop, build_profile,
+                                     pgo_input, symbol_sizes)
+        _check_sizes(context, symbol_sizes, size_report, size_budget)
+        if profile:
+            themis.profile.write_map(output_path + ".profile.json", context.profiled_instants)
+        if source_map_path is not None:
+            context.write_source_map(source_map_path)
+    with open(output_path, "wb") as fout:
+        fout.write(compiled_code)
+    os.chmod(output_path, 0o755)
+
+
+def simulate(robot_constructor: typing.Callable[[RoboRIO], None], topological: bool = False) -> themis.host.HostRuntime:
+    with themis.codegen.GenerationContext(topological).enter():
+        roboRIO = RoboRIO()
+        robot_constructor(roboRIO)
+        python_code = themis.codegen.generate_python()
+    runtime = themis.host.HostRuntime(modes=Mode)
+    themis.cgen.pygen.compile_python(python_code, runtime.functions())()
+    return runtime
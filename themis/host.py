@@ -0,0 +1,230 @@
+import collections
+import heapq
+import math
+import typing
+
+import themis.cgen.helpers
+
+__all__ = ["HostPanic", "HostRuntime"]
+
+Callback = typing.Callable[[], None]
+
+
+class HostPanic(Exception):
+    pass
+
+
+# stand-ins for the C runtime and the FRC HAL, driven by a virtual clock instead of real hardware
+class HostRuntime:
+    def __init__(self, modes=None):
+        self.now_ns = 0
+        self._queue = collections.deque()
+        self._periodic = []  # [next_tick_ns, period_ns, callback]
+        self._one_shots = []  # heap of (happen_at_ns, sequence, callback)
+        self._sequence = 0
+        self._timers_started = False
+
+        self._modes = modes
+        self.robot_mode = 0
+        self.axes = {}
+        self.buttons = {}
+        self._ds_target = None
+        self._ds_ready = True
+
+        self.pwm = {}
+        self.pwm_writes = collections.Counter()
+        self.pwm_skipped = collections.Counter()
+        self._pwm_staged = {}
+        self._pwm_forced = set()
+        self.solenoids = {}
+        self.gpio = {}
+        self._interrupts = {}
+
+        self.events_dispatched = 0
+
+    def functions(self) -> typing.Dict[str, typing.Callable]:
+        functions = dict(themis.cgen.helpers.PURE_HELPERS)
+        for name in ("enter_loop", "queue_event", "start_timer_ns", "begin_timers", "run_after_ns", "panic",
+                     "do_nothing", "ds_init", "ds_begin", "get_robot_mode", "get_joystick_axis",
+                     "get_joystick_button", "pwm_init", "pwm_update", "pwm_stage", "pwm_refresh", "pwm_flush",
+                     "solenoid_init", "solenoid_update",
+                     "gpio_init_input_poll", "gpio_poll_input", "gpio_init_input_interrupt",
+                     "gpio_start_interrupt"):
+            functions[name] = getattr(self, name)
+        # the inline snapshot accessors from themis.h, which read the same state as the get_* functions here
+        functions.update(ds_mode=self.get_robot_mode, ds_axis=self.get_joystick_axis,
+                         ds_button=self.get_joystick_button)
+        return functions
+
+    # === runloop.c ===
+
+    def enter_loop(self, entry: Callback) -> None:
+        # unlike the real runloop, this returns once there's nothing left to do, so that the caller can drive time.
+        self.queue_event(entry)
+        self.run_pending()
+
+    def queue_event(self, cb: Callback) -> None:
+        self._queue.append(cb)
+
+    def run_pending(self) -> int:
+        count = 0
+        while self._queue:
+            self._queue.popleft()()
+            self.pwm_flush()  # the after-dispatch hook that frc.cpp installs
+            count += 1
+        self.events_dispatched += count
+        return count
+
+    # === timers.c ===
+
+    def start_timer_ns(self, period_ns: int, cb: Callback) -> None:
+        assert not self._timers_started
+        self._periodic.append([None, period_ns, cb])
+
+    def begin_timers(self) -> None:
+        self._timers_started = True
+        for timer in self._periodic:
+            timer[0] = self.now_ns + timer[1]
+
+    def run_after_ns(self, delay_ns: int, cb: Callback) -> None:
+        heapq.heappush(self._one_shots, (self.now_ns + delay_ns, self._sequence, cb))
+        self._sequence += 1
+
+    def _next_deadline(self) -> typing.Optional[int]:
+        deadlines = [timer[0] for timer in self._periodic if timer[0] is not None]
+        if self._one_shots:
+            deadlines.append(self._one_shots[0][0])
+        return min(deadlines) if deadlines else None
+
+    def advance_ns(self, nanos: int) -> None:
+        assert nanos >= 0
+        end = self.now_ns + nanos
+        self.run_pending()
+        while True:
+            deadline = self._next_deadline()
+            if deadline is None or deadline > end:
+                break
+            self.now_ns = deadline
+            for timer in self._periodic:
+                if timer[0] == deadline:
+                    self.queue_event(timer[2])
+                    timer[0] += timer[1]
+            while self._one_shots and self._one_shots[0][0] == deadline:
+                self.queue_event(heapq.heappop(self._one_shots)[2])
+            self.run_pending()
+        self.now_ns = end
+
+    def advance_ms(self, millis: float) -> None:
+        self.advance_ns(int(millis * 1000000))
+
+    # === themis.c ===
+
+    def panic(self, err: str) -> None:
+        raise HostPanic(err)
+
+    def do_nothing(self) -> None:
+        pass
+
+    # === frc.cpp ===
+
+    def ds_init(self) -> None:
+        pass
+
+    def ds_begin(self, target: Callback) -> None:
+        assert self._ds_target is None and target is not None
+        self._ds_target = target
+
+    def _ds_dispatch(self) -> None:
+        self._ds_ready = True
+        self._ds_target()
+
+    def ds_packet(self) -> None:
+        assert self._ds_target is not None, "no driver station dispatch registered"
+        if self._ds_ready:
+            self._ds_ready = False
+            self.queue_event(self._ds_dispatch)
+        self.run_pending()
+
+    def set_mode(self, mode) -> None:
+        if isinstance(mode, str):
+            assert self._modes is not None, "no mode names available"
+            mode = self._modes.numeric(mode)
+        self.robot_mode = mode
+
+    def set_axis(self, joystick: int, axis: int, value: float) -> None:  # 1-indexed, like Joystick.axis
+        self.axes[joystick - 1, axis - 1] = float(value)
+
+    def set_button(self, joystick: int, button: int, value: bool) -> None:  # 1-indexed, like Joystick.button
+        self.buttons[joystick - 1, button - 1] = bool(value)
+
+    def get_robot_mode(self) -> int:
+        return self.robot_mode
+
+    def get_joystick_axis(self, joy_i: int, axis: int) -> float:
+        return self.axes.get((joy_i, axis), 0.0)
+
+    def get_joystick_button(self, joy_i: int, btn: int) -> bool:
+        return self.buttons.get((joy_i, btn), False)
+
+    def pwm_init(self, pwm_id: int, squelch: int, latch_pwm_zero: bool) -> None:
+        assert pwm_id not in self.pwm
+        self.pwm[pwm_id] = math.nan  # what frc.cpp's raw 0 means
+
+    def pwm_update(self, millis: float, pwm_id: int, force: bool = False) -> None:
+        assert pwm_id in self.pwm
+        # compared as values, since there is no FPGA loop timing here to convert them into raw steps
+        if not force and (millis == self.pwm[pwm_id] or (math.isnan(millis) and math.isnan(self.pwm[pwm_id]))):
+            self.pwm_skipped[pwm_id] += 1
+            return
+        self.pwm[pwm_id] = millis
+        self.pwm_writes[pwm_id] += 1
+
+    def pwm_stage(self, millis: float, pwm_id: int) -> None:
+        assert pwm_id in self.pwm
+        if pwm_id in self._pwm_staged:
+            self.pwm_skipped[pwm_id] += 1
+        self._pwm_staged[pwm_id] = millis
+
+    def pwm_refresh(self, millis: float, pwm_id: int) -> None:
+        self.pwm_stage(millis, pwm_id)
+        self._pwm_forced.add(pwm_id)
+
+    def pwm_flush(self) -> None:
+        for pwm_id, millis in sorted(self._pwm_staged.items()):
+            self.pwm_update(millis, pwm_id, pwm_id in self._pwm_forced)
+        self._pwm_staged.clear()
+        self._pwm_forced.clear()
+
+    def solenoid_init(self, pcm_id: int, solenoid_id: int) -> None:
+        assert (pcm_id, solenoid_id) not in self.solenoids
+        self.solenoids[pcm_id, solenoid_id] = False
+
+    def solenoid_update(self, on: bool, pcm_id: int, solenoid_id: int) -> None:
+        assert (pcm_id, solenoid_id) in self.solenoids
+        self.solenoids[pcm_id, solenoid_id] = on
+
+    def gpio_init_input_poll(self, gpio_pin: int) -> None:
+        assert gpio_pin not in self.gpio
+        self.gpio[gpio_pin] = False
+
+    def gpio_poll_input(self, gpio_pin: int) -> bool:
+        return self.gpio[gpio_pin]
+
+    def gpio_init_input_interrupt(self, gpio_pin: int, interrupt_id: int) -> None:
+        assert interrupt_id not in self._interrupts
+        self.gpio_init_input_poll(gpio_pin)
+        self._interrupts[interrupt_id] = (gpio_pin, None)
+
+    def gpio_start_interrupt(self, gpio_pin: int, interrupt_id: int, cb: Callback) -> None:
+        assert self._interrupts[interrupt_id] == (gpio_pin, None)
+        self._interrupts[interrupt_id] = (gpio_pin, cb)
+
+    def set_gpio(self, gpio_pin: int, value: bool) -> None:
+        assert gpio_pin in self.gpio
+        changed = self.gpio[gpio_pin] != value
+        self.gpio[gpio_pin] = value
+        if changed:
+            for pin, cb in self._interrupts.values():
+                if pin == gpio_pin and cb is not None:
+                    self.queue_event(cb)
+        self.run_pending()
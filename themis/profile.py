@@ -0,0 +1,68 @@
+import gc
+import json
+import sys
+import typing
+
+import themis.cgen
+
+__all__ = ["describe_instant", "write_map", "read_dump", "report"]
+
+
+def _owners(instant: themis.cgen.Instant) -> typing.List[str]:
+    # the channel objects (and other graph-building objects) that hold onto this instant
+    owners = []
+    for referrer in gc.get_referrers(instant):
+        module = type(referrer).__module__
+        if module.startswith("themis.") and not module.startswith("themis.cgen"):
+            owners.append("%s.%s" % (module, type(referrer).__qualname__))
+    return sorted(owners)
+
+
+def describe_instant(instant: themis.cgen.Instant) -> dict:
+    return {
+        "name": instant._instant,
+        "uid": instant._uid,
+        "param_type": themis.cgen.PARAM_TYPES[instant._param_type],
+        "source": themis.cgen.describe_source(instant._source),
+        "owners": _owners(instant),
+        "callers": sorted(user._instant for user in instant._users),
+        "first_statement": instant._body[0].generate().split("\n")[0] if instant._body else None,
+    }
+
+
+def write_map(path: str, instants: typing.List[themis.cgen.Instant]) -> None:
+    with open(path, "w") as fout:
+        json.dump([describe_instant(instant) for instant in instants], fout, indent=1)
+
+
+def read_dump(path: str) -> typing.List[typing.Tuple[str, int, int, int]]:
+    entries = []
+    with open(path, "r") as fin:
+        for line in fin:
+            if line.startswith("#") or not line.strip():
+                continue
+            name, uid, calls, total_ns = line.split()
+            entries.append((name, int(uid), int(calls), int(total_ns)))
+    return entries
+
+
+def report(dump_path: str, map_path: str, limit: int = 20) -> str:
+    with open(map_path, "r") as fin:
+        descriptions = {description["uid"]: description for description in json.load(fin)}
+    entries = sorted(read_dump(dump_path), key=lambda entry: entry[3], reverse=True)
+    lines = ["%-14s %10s %12s %10s  %s" % ("instant", "calls", "total us", "mean ns", "created by / first statement")]
+    for name, uid, calls, total_ns in entries[:limit]:
+        description = descriptions.get(uid, {})
+        lines.append("%-14s %10d %12.1f %10.0f  %s" % (name, calls, total_ns / 1000, total_ns / calls if calls else 0,
+                                                      description.get("source") or
+                                                      ", ".join(description.get("owners", [])) or "-"))
+        if description.get("first_statement"):
+            lines.append("%-50s %s" % ("", description["first_statement"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python -m themis.profile <themis-profile.txt> <program.profile.json>", file=sys.stderr)
+        sys.exit(1)
+    print(report(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,130 @@
+import heapq
+import typing
+
+import themis.cgen
+import themis.cgen.optimizer
+import themis.codegen
+from themis.cgen import ir
+
+__all__ = ["combine"]
+
+# In topological mode, expressions with more than one input (a * b, a & b, c.choose(a, b)) don't recompute as soon as
+# any one of their inputs updates. The inputs only mark the expression dirty, and each root event (driver station
+# packet, timer tick, interrupt) ends by recomputing its dirty expressions once each, in dependency order. An output fed
+# by several inputs that change in the same event is then computed and written once, and never sees a half-updated mix.
+
+
+class _Combination:
+    def __init__(self, sources: typing.List[themis.cgen.Instant], build):
+        self.sources = sources
+        self.dirty = themis.cgen.Box(False)
+        self.recompute = themis.cgen.Instant(None)
+        self.recompute.set(self.dirty, False)
+        build(self.recompute)
+        for source in sources:
+            source.set(self.dirty, True)
+
+
+def combine(sources: typing.List[themis.cgen.Instant], build: typing.Callable[[themis.cgen.Instant], None]) -> None:
+    # build appends the computation, which must only read the inputs' value Boxes, to the instant it's passed
+    if not themis.codegen.GenerationContext.get_context().topological:
+        for source in sources:
+            build(source)
+        return
+    themis.codegen.get_prop_init(combine, _init_combinations).append(_Combination(sources, build))
+
+
+def _init_combinations():
+    combinations = []
+    # late, so that every timer and other root event has been created before we look for them
+    themis.codegen.add_finalizer(lambda: _schedule(combinations), late=True)
+    return combinations
+
+
+def _callees(instant: themis.cgen.Instant) -> typing.Set[themis.cgen.Instant]:
+    # only direct calls: callbacks handed to the runtime run later, as root events of their own
+    callees = set()
+    nodes = list(instant._body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ir.Invoke):
+            callees.add(node.target)
+        nodes.extend(operand for operand in node.operands() if isinstance(operand, ir.Node))
+    return callees
+
+
+def _reachable(instant: themis.cgen.Instant) -> typing.Set[themis.cgen.Instant]:
+    reached = {instant}
+    remaining = [instant]
+    while remaining:
+        for callee in _callees(remaining.pop()):
+            if callee not in reached:
+                reached.add(callee)
+                remaining.append(callee)
+    return reached
+
+
+def _order(combinations: list, downstream: dict) -> list:
+    # Kahn's algorithm, breaking ties by creation order so that the output is deterministic
+    index = {combination: i for i, combination in enumerate(combinations)}
+    indegree = {combination: 0 for combination in combinations}
+    for combination in combinations:
+        for after in downstream[combination]:
+            indegree[after] += 1
+    ready = [i for i, combination in enumerate(combinations) if not indegree[combination]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        combination = combinations[heapq.heappop(ready)]
+        order.append(combination)
+        for after in downstream[combination]:
+            indegree[after] -= 1
+            if not indegree[after]:
+                heapq.heappush(ready, index[after])
+    if len(order) < len(combinations):
+        # anything on a cycle is recomputed in creation order, and picks up its feedback in the next event
+        print("PROPAGATION CYCLE BETWEEN", len(combinations) - len(order), "EXPRESSIONS")
+        order += [combination for combination in combinations if combination not in order]
+    return order
+
+
+def _schedule(combinations: list) -> None:
+    marked_by = {}
+    for combination in combinations:
+        for source in combination.sources:
+            marked_by.setdefault(source, []).append(combination)
+
+    def marked_from(instant):
+        return {marked for reached in _reachable(instant) for marked in marked_by.get(reached, ())}
+
+    downstream = {combination: marked_from(combination.recompute) - {combination} for combination in combinations}
+    order = _order(combinations, downstream)
+
+    instants = themis.cgen._enumerate_instants(themis.codegen.GenerationContext.get_context()._root_init)
+    callbacks = {arg for instant in instants for node in instant._body if isinstance(node, ir.PolyCall)
+                 for arg in node.args if isinstance(arg, themis.cgen.Instant) and arg.is_param_type(None)}
+    wrappers = {}
+    for callback in sorted(callbacks, key=lambda instant: instant._uid):
+        affected = marked_from(callback)
+        remaining = list(affected)
+        while remaining:
+            for after in downstream[remaining.pop()]:
+                if after not in affected:
+                    affected.add(after)
+                    remaining.append(after)
+        if not affected:
+            continue
+        wrapper = themis.cgen.Instant(None)
+        wrapper.invoke(callback)
+        for combination in order:
+            if combination in affected:
+                wrapper.if_equal(combination.dirty, True, combination.recompute)
+        wrappers[callback] = wrapper
+
+    def substitutor(node):
+        if isinstance(node, ir.PolyCall) and any(arg in wrappers for arg in node.args):
+            return ir.PolyCall(node.func, [wrappers.get(arg, arg) for arg in node.args])
+        return node
+
+    for instant in instants:
+        themis.cgen.optimizer.rewrite_body(instant, substitutor)
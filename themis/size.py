@@ -0,0 +1,64 @@
+import collections
+import typing
+
+import themis.cgen
+import themis.profile
+
+__all__ = ["SizeBudget", "SizeBudgetExceeded", "instant_sizes", "report", "check_budget"]
+
+
+class SizeBudgetExceeded(Exception):
+    pass
+
+
+class SizeBudget:
+    # limits, in bytes, on the code generated for a robot program; None for no limit
+    def __init__(self, generated_bytes: typing.Optional[int] = None, instant_bytes: typing.Optional[int] = None):
+        self.generated_bytes = generated_bytes  # all of the instant functions together
+        self.instant_bytes = instant_bytes  # any one instant function
+
+
+def instant_sizes(symbol_sizes: dict, symbols: dict) -> typing.List[typing.Tuple[themis.cgen.Instant, int]]:
+    # the instants that were compiled into functions of their own, largest first; gcc inlined the others into callers
+    sizes = [(symbols[name], size) for name, size in symbol_sizes.items()
+             if isinstance(symbols.get(name), themis.cgen.Instant)]
+    return sorted(sizes, key=lambda entry: (-entry[1], entry[0]._uid))
+
+
+def report(symbol_sizes: dict, symbols: dict, limit: int = 20) -> str:
+    sizes = instant_sizes(symbol_sizes, symbols)
+    generated = sum(symbol_sizes.get(name, 0) for name in symbols)
+    instant_count = sum(1 for symbol in symbols.values() if isinstance(symbol, themis.cgen.Instant))
+    by_owner = collections.Counter()
+    lines = ["generated code: %d bytes in %d functions (%d of %d instants inlined)" %
+             (generated, len(sizes), instant_count - len(sizes), instant_count),
+             "%-14s %8s  %s" % ("instant", "bytes", "created by / first statement")]
+    for i, (instant, size) in enumerate(sizes):
+        description = themis.profile.describe_instant(instant)
+        for owner in set(description["owners"]) or {"-"}:
+            by_owner[owner] += size
+        if i < limit:
+            lines.append("%-14s %8d  %s" % (instant._instant, size,
+                                            description["source"] or ", ".join(description["owners"]) or "-"))
+            if description["first_statement"]:
+                lines.append("%-24s %s" % ("", description["first_statement"]))
+    # an instant held by several channels counts towards each of them
+    lines.append("%-50s %8s" % ("by channel type", "bytes"))
+    for owner, size in sorted(by_owner.items(), key=lambda entry: (-entry[1], entry[0])):
+        lines.append("%-50s %8d" % (owner, size))
+    return "\n".join(lines)
+
+
+def check_budget(symbol_sizes: dict, symbols: dict, budget: SizeBudget) -> None:
+    sizes = instant_sizes(symbol_sizes, symbols)
+    problems = []
+    generated = sum(symbol_sizes.get(name, 0) for name in symbols)
+    if budget.generated_bytes is not None and generated > budget.generated_bytes:
+        problems.append("generated code is %d bytes, over the budget of %d" % (generated, budget.generated_bytes))
+    if budget.instant_bytes is not None:
+        problems += ["%s (from %s) is %d bytes, over the budget of %d per instant" %
+                     (instant._instant, themis.cgen.describe_source(instant._source) or "unknown", size,
+                      budget.instant_bytes)
+                     for instant, size in sizes if size > budget.instant_bytes]
+    if problems:
+        raise SizeBudgetExceeded("; ".join(problems))
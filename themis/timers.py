@@ -1,26 +1,116 @@
+import math
+import typing
+
 import themis.channel.event
 import themis.codegen
 import themis.cgen
 
+MAX_PHASE_SPAN = 1024  # number of base ticks considered when spreading dividers across phases
+
+
+def _start_timer(nanos: int, target) -> None:
+    # periodic timers must all be registered before the timer thread starts in PHASE_BEGIN
+    _ensure_proc_thread()
+    themis.codegen.add_init_call("start_timer_ns", themis.codegen.InitPhase.PHASE_INIT_IO, nanos, target)
+
 
-def tick(millis: int, event: themis.channel.event.EventOutput) -> None:
+def tick(millis: int, event: "themis.channel.event.EventOutput") -> None:
     assert millis > 0
     nanos = millis * 1000000
-    themis.codegen.add_init_call("start_timer_ns", themis.codegen.InitPhase.PHASE_BEGIN, nanos, event)
+    _start_timer(nanos, event)
 
 
-def ticker(millis: int, isolated=False) -> themis.channel.event.EventInput:
+def ticker(millis: int, isolated=False) -> "themis.channel.event.EventInput":
     assert millis > 0
     if not isolated:
-        cached_tickers = themis.codegen.get_prop_init(ticker, lambda: {})
+        cached_tickers = themis.codegen.get_prop_init(ticker, _init_tickers)
         if millis not in cached_tickers:
-            cached_tickers[millis] = ticker(millis, isolated=True)
+            # not scheduled until the graph is complete, so that it can share a timer with the other tickers
+            cached_tickers[millis] = themis.channel.event.event_cell()[1]
         return cached_tickers[millis]
     event_out, event_in = themis.channel.event.event_cell()
     tick(millis, event_out)
     return event_in
 
 
+def _init_tickers():
+    tickers = {}
+    themis.codegen.add_finalizer(lambda: _schedule_tickers(tickers))
+    return tickers
+
+
+def group_periods(periods: typing.Iterable[int]) -> typing.List[typing.Tuple[int, typing.List[int]]]:
+    groups = []  # [base, [periods]]
+    for period in sorted(set(periods)):
+        for group in groups:
+            base = math.gcd(group[0], period)
+            # merge if one timer at the shared base wakes up no more often than the two did separately,
+            # i.e. 1/base <= 1/group_base + 1/period
+            if group[0] * period <= base * (group[0] + period):
+                group[0] = base
+                group[1].append(period)
+                break
+        else:
+            groups.append([period, [period]])
+    return [(base, members) for base, members in groups]
+
+
+def assign_phases(divisors: typing.List[int]) -> typing.List[int]:
+    span = 1
+    for divisor in divisors:
+        span = span * divisor // math.gcd(span, divisor)
+    span = min(span, MAX_PHASE_SPAN)
+    load = [0] * span
+    phases = [None] * len(divisors)
+    # place the most frequent dividers first, since they have the fewest choices
+    for i in sorted(range(len(divisors)), key=lambda i: divisors[i]):
+        divisor = divisors[i]
+        phase = min(range(min(divisor, span)), key=lambda p: (max(load[p::divisor]), sum(load[p::divisor]), p))
+        for tick_i in range(phase, span, divisor):
+            load[tick_i] += 1
+        phases[i] = phase
+    return phases
+
+
+def _add_divider(base: themis.cgen.Instant, target: themis.cgen.Instant, divisor: int, phase: int) -> None:
+    # counts down from the phase offset; fires and resets to divisor - 1 at zero
+    counter = themis.cgen.Box(phase)
+    fire = themis.cgen.Instant(None)
+    step = themis.cgen.Instant(None)
+    store = themis.cgen.Instant(int)
+    base.if_else(counter, 0, fire, step)
+    fire.set(counter, divisor - 1)
+    fire.invoke(target)
+    step.operator_transform("-", store, counter, 1)
+    store.set(counter, themis.cgen.Param)
+
+
+def _schedule_tickers(tickers: dict) -> None:
+    # tickers that nothing ever listened to don't need timers at all
+    live = {int(millis * 1000000): event.get_instant() for millis, event in tickers.items()
+            if not event.get_instant().is_empty()}
+    schedule = themis.codegen.get_prop_init(_schedule_tickers, lambda: [])
+    for base_nanos, periods in group_periods(live):
+        divisors = [period // base_nanos for period in periods]
+        phases = assign_phases(divisors)
+        schedule.append((base_nanos, list(zip(periods, divisors, phases))))
+        if divisors == [1]:
+            _start_timer(base_nanos, live[periods[0]])
+            continue
+        base = themis.cgen.Instant(None)
+        _start_timer(base_nanos, base)
+        for period, divisor, phase in zip(periods, divisors, phases):
+            if divisor == 1:
+                base.invoke(live[period])
+            else:
+                _add_divider(base, live[period], divisor, phase)
+
+
+def ticker_schedule() -> typing.List[typing.Tuple[int, typing.List[typing.Tuple[int, int, int]]]]:
+    # after generation: [(base period ns, [(ticker period ns, divisor, phase)])], one entry per timer
+    return themis.codegen.get_prop_init(_schedule_tickers, lambda: [])
+
+
 def _gen_proc_thread():
     themis.codegen.add_init_call("begin_timers", themis.codegen.InitPhase.PHASE_BEGIN)
 
@@ -29,7 +119,7 @@ def _ensure_proc_thread():
     themis.codegen.get_prop_init(_ensure_proc_thread, _gen_proc_thread)
 
 
-def delay_ms(out: themis.channel.event.EventOutput, milliseconds: (int, float)) -> themis.channel.event.EventOutput:
+def delay_ms(out: "themis.channel.event.EventOutput", milliseconds: (int, float)) -> "themis.channel.event.EventOutput":
     assert isinstance(milliseconds, (int, float))
     _ensure_proc_thread()
     nanos = int(milliseconds * 1000000)
@@ -39,7 +129,7 @@ def delay_ms(out: themis.channel.event.EventOutput, milliseconds: (int, float))
     return themis.channel.EventOutput(instant)
 
 
-def after_ms(begin: themis.channel.event.EventInput, milliseconds: (int, float)) -> themis.channel.event.EventInput:
+def after_ms(begin: "themis.channel.event.EventInput", milliseconds: (int, float)) -> "themis.channel.event.EventInput":
     cell_out, cell_in = themis.channel.event.event_cell()
     begin.send(delay_ms(cell_out, milliseconds))
     return cell_in
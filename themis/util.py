@@ -51,4 +51,4 @@ class Parameterization:
     def __exit__(self, exc_type, exc_val, exc_tb):
         assert self._inside
         self._inside = False
-        assert self._swap(self._saved_value)
+        assert self._swap(self._saved_value) is self._value  # (entered and exited in a nested order)